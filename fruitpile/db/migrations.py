@@ -0,0 +1,202 @@
+# Copyright (c) 2016 Dominic Binks (software-fool on github)
+# This file is part of Fruitpile.
+#
+# Fruitpile is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fruitpile is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fruitpile.  If not, see <http://www.gnu.org/licenses/>.
+
+from .schema import *
+from sqlalchemy import func, inspect, text, select
+
+# Schema and data changes for existing stores.  Each step has a number,
+# which is recorded in the migrations table once the step has completed.
+# A new store is created with the latest schema and all of the steps
+# recorded as applied.
+#
+# A step is applied a batch at a time: run() is a generator which commits
+# each batch before yielding the number of rows done so far.  Steps must
+# be safe to run again on a store that already has the change so that an
+# interrupted upgrade can simply be restarted.
+
+BATCH_SIZE = 1000
+
+class MigrationStep(object):
+
+  def __init__(self, mig_id, name):
+    self.id = mig_id
+    self.name = name
+
+  def total(self, session):
+    # The number of rows the step will work through, if known
+    return None
+
+  def run(self, engine, session, batch_size):
+    raise NotImplementedError
+
+class CreateIndexes(MigrationStep):
+  # Creates the indexes declared in the schema on the given tables
+
+  def __init__(self, mig_id, name, tables):
+    MigrationStep.__init__(self, mig_id, name)
+    self.tables = tables
+
+  def run(self, engine, session, batch_size):
+    for table in self.tables:
+      for index in table.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+    yield 0
+
+class CreateTables(MigrationStep):
+  # Creates tables added to the schema after the store was made
+
+  def __init__(self, mig_id, name, tables):
+    MigrationStep.__init__(self, mig_id, name)
+    self.tables = tables
+
+  def run(self, engine, session, batch_size):
+    Base.metadata.create_all(bind=engine, tables=[t.__table__ for t in self.tables], checkfirst=True)
+    yield 0
+
+class AddColumn(MigrationStep):
+  # Adds a column declared in the schema to an existing table.  The
+  # column must be nullable or have a server default.
+
+  def __init__(self, mig_id, name, column):
+    MigrationStep.__init__(self, mig_id, name)
+    self.column = column
+
+  def run(self, engine, session, batch_size):
+    table = self.column.table
+    names = [c["name"] for c in inspect(engine).get_columns(table.name)]
+    if self.column.name not in names:
+      coltype = self.column.type.compile(dialect=engine.dialect)
+      with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE %s ADD COLUMN %s %s" % (table.name, self.column.name, coltype)))
+    yield 0
+
+class BatchedUpdate(MigrationStep):
+  # Works through the rows of entity matching where in id order calling
+  # fn(session, ids) for each batch.  fn must change the rows so they no
+  # longer match where, which is what lets the step be restarted.
+
+  def __init__(self, mig_id, name, entity, where, fn):
+    MigrationStep.__init__(self, mig_id, name)
+    self.entity = entity
+    self.where = where
+    self.fn = fn
+
+  def _pending(self, session):
+    return session.query(self.entity.id).filter(self.where)
+
+  def total(self, session):
+    return self._pending(session).count()
+
+  def run(self, engine, session, batch_size):
+    done = 0
+    last_id = None
+    while True:
+      q = self._pending(session)
+      if last_id is not None:
+        q = q.filter(self.entity.id > last_id)
+      ids = [row[0] for row in q.order_by(self.entity.id).limit(batch_size)]
+      if not ids:
+        break
+      self.fn(session, ids)
+      session.commit()
+      done += len(ids)
+      last_id = ids[-1]
+      yield done
+
+class DedupeProperties(MigrationStep):
+  # Stores made before properties were interned have a row per
+  # association.  Point the associations at the lowest numbered row with
+  # the same name and value and remove the rest, which has to happen
+  # before the unique index on (name, value) can be created.
+
+  def total(self, session):
+    distinct = session.query(Property.name, Property.value).distinct().count()
+    return session.query(Property).count() - distinct
+
+  def run(self, engine, session, batch_size):
+    q = session.query(Property.name, Property.value, func.min(Property.id)).group_by(
+      Property.name, Property.value).having(func.count(Property.id) > 1)
+    keep = dict(((name, value), keep_id) for name, value, keep_id in q)
+    done = 0
+    last_id = 0
+    while keep:
+      rows = session.query(Property.id, Property.name, Property.value).filter(
+        Property.id > last_id).order_by(Property.id).limit(batch_size).all()
+      if not rows:
+        break
+      last_id = rows[-1].id
+      dups = {}
+      for row in rows:
+        keep_id = keep.get((row.name, row.value), row.id)
+        if keep_id != row.id:
+          dups.setdefault(keep_id, []).append(row.id)
+      if not dups:
+        continue
+      for keep_id, dup_ids in dups.items():
+        for assoc, key in [(PropAssoc, PropAssoc.fileset_id), (BinFileProp, BinFileProp.binfile_id)]:
+          has_keep = select(key).where(assoc.prop_id == keep_id)
+          session.query(assoc).filter(assoc.prop_id.in_(dup_ids), key.in_(has_keep)).delete(
+            synchronize_session=False)
+          session.query(assoc).filter(assoc.prop_id.in_(dup_ids)).update(
+            {assoc.prop_id: keep_id}, synchronize_session=False)
+      removed = [dup_id for dup_ids in dups.values() for dup_id in dup_ids]
+      session.query(Property).filter(Property.id.in_(removed)).delete(synchronize_session=False)
+      session.commit()
+      done += len(removed)
+      yield done
+
+MIGRATIONS = [
+  CreateIndexes(2, "add_hot_column_indexes", [BinFile, TagAssoc, PropAssoc, BinFileTag, BinFileProp]),
+  CreateTables(3, "add_verifications_table", [Verification]),
+  DedupeProperties(4, "dedupe_properties"),
+  CreateIndexes(5, "add_unique_property_index", [Property]),
+  AddColumn(6, "add_binfile_size", BinFile.__table__.c.size)]
+
+def current_version(session):
+  return session.query(func.max(Migration.id)).scalar() or 0
+
+def pending_migrations(session, steps=None):
+  version = current_version(session)
+  return [step for step in (steps or MIGRATIONS) if step.id > version]
+
+def migrate(engine, progress=None, batch_size=BATCH_SIZE, steps=None):
+  # Apply the steps the store doesn't have yet in order.  progress, if
+  # given, is called as progress(step, done, total) when each step starts
+  # and after each batch.  Returns the numbers of the steps applied.
+  Session = sessionmaker(bind=engine)
+  session = Session()
+  applied = []
+  try:
+    for step in pending_migrations(session, steps):
+      total = step.total(session)
+      session.commit()
+      if progress is not None:
+        progress(step, 0, total)
+      for done in step.run(engine, session, batch_size):
+        if progress is not None and done:
+          progress(step, done, total)
+      session.add(Migration(id=step.id, script=step.name))
+      session.commit()
+      applied.append(step.id)
+  finally:
+    session.close()
+  return applied
+
+def mark_migrated(session):
+  # A new store already has the latest schema
+  for step in pending_migrations(session):
+    session.add(Migration(id=step.id, script=step.name))
+  session.commit()
@@ -15,8 +15,8 @@
 # along with Fruitpile.  If not, see <http://www.gnu.org/licenses/>.
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Table
-from sqlalchemy.schema import UniqueConstraint, PrimaryKeyConstraint, CheckConstraint
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Boolean, ForeignKey, Table
+from sqlalchemy.schema import UniqueConstraint, PrimaryKeyConstraint, CheckConstraint, Index
 from sqlalchemy.orm import relationship, sessionmaker
 from sqlalchemy import create_engine
 from sqlalchemy.exc import IntegrityError
@@ -153,6 +153,10 @@ class Tag(Base):
 
 class Property(Base):
   __tablename__ = "properties"
+  __table_args__ = (
+    # Each (name, value) pair is stored once and shared
+    Index('ux_properties_name_value', 'name', 'value', unique=True),
+  )
 
   id = Column(Integer, primary_key=True)
   name = Column(String(60), nullable=False)
@@ -231,7 +235,11 @@ class BinFile(Base):
   __tablename__ = 'binfiles'
   __table_args__ = (
     UniqueConstraint('name', 'path'),
-    UniqueConstraint('fileset_id', 'name')
+    UniqueConstraint('fileset_id', 'name'),
+    # Supports the auxilliary file lookups done by transition functions
+    Index('ix_binfiles_fileset_primary_name', 'fileset_id', 'primary', 'name'),
+    Index('ix_binfiles_state_id', 'state_id'),
+    Index('ix_binfiles_checksum', 'checksum')
   )
 
   id = Column(Integer, primary_key=True)
@@ -261,6 +269,9 @@ class BinFile(Base):
   # the file and if so, what type.  If the file is already in a compressed
   # form then it won't be recompressed (typically used for text documents
   ztype = Column(String)
+  # The size of the original contents in bytes, so it is known without
+  # decompressing the file.  None for files added before it was recorded.
+  size = Column(BigInteger)
 
   def tags(self, session):
     tas = session.query(BinFileTag).filter(BinFileTag.binfile_id == self.id).all()
@@ -279,10 +290,23 @@ class BinFile(Base):
   def __repr__(self):
     return "<BinFile(name='%s', path='%s')>" % (self.name, self.path)
 
+class Verification(Base):
+  __tablename__ = "verifications"
+
+  # The last time the stored contents of a binfile were checked against
+  # its checksum and what was found (ok, missing or corrupt)
+  binfile_id = Column(Integer, ForeignKey('binfiles.id'), primary_key=True)
+  verified = Column(DateTime, nullable=False)
+  status = Column(String(10), nullable=False)
+
+  def __repr__(self):
+    return "<Verification(%d,%s,%s)>" % (self.binfile_id, self.status, self.verified)
+
 class TagAssoc(Base):
   __tablename__ = "tags_assocs"
   __table_args__ = (
     PrimaryKeyConstraint('tag_id','fileset_id'),
+    Index('ix_tags_assocs_fileset_id', 'fileset_id')
   )
 
   tag_id = Column('tag_id', ForeignKey('tags.id'), primary_key=True)
@@ -296,6 +320,7 @@ class PropAssoc(Base):
   __tablename__ = "props_assocs"
   __table_args__ = (
     PrimaryKeyConstraint('prop_id','fileset_id'),
+    Index('ix_props_assocs_fileset_id', 'fileset_id')
   )
 
   prop_id = Column('prop_id', ForeignKey('properties.id'))
@@ -309,6 +334,7 @@ class BinFileTag(Base):
   __tablename__ = "binfile_tags"
   __table_args__ = (
     PrimaryKeyConstraint('tag_id','binfile_id'),
+    Index('ix_binfile_tags_binfile_id', 'binfile_id')
   )
 
   tag_id = Column('tag_id', ForeignKey('tags.id'), primary_key=True)
@@ -322,6 +348,7 @@ class BinFileProp(Base):
   __tablename__ = 'binfile_props'
   __table_args__ = (
     PrimaryKeyConstraint('prop_id','binfile_id'),
+    Index('ix_binfile_props_binfile_id', 'binfile_id')
   )
 
   prop_id = Column('prop_id', ForeignKey('properties.id'))
@@ -331,11 +358,11 @@ class BinFileProp(Base):
   def __repr__(self):
     return "<BinFileProp(%d,%d)>" % (self.prop_id, self.binfile_id)
 
-def upgrade(engine, uid, username, path):
+def upgrade(engine, uid, username, path, repo_type="FileManager"):
   Base.metadata.create_all(bind=engine)
   Session = sessionmaker(bind=engine)
   session = Session()
-  rp = Repo(name="default", path=path, repo_type="FileManager")
+  rp = Repo(name="default", path=path, repo_type=repo_type)
   session.add(rp)
   session.add(User(uid=uid, name=username))
   for name in Capability.keys():
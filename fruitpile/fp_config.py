@@ -0,0 +1,154 @@
+# Copyright (c) 2016 Dominic Binks (software-fool on github)
+# This file is part of Fruitpile.
+#
+# Fruitpile is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fruitpile is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fruitpile.  If not, see <http://www.gnu.org/licenses/>.
+
+from configparser import ConfigParser, Error as ConfigError
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import ArgumentError
+from sqlalchemy.pool import QueuePool
+from .fp_exc import FPLConfiguration
+import os
+
+# Per store settings live in fpl.cfg in the store directory.
+#
+# [database] url is the SQLAlchemy URL of the metadata database, by
+# default the sqlite database fpl.db in the store.  Pointing several
+# stores (e.g. one per API node) at the same server database lets them
+# share the metadata; the pool_* settings size each node's connection
+# pool.
+#
+# [repo] path overrides where this node finds the files, which is
+# otherwise the path recorded in the database when the store was made.
+#
+# [sqlite] holds the pragmas applied to every connection made to a
+# sqlite database; the defaults put the database in WAL mode so readers
+# don't wait on a writer and a writer waits (up to busy_timeout ms)
+# rather than failing when another process holds the write lock.
+
+CONFIG_FILE = "fpl.cfg"
+DB_FILE = "fpl.db"
+
+DATABASE_DEFAULTS = [
+  ("url", ""),
+  ("pool_size", "5"),
+  ("max_overflow", "10"),
+  ("pool_recycle", "3600")]
+
+REPO_DEFAULTS = [
+  ("path", "")]
+
+# busy_timeout goes first so the rest wait for other connections, e.g.
+# changing journal_mode needs the database to itself
+SQLITE_DEFAULTS = [
+  ("busy_timeout", "5000"),
+  ("journal_mode", "wal"),
+  ("synchronous", "normal"),
+  ("cache_size", "-16000"),
+  ("mmap_size", "268435456"),
+  ("temp_store", "memory"),
+  ("foreign_keys", "off")]
+
+SQLITE_CHOICES = {
+  "journal_mode": ["delete", "truncate", "persist", "memory", "wal", "off"],
+  "synchronous": ["off", "normal", "full", "extra"],
+  "temp_store": ["default", "file", "memory"],
+  "foreign_keys": ["on", "off"]}
+
+def default_config():
+  config = ConfigParser()
+  for section, defaults in [("database", DATABASE_DEFAULTS),
+                            ("repo", REPO_DEFAULTS),
+                            ("sqlite", SQLITE_DEFAULTS)]:
+    config.add_section(section)
+    for name, value in defaults:
+      config.set(section, name, value)
+  return config
+
+def load_config(path):
+  # Read the store's fpl.cfg over the defaults, a store without one
+  # (made before the file existed) just gets the defaults
+  config = default_config()
+  try:
+    config.read(os.path.join(path, CONFIG_FILE))
+  except ConfigError as e:
+    raise FPLConfiguration("cannot read %s: %s" % (CONFIG_FILE, e))
+  return config
+
+def write_config(path, config):
+  with open(os.path.join(path, CONFIG_FILE), "w") as f:
+    config.write(f)
+
+def database_url(path, config):
+  url = config.get("database", "url", fallback="").strip()
+  if not url:
+    return make_url("sqlite:///%s" % (os.path.abspath(os.path.join(path, DB_FILE))))
+  try:
+    return make_url(url)
+  except ArgumentError as e:
+    raise FPLConfiguration("invalid database url: %s" % (e))
+
+def repo_path(config):
+  return config.get("repo", "path", fallback="").strip() or None
+
+def is_sqlite(url):
+  return url.get_backend_name() == "sqlite"
+
+def _int_setting(config, section, name, default):
+  value = config.get(section, name, fallback=default).strip()
+  try:
+    return int(value)
+  except ValueError:
+    raise FPLConfiguration("invalid value for %s %s: %s" % (section, name, value))
+
+def sqlite_pragmas(config):
+  # The pragmas to apply as (name, value) pairs, in the order they're
+  # applied, checking each value is one sqlite will accept
+  pragmas = []
+  for name, default in SQLITE_DEFAULTS:
+    if name in SQLITE_CHOICES:
+      value = config.get("sqlite", name, fallback=default).strip().lower()
+      if value not in SQLITE_CHOICES[name]:
+        raise FPLConfiguration("invalid value for sqlite %s: %s" % (name, value))
+    else:
+      value = str(_int_setting(config, "sqlite", name, default))
+    pragmas.append((name, value))
+  return pragmas
+
+def create_store_engine(url, config, scoped=False):
+  # create_engine for the store's database.  sqlite databases get the
+  # configured pragmas set on every new connection, and are only pooled
+  # for scoped (multi-threaded) use; anything else is pooled as
+  # configured in [database].
+  if is_sqlite(url):
+    pragmas = sqlite_pragmas(config)
+    if scoped:
+      engine = create_engine(url, poolclass=QueuePool,
+                             connect_args={"check_same_thread": False})
+    else:
+      engine = create_engine(url)
+    def set_pragmas(dbapi_conn, conn_record):
+      cursor = dbapi_conn.cursor()
+      for name, value in pragmas:
+        cursor.execute("PRAGMA %s=%s" % (name, value))
+      cursor.close()
+    event.listen(engine, "connect", set_pragmas)
+    return engine
+  pool = dict((name, _int_setting(config, "database", name, default))
+              for name, default in DATABASE_DEFAULTS if name != "url")
+  try:
+    return create_engine(url, pool_pre_ping=True, **pool)
+  except (ArgumentError, ImportError) as e:
+    raise FPLConfiguration("cannot use database %s: %s" % (url.render_as_string(hide_password=True), e))
@@ -26,6 +26,9 @@ class FPLExists(FruitpileError):
 class FPLRepoInUse(FruitpileError):
   pass
 
+class FPLNeedsUpgrade(FruitpileError):
+  pass
+
 class FPLFileSetExists(FruitpileError):
   pass
 
@@ -58,14 +61,40 @@ class FPLInvalidState(FruitpileError):
 class FPLBinFileNotExists(FruitpileError):
   pass
 
+class FPLFileSetNotExists(FruitpileError):
+  pass
+
 class FPLInvalidTargetForStateChange(FruitpileError):
   pass
 
 class FPLFileExists(FruitpileError):
   pass
 
+class FPLInvalidPath(FruitpileError):
+  pass
+
 class FPLCannotWriteFile(FruitpileError):
   pass
 
 class FPLPropertyExists(FruitpileError):
   pass
+
+class FPLInvalidCursor(FruitpileError):
+  pass
+
+class FPLNoFilesetSpecified(FruitpileError):
+  pass
+
+class FPLNoFilesSpecified(FruitpileError):
+  pass
+
+class FPLUploadNotFound(FruitpileError):
+  pass
+
+class FPLUploadLengthMismatch(FruitpileError):
+  pass
+
+class FPLUploadOffsetMismatch(FruitpileError):
+  def __init__(self, msg, offset):
+    self.msg = msg
+    self.offset = offset
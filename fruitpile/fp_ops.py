@@ -15,21 +15,46 @@
 # along with Fruitpile.  If not, see <http://www.gnu.org/licenses/>.
 
 from .db.schema import *
-from sqlalchemy.orm import sessionmaker
+from .db.migrations import migrate, mark_migrated, current_version, MIGRATIONS, BATCH_SIZE
+from sqlalchemy.orm import sessionmaker, scoped_session, aliased
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy import or_, and_, inspect, tuple_
+from sqlalchemy.dialects import sqlite, postgresql
 from importlib import import_module
 from .fp_exc import *
 from .fp_perms import PermissionManager
 from .fp_constants import *
-from .fp_state import StateMachine
+from .fp_state import StateMachine, invalidate_compiled_states
+from .fp_config import (
+  default_config,
+  load_config,
+  write_config,
+  database_url,
+  repo_path,
+  is_sqlite,
+  create_store_engine)
 import os
 from datetime import datetime
 from hashlib import sha1, sha256, sha512
 from shutil import copyfileobj
 import io
-from .repo.filemanager import FileManager, FileHandler
+import fnmatch
+import base64
+import binascii
+import json
+import re
+import uuid
+import time
+import zlib
+import lzma
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED, FIRST_EXCEPTION
+from collections import namedtuple
+from .repo import REPO_TYPES
+from .repo.filemanager import FileHandler, CHUNK_SIZE
+from .repo.compression import DecompressingReader
 import socket
 import pwd
+import fcntl
 
 def _checksum_file(fob, hasher):
   m = hasher()
@@ -40,57 +65,281 @@ def _checksum_file(fob, hasher):
     m.update(chunk)
   return m.hexdigest()
 
+# The outcome of moving one file in transit_files, error is None when
+# the file was moved and otherwise the exception that stopped it
+TransitResult = namedtuple("TransitResult", ["file_id","old_state","new_state","error"])
+
+# Directory in the store where partial uploads are kept until they are
+# complete and can be added to the repo
+UPLOAD_DIR = "uploads"
+UPLOAD_ID_RE = re.compile("^[0-9a-f]{32}$")
+
+# Files and directories in the store that belong to Fruitpile itself
+# rather than the repo, so they are never reported as orphans
+STORE_FILES = set(["fpl.db", "fpl.db-wal", "fpl.db-shm", "fpl.db-journal", "fpl.cfg"])
+STORE_DIRS = [UPLOAD_DIR, os.path.join("blobs", ".tmp")]
+
+# The outcome of verify_files.  missing and corrupt are lists of binfile
+# ids, orphaned the paths (relative to the repo) of files in the repo
+# that no binfile refers to, size the number of bytes checked.
+VerifyReport = namedtuple("VerifyReport", ["checked","ok","missing","corrupt","orphaned","size","elapsed"])
+
+def _verify_blob(task):
+  # Re-hash one stored file, this runs in a worker process
+  file_id, fullpath, ztype, checksum = task
+  if not os.path.exists(fullpath):
+    return file_id, "missing", 0
+  m = sha256()
+  size = 0
+  try:
+    fob = DecompressingReader(fullpath, ztype) if ztype else io.open(fullpath, "rb")
+    try:
+      while True:
+        chunk = fob.read(CHUNK_SIZE)
+        if not chunk:
+          break
+        m.update(chunk)
+        size += len(chunk)
+    finally:
+      fob.close()
+  except (IOError, OSError, EOFError, zlib.error, lzma.LZMAError):
+    return file_id, "corrupt", size
+  return file_id, "ok" if m.hexdigest() == checksum else "corrupt", size
+
+# Upper limit on the number of ids passed in a single IN clause, this
+# keeps well clear of the SQLite bound variable limit
+IN_CLAUSE_LIMIT = 500
+
+class _Record(object):
+  # Plain read only copy of one row of a listing.  The listing methods
+  # return these when called with records=True, they are built straight
+  # from a joined column query so there is no ORM object to hydrate and
+  # no relationship to lazy load.  loaded_tags and loaded_properties are
+  # None unless with_tags/with_properties were asked for.
+  __slots__ = ()
+
+  def __init__(self, *values):
+    for field, value in zip(self.__slots__, values):
+      setattr(self, field, value)
+    for field in self.__slots__[len(values):]:
+      setattr(self, field, None)
+
+  def __repr__(self):
+    return "<%s(id=%s, name='%s')>" % (self.__class__.__name__, self.id, self.name)
+
+class FileRecord(_Record):
+  __slots__ = ("id", "fileset_id", "fileset_name", "name", "path", "primary", "state_name",
+               "create_date", "update_date", "source", "checksum", "ztype",
+               "loaded_tags", "loaded_properties")
+
+  @classmethod
+  def from_binfile(cls, bf):
+    return cls(bf.id, bf.fileset_id, bf.fileset.name, bf.name, bf.path, bf.primary,
+               bf.state.name, bf.create_date, bf.update_date, bf.source, bf.checksum, bf.ztype)
+
+class FilesetRecord(_Record):
+  __slots__ = ("id", "name", "version", "revision", "repo_name",
+               "loaded_tags", "loaded_properties")
+
+FILE_RECORD_COLUMNS = (BinFile.id, BinFile.fileset_id, FileSet.name.label("fileset_name"),
+                       BinFile.name, BinFile.path, BinFile.primary, State.name.label("state_name"),
+                       BinFile.create_date, BinFile.update_date,
+                       BinFile.source, BinFile.checksum, BinFile.ztype)
+FILESET_RECORD_COLUMNS = (FileSet.id, FileSet.name, FileSet.version, FileSet.revision,
+                          Repo.name.label("repo_name"))
+
+def build_manifest(source_dir, path, auxilliaries=()):
+  # Walk source_dir producing the list of files to pass to add_files.
+  # Each file is stored under path with the directory structure below
+  # source_dir preserved.  Files whose names match one of the
+  # auxilliaries patterns are added as auxilliary files.
+  manifest = []
+  for root, dirs, files in os.walk(source_dir):
+    dirs.sort()
+    reldir = os.path.relpath(root, source_dir)
+    for f in sorted(files):
+      manifest.append({"source_file": os.path.join(root, f),
+                       "name": f,
+                       "path": path if reldir == "." else os.path.join(path, reldir),
+                       "primary": not any([fnmatch.fnmatch(f, pat) for pat in auxilliaries])})
+  return manifest
+
+def encode_cursor(last_id):
+  # Cursors are opaque to callers, they just hand back whatever they
+  # were given to get the next page
+  return base64.urlsafe_b64encode(("id:%d" % (last_id)).encode("ascii")).decode("ascii")
+
+def decode_cursor(cursor):
+  try:
+    kind, last_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("ascii").split(":")
+    if kind != "id":
+      raise ValueError(kind)
+    return int(last_id)
+  except (ValueError, TypeError, UnicodeError, binascii.Error):
+    raise FPLInvalidCursor("invalid cursor %s" % (cursor))
+
+# INSERT ... ON CONFLICT DO NOTHING for the databases that have it
+INSERT_IGNORE = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
+
+def insert_ignore(session, table, rows):
+  # Insert rows into table skipping any that would break a unique
+  # constraint, in the current transaction.  Returns the number of rows
+  # inserted.
+  if not rows:
+    return 0
+  insert = INSERT_IGNORE.get(session.get_bind().dialect.name)
+  if insert is not None:
+    return session.execute(insert(table).on_conflict_do_nothing(), rows).rowcount
+  added = 0
+  for row in rows:
+    try:
+      with session.begin_nested():
+        session.execute(table.insert(), [row])
+      added += 1
+    except IntegrityError:
+      pass
+  return added
+
+def glob_to_like(pattern):
+  # Turn a shell style name pattern (* and ?) into a LIKE pattern using
+  # backslash as the escape character
+  like = pattern.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+  return like.replace("*", "%").replace("?", "_")
+
+# ISO 8601 dates and times (without a time zone) accepted by the search
+# commands.  datetime.fromisoformat would do but needs python 3.7.
+DATE_FORMATS = ["%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d"]
+
+def parse_date(text):
+  for fmt in DATE_FORMATS:
+    try:
+      return datetime.strptime(text.replace(" ", "T", 1), fmt)
+    except ValueError:
+      pass
+  raise ValueError("invalid date %s" % (text))
+
+def parse_properties(props):
+  # name=value matches that value, name on its own any value
+  properties = {}
+  for prop in props or []:
+    name, sep, value = prop.partition("=")
+    properties[name] = value if sep else None
+  return properties
+
+def _check_source_file(source_file):
+  if not os.path.exists(source_file):
+    raise FPLSourceFileNotFound("%s cannot be found" % (source_file))
+  if not os.access(source_file, os.R_OK):
+    raise FPLSourceFilePermissionDenied("%s cannot be read" % (source_file))
+
 class Fruitpile(object):
 
   def __init__(self, path="store"):
     self.path=path
-    self.dbpath = os.path.join(path,"fpl.db")
     self.state_map = {}
+    # Tags are never renamed or removed so their ids can be remembered
+    # for the life of the instance, see _resolve_tags
+    self._tag_ids = {}
 
-  def open(self):
-    if not os.path.exists(self.dbpath):
+  def open(self, **kwargs):
+    # With scoped=True the session is a thread local scoped_session on a
+    # pooled engine, which is what a long lived multi-threaded server
+    # wants.  The static data (repo, states, state machine) is loaded
+    # once and detached from the session so it can be shared by all the
+    # threads.  A store made by an older version must be brought up to
+    # date before it can be used, upgrade=True opens it anyway but then
+    # migrate is the only thing that can be relied on to work.
+    scoped = kwargs.get("scoped", False)
+    if not os.path.isdir(self.path):
+      raise FPLConfiguration('fruitpile instance not found')
+    self.config = load_config(self.path)
+    self.dburl = database_url(self.path, self.config)
+    if is_sqlite(self.dburl) and not os.path.exists(self.dburl.database):
       raise FPLConfiguration('fruitpile instance not found')
     self.hostname = socket.gethostname()
     self.pid = os.getpid()
     self.owner = os.getuid()
     self.owner_name = pwd.getpwuid(self.owner)[0]
-    self.engine = create_engine('sqlite:///%s' % (self.dbpath))
-    Session = sessionmaker(bind=self.engine)
-    self.session = Session()
+    self.engine = create_store_engine(self.dburl, self.config, scoped=scoped)
+    if scoped:
+      self.session = scoped_session(sessionmaker(bind=self.engine))
+    else:
+      Session = sessionmaker(bind=self.engine)
+      self.session = Session()
+    if not kwargs.get("upgrade", False) and current_version(self.session) < MIGRATIONS[-1].id:
+      self.session.close()
+      self.engine.dispose()
+      raise FPLNeedsUpgrade("the store needs upgrading, run fp_tool upgrade")
     repos = self.session.query(Repo).all()
     if len(repos) != 1:
       raise FPLConfiguration('Only one repo handler supported')
     repo = repos[0]
-    assert repo.repo_type == "FileManager"
+    if repo.repo_type not in REPO_TYPES:
+      raise FPLConfiguration('Unknown repo type %s' % (repo.repo_type))
     self.repo_data = repo
-    self.repo = FileManager(self.repo_data.path)
-    states = self.session.query(State).all()
-    for state in states:
-      self.state_map[state.name] = state.id
-    self.perm_manager = PermissionManager(self.session)
-    self.sm = StateMachine.create_state_machine(self.session)
+    self.repo = REPO_TYPES[repo.repo_type](repo_path(self.config) or self.repo_data.path)
+    self.perm_manager = PermissionManager(self.session, ttl=kwargs.get("perm_ttl", 60))
+    self.sm = StateMachine.create_state_machine(self.session, key=self._sm_key())
+    self.state_map = self.sm.state_ids()
+    if scoped:
+      self.session.remove()
 
   def init(self, **kwargs):
     if os.path.exists(self.path):
       raise FPLExists('cannot initialise the repo because the path already exists')
     if os.access(self.path, os.W_OK|os.R_OK|os.X_OK):
       raise FPLConfiguration('cannot access the target directory')
+    repo_type = kwargs.get("repo_type", "FileManager")
+    if repo_type not in REPO_TYPES:
+      raise FPLConfiguration('Unknown repo type %s' % (repo_type))
+    # db_url puts the metadata in a database other than the store's own
+    # sqlite file and repo_path keeps the files somewhere other than the
+    # store directory
+    self.config = default_config()
+    if kwargs.get("db_url"):
+      self.config.set("database", "url", kwargs.get("db_url"))
+    if kwargs.get("repo_path"):
+      self.config.set("repo", "path", kwargs.get("repo_path"))
+    self.dburl = database_url(self.path, self.config)
+    self.engine = create_store_engine(self.dburl, self.config)
+    if kwargs.get("db_url") and inspect(self.engine).has_table(Migration.__tablename__):
+      self.engine.dispose()
+      raise FPLExists('cannot initialise the repo because the database is already in use')
     os.mkdir(self.path)
-    self.engine = create_engine('sqlite:///%s' % (self.dbpath))
-    upgrade(self.engine, kwargs.get("uid"), kwargs.get("username"), self.path)
+    write_config(self.path, self.config)
+    path = repo_path(self.config) or self.path
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    invalidate_compiled_states(self._sm_key())
+    upgrade(self.engine, kwargs.get("uid"), kwargs.get("username"), path, repo_type)
     Session = sessionmaker(bind=self.engine)
     self.session = Session()
+    mark_migrated(self.session)
     # Initialise the static data in the database
     self.sm = StateMachine.create_state_machine(self.session)
 
+  def migrate(self, **kwargs):
+    # Bring an existing store's schema up to date, see db.migrations
+    applied = migrate(self.engine, progress=kwargs.get("progress"),
+                      batch_size=kwargs.get("batch_size") or BATCH_SIZE)
+    if applied:
+      invalidate_compiled_states(self._sm_key())
+    return applied
+
+  def _sm_key(self):
+    return self.dburl.render_as_string(hide_password=False)
+
   def close(self):
     self.repo.close()
-    self.session.close()
+    if isinstance(self.session, scoped_session):
+      self.session.remove()
+    else:
+      self.session.close()
     self.engine.dispose()
 
   def add_new_fileset(self, **kwargs):
     self.perm_manager.check_permission(kwargs.get("uid"), Capability.ADD_FILESET)
-    fs = FileSet(name=kwargs.get("name"), version=kwargs.get("version"), revision=kwargs.get("revision"), repo=self.repo_data)
+    fs = FileSet(name=kwargs.get("name"), version=kwargs.get("version"), revision=kwargs.get("revision"), repo_id=self.repo_data.id)
     self.session.add(fs)
     try:
       self.session.commit()
@@ -103,25 +352,144 @@ class Fruitpile(object):
     count = kwargs.get("count", -1)
     start_at = kwargs.get("start_at", 1)
     self.perm_manager.check_permission(kwargs.get("uid"), Capability.LIST_FILESETS)
-    q = self.session.query(FileSet).order_by(FileSet.id)
+    q = self._filesets_query(kwargs.get("records", False)).order_by(FileSet.id)
     if start_at != 1:
       q = q.offset(start_at)
     if count != -1:
       q = q.limit(count)
-    fss = q.all()
+    return self._load_filesets(q.all(), **kwargs)
+
+  def page_filesets(self, **kwargs):
+    # Like list_filesets but pages using the fileset id rather than an
+    # offset so that deep pages are as cheap as the first.  Returns the
+    # filesets and the cursor for the next page (None at the end).
+    self.perm_manager.check_permission(kwargs.get("uid"), Capability.LIST_FILESETS)
+    fss, next_cursor = self._keyset_page(self._filesets_query(kwargs.get("records", False)), FileSet.id,
+                                         kwargs.get("count", -1), kwargs.get("cursor"))
+    return self._load_filesets(fss, **kwargs), next_cursor
+
+  def iter_filesets(self, **kwargs):
+    # Generator version of list_filesets, see _iter_batches
+    self.perm_manager.check_permission(kwargs.get("uid"), Capability.LIST_FILESETS)
+    records = kwargs.get("records", False)
+    return self._iter_batches(lambda: self._filesets_query(records), FileSet.id,
+                              lambda fss: self._load_filesets(fss, **kwargs), **kwargs)
+
+  def _filesets_query(self, records):
+    if not records:
+      return self.session.query(FileSet)
+    return self.session.query(*FILESET_RECORD_COLUMNS).join(Repo, Repo.id == FileSet.repo_id)
+
+  def _load_filesets(self, fss, **kwargs):
+    # Turn the rows of a _filesets_query into what the listing methods
+    # return, attaching tags and properties if they were asked for
+    if kwargs.get("records", False):
+      fss = [FilesetRecord(*row) for row in fss]
+    if kwargs.get("with_tags", False):
+      self._attach_tags(fss, TagAssoc, TagAssoc.fileset_id)
+    if kwargs.get("with_properties", False):
+      self._attach_properties(fss, PropAssoc, PropAssoc.fileset_id)
     return fss
 
+  def _iter_batches(self, make_query, id_col, load, **kwargs):
+    # Yield the rows of entity batch_size at a time so memory use is bounded
+    # by the batch size and not the size of the store.  Each batch is a
+    # separate keyset query so no database cursor is held open while
+    # the caller processes the rows.  The queries are built as the
+    # batches are needed, by calling make_query, so that, with a scoped
+    # session, they run in the
+    # session that is current when the generator is consumed rather than
+    # the one it was created in.  start_at has the same meaning as
+    # for the list methods and cursor as for the page methods.
+    count = kwargs.get("count", -1)
+    if count is None:
+      count = -1
+    start_at = kwargs.get("start_at", 1)
+    offset = start_at if start_at not in (None, 1) else 0
+    cursor = kwargs.get("cursor")
+    last_id = decode_cursor(cursor) if cursor else None
+    batch_size = kwargs.get("batch_size", 500)
+    while count != 0:
+      n = batch_size if count == -1 else min(batch_size, count)
+      bq = make_query()
+      if last_id is not None:
+        bq = bq.filter(id_col > last_id)
+      bq = bq.order_by(id_col)
+      if offset:
+        bq = bq.offset(offset)
+        offset = 0
+      items = load(bq.limit(n).all())
+      for item in items:
+        yield item
+      if len(items) < n:
+        break
+      if count != -1:
+        count -= len(items)
+      last_id = items[-1].id
+
+  def _keyset_page(self, q, id_col, count, cursor):
+    if cursor:
+      q = q.filter(id_col > decode_cursor(cursor))
+    q = q.order_by(id_col)
+    if count is None or count == -1:
+      return q.all(), None
+    # fetch one extra row to find out whether there is another page
+    items = q.limit(count + 1).all()
+    if len(items) > count:
+      items = items[:count]
+      return items, encode_cursor(items[-1].id)
+    return items, None
+
+  def _attach_tags(self, objs, assoc, key):
+    # Load the tags for all of objs with one query per IN_CLAUSE_LIMIT
+    # objects rather than one per object and attach them as loaded_tags
+    by_id = {}
+    for obj in objs:
+      obj.loaded_tags = []
+      by_id[obj.id] = obj
+    ids = list(by_id.keys())
+    for i in range(0, len(ids), IN_CLAUSE_LIMIT):
+      q = self.session.query(key, Tag.tag).join(Tag, Tag.id == assoc.tag_id)
+      for obj_id, tag in q.filter(key.in_(ids[i:i + IN_CLAUSE_LIMIT])):
+        by_id[obj_id].loaded_tags.append(tag)
+
+  def _attach_properties(self, objs, assoc, key):
+    # As _attach_tags but for properties, attached as loaded_properties
+    by_id = {}
+    for obj in objs:
+      obj.loaded_properties = {}
+      by_id[obj.id] = obj
+    ids = list(by_id.keys())
+    for i in range(0, len(ids), IN_CLAUSE_LIMIT):
+      q = self.session.query(key, Property.name, Property.value).join(Property, Property.id == assoc.prop_id)
+      for obj_id, name, value in q.filter(key.in_(ids[i:i + IN_CLAUSE_LIMIT])):
+        by_id[obj_id].loaded_properties[name] = value
+
+
   def add_file(self, **kwargs):
     self.perm_manager.check_permission(kwargs.get("uid"), Capability.ADD_FILE)
     source_file = kwargs.get("source_file")
-    if not os.path.exists(source_file):
-      raise FPLSourceFileNotFound("%s cannot be found" % (source_file))
-    if not os.access(source_file, os.R_OK):
-      raise FPLSourceFilePermissionDenied("%s cannot be read" % (source_file))
-    srcfob = io.open(source_file, "rb")
-    checksum = _checksum_file(srcfob, sha256)
+    srcfob = kwargs.get("source_fob")
+    # any readable stream can be passed as source_fob, otherwise the
+    # source_file is opened (and closed) here
+    close_source = srcfob is None
+    if close_source:
+      _check_source_file(source_file)
+      srcfob = io.open(source_file, "rb")
     name = kwargs.get("name")
     path = kwargs.get("path")
+    self._check_repo_path(path, name)
+    if self._find_existing(kwargs.get("fileset_id"), [(name, path)]) is not None:
+      raise FPLBinFileExists("binfile %s/%s in fileset (id=%d) already exists in store" % (name, path, kwargs.get("fileset_id")))
+    # we copy the file before commiting so that if the file copy fails
+    # for some reason we should rollback the transaction and the database
+    # is consistent with the file store.  The checksum is computed as the
+    # data is copied so the source is only read once.
+    try:
+      stats = self.repo.ingest(os.path.join(path,name), srcfob, sha256)
+    finally:
+      if close_source:
+        srcfob.close()
     jot = datetime.now()
     bf = BinFile(fileset_id=kwargs.get("fileset_id"),
                  name=name,
@@ -131,23 +499,127 @@ class Fruitpile(object):
                  create_date=jot,
                  update_date=jot,
                  source=kwargs.get("source"),
-                 checksum=checksum)
+                 checksum=stats.checksum,
+                 ztype=stats.ztype,
+                 size=stats.size)
     self.session.add(bf)
-    snkfob = self.repo.open(os.path.join(path,name),"w")
-    # we copy the file before commiting so that if the file copy fails
-    # for some reason we should rollback the transaction and the database
-    # is consistent with the file store
-    srcfob.seek(0, 0)
-    copyfileobj(srcfob, snkfob)
-    srcfob.close()
-    snkfob.close()
     try:
       self.session.commit()
     except IntegrityError:
       self.session.rollback()
       raise FPLBinFileExists("binfile %s/%s in fileset (id=%d) already exists in store" % (name, path, kwargs.get("fileset_id")))
+    bf.ingest_stats = stats
     return bf
 
+  def _check_repo_path(self, path, name):
+    # name and path can come from remote clients so make sure the file
+    # can only ever be written inside the repo
+    if not name or name in (".", "..") or "/" in name or os.sep in name:
+      raise FPLInvalidPath("invalid file name %s" % (name))
+    if path is None or os.path.isabs(path) or ".." in path.replace(os.sep, "/").split("/"):
+      raise FPLInvalidPath("invalid path %s" % (path))
+    root = os.path.realpath(self.repo.repopath)
+    dest = os.path.realpath(os.path.join(root, path, name))
+    if not dest.startswith(root + os.sep):
+      raise FPLInvalidPath("%s/%s is outside of the repo" % (path, name))
+    # the repo can be the store directory itself, whose database, config
+    # and staging areas must never be written to
+    rel = os.path.relpath(dest, os.path.realpath(self.path))
+    if rel in STORE_FILES or any([rel == d or rel.startswith(d + os.sep) for d in STORE_DIRS]):
+      raise FPLInvalidPath("%s/%s belongs to the store" % (path, name))
+
+  def _find_existing(self, fileset_id, files):
+    # Return the (name, path) of a binfile that clashes with one of
+    # files, a list of (name, path) pairs to add to the fileset, or None.
+    # This has to be checked before anything is copied into the repo or
+    # the copy would overwrite the contents of the existing file.
+    for i in range(0, len(files), IN_CLAUSE_LIMIT):
+      chunk = files[i:i + IN_CLAUSE_LIMIT]
+      q = self.session.query(BinFile.name, BinFile.path).filter(
+        or_(and_(BinFile.fileset_id == fileset_id, BinFile.name.in_([name for name, path in chunk])),
+            tuple_(BinFile.name, BinFile.path).in_(chunk)))
+      existing = q.first()
+      if existing is not None:
+        return tuple(existing)
+    return None
+
+  def add_files(self, **kwargs):
+    # Add many files to a fileset in one go.  files is a list of dicts
+    # with source_file, name, path and primary keys (see build_manifest).
+    # The files are hashed and copied into the repo by a pool of worker
+    # threads and all the binfiles are recorded in a single transaction.
+    self.perm_manager.check_permission(kwargs.get("uid"), Capability.ADD_FILE)
+    fileset_id = kwargs.get("fileset_id")
+    files = kwargs.get("files")
+    workers = kwargs.get("workers", 4)
+    for f in files:
+      _check_source_file(f["source_file"])
+      self._check_repo_path(f["path"], f["name"])
+    # clashes within the batch or with files already in the store are
+    # found before any of the files are copied into the repo
+    pairs = [(f["name"], f["path"]) for f in files]
+    if len(set([name for name, path in pairs])) != len(pairs):
+      raise FPLBinFileExists("the same name appears more than once in the files for fileset (id=%d)" % (fileset_id))
+    existing = self._find_existing(fileset_id, pairs)
+    if existing is not None:
+      raise FPLBinFileExists("binfile %s/%s already exists in fileset (id=%d)" % (existing[1], existing[0], fileset_id))
+    def ingest(f):
+      with io.open(f["source_file"], "rb") as srcfob:
+        return self.repo.ingest(os.path.join(f["path"], f["name"]), srcfob, sha256)
+    # if any copy fails the ones that haven't started are abandoned and
+    # those already in the repo are removed again
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+      futures = [pool.submit(ingest, f) for f in files]
+      wait(futures, return_when=FIRST_EXCEPTION)
+      for fut in futures:
+        fut.cancel()
+    done = [fut for fut in futures if not fut.cancelled() and fut.exception() is None]
+    failed = [fut for fut in futures if not fut.cancelled() and fut.exception() is not None]
+    jot = datetime.now()
+    bfs = []
+    all_stats = []
+    for f, fut in zip(files, futures):
+      if fut not in done:
+        continue
+      stats = fut.result()
+      all_stats.append(stats)
+      bfs.append(BinFile(fileset_id=fileset_id,
+                         name=f["name"],
+                         path=f["path"],
+                         primary=f.get("primary", True),
+                         state_id=self.state_map["untested"],
+                         create_date=jot,
+                         update_date=jot,
+                         source=kwargs.get("source"),
+                         checksum=stats.checksum,
+                         ztype=stats.ztype,
+                         size=stats.size))
+    if failed:
+      self._discard(bfs)
+      raise failed[0].exception()
+    self.session.add_all(bfs)
+    try:
+      self.session.commit()
+    except IntegrityError:
+      self.session.rollback()
+      self._discard(bfs)
+      raise FPLBinFileExists("one or more binfiles already exist in fileset (id=%d)" % (fileset_id))
+    for bf, stats in zip(bfs, all_stats):
+      bf.ingest_stats = stats
+    return bfs
+
+  def _discard(self, bfs):
+    # Remove the contents written for binfiles that were never recorded,
+    # unless a recorded binfile shares them (identical blobs)
+    checksums = list(set([bf.checksum for bf in bfs]))
+    in_use = set()
+    for i in range(0, len(checksums), IN_CLAUSE_LIMIT):
+      for other in self.session.query(BinFile).filter(BinFile.checksum.in_(checksums[i:i + IN_CLAUSE_LIMIT])):
+        in_use.add(self.repo.locate(other))
+    for bf in bfs:
+      if self.repo.locate(bf) not in in_use:
+        self.repo.discard(bf)
+
   def transit_file(self, **kwargs):
     uid = kwargs.get("uid")
     file_id = kwargs.get("file_id")
@@ -161,23 +633,364 @@ class Fruitpile(object):
     if not bf.primary:
       raise FPLInvalidTargetForStateChange("binfile with id=%d is an auxilliary file" % (file_id))
     new_state = self.sm.transit(uid, self.perm_manager, bf.state.name, req_state, {"bf":bf,"obj":self})
-    bf.state_id = self.sm.state_id
+    bf.state_id = self.state_map[new_state]
     bf.update_date = datetime.now()
     self.session.commit()
     return bf
 
+  def transit_files(self, **kwargs):
+    # Move either the files in file_ids or all the primary files of
+    # fileset_id to req_state in a single transaction.  The permission
+    # for each kind of transition is checked once and the transition
+    # functions share aux_cache so each fileset is only looked at once.
+    # A file that can't be moved doesn't stop the others, the result is
+    # a TransitResult for every file.
+    uid = kwargs.get("uid")
+    req_state = kwargs.get("req_state")
+    file_ids = kwargs.get("file_ids")
+    fileset_id = kwargs.get("fileset_id")
+    if not self.sm.is_valid_state(req_state):
+      raise FPLInvalidState("state %s is not a valid state" % (req_state))
+    if fileset_id is not None:
+      bfs = self.session.query(BinFile).filter(BinFile.fileset_id == fileset_id).filter(
+        BinFile.primary == True).order_by(BinFile.id).all()
+      file_ids = [bf.id for bf in bfs]
+    elif file_ids is not None:
+      bfs = []
+      for i in range(0, len(file_ids), IN_CLAUSE_LIMIT):
+        bfs.extend(self.session.query(BinFile).filter(
+          BinFile.id.in_(file_ids[i:i+IN_CLAUSE_LIMIT])).all())
+    else:
+      raise FPLNoFilesSpecified("no files or fileset given to transit")
+    by_id = dict((bf.id, bf) for bf in bfs)
+    state_names = dict((sid, name) for name, sid in self.state_map.items())
+    transitions = {}
+    aux_cache = {}
+    now = datetime.now()
+    results = []
+    for file_id in file_ids:
+      bf = by_id.get(file_id)
+      if bf is None:
+        results.append(TransitResult(file_id, None, None,
+          FPLBinFileNotExists("binfile with id=%d cannot be found" % (file_id))))
+        continue
+      old_state = state_names[bf.state_id]
+      try:
+        if not bf.primary:
+          raise FPLInvalidTargetForStateChange("binfile with id=%d is an auxilliary file" % (file_id))
+        if old_state not in transitions:
+          try:
+            trans_control = self.sm.transition(old_state, req_state)
+            self.perm_manager.check_permission(uid, trans_control.capability)
+            transitions[old_state] = trans_control
+          except FruitpileError as exc:
+            transitions[old_state] = exc
+        trans_control = transitions[old_state]
+        if isinstance(trans_control, FruitpileError):
+          raise trans_control
+        self.sm.apply(uid, self.perm_manager, trans_control, old_state, req_state,
+                      {"bf":bf, "obj":self, "aux_cache":aux_cache})
+      except FruitpileError as exc:
+        results.append(TransitResult(file_id, old_state, None, exc))
+        continue
+      bf.state_id = self.state_map[req_state]
+      bf.update_date = now
+      results.append(TransitResult(file_id, old_state, req_state, None))
+    self.session.commit()
+    return results
+
   def list_files(self, **kwargs):
     count = kwargs.get("count", -1)
     start_at = kwargs.get("start_at", 1)
     self.perm_manager.check_permission(kwargs.get("uid"), Capability.LIST_FILES)
-    q = self.session.query(BinFile).order_by(BinFile.id)
+    q = self._files_query(kwargs.get("records", False)).order_by(BinFile.id)
     if start_at != 1:
       q = q.offset(start_at)
     if count != -1:
       q = q.limit(count)
-    bfs = q.all()
+    return self._load_files(q.all(), **kwargs)
+
+  def page_files(self, **kwargs):
+    # Keyset paged version of list_files, see page_filesets
+    self.perm_manager.check_permission(kwargs.get("uid"), Capability.LIST_FILES)
+    bfs, next_cursor = self._keyset_page(self._files_query(kwargs.get("records", False)), BinFile.id,
+                                         kwargs.get("count", -1), kwargs.get("cursor"))
+    return self._load_files(bfs, **kwargs), next_cursor
+
+  def iter_files(self, **kwargs):
+    # Generator version of list_files, see _iter_batches
+    self.perm_manager.check_permission(kwargs.get("uid"), Capability.LIST_FILES)
+    records = kwargs.get("records", False)
+    return self._iter_batches(lambda: self._files_query(records), BinFile.id,
+                              lambda bfs: self._load_files(bfs, **kwargs), **kwargs)
+
+  def _files_query(self, records):
+    # With records the state and fileset names come from the same query
+    # rather than a lazy load per file
+    if not records:
+      return self.session.query(BinFile)
+    return (self.session.query(*FILE_RECORD_COLUMNS)
+            .join(FileSet, FileSet.id == BinFile.fileset_id)
+            .join(State, State.id == BinFile.state_id))
+
+  def _load_files(self, bfs, **kwargs):
+    # As _load_filesets for files
+    if kwargs.get("records", False):
+      bfs = [FileRecord(*row) for row in bfs]
+    if kwargs.get("with_tags", False):
+      self._attach_tags(bfs, BinFileTag, BinFileTag.binfile_id)
+    if kwargs.get("with_properties", False):
+      self._attach_properties(bfs, BinFileProp, BinFileProp.binfile_id)
     return bfs
 
+  def search_files(self, **kwargs):
+    # Find the files matching all of the given conditions with a single
+    # query:
+    #   name_pattern - shell style pattern for the file name
+    #   tags - list of tags the file must have
+    #   properties - dict of properties the file must have, a value of
+    #                None matches any value
+    #   state, fileset_id, source - exact matches
+    #   since, until - range of create_date (since inclusive)
+    # Paged as page_files, returns the files and the next cursor.
+    self.perm_manager.check_permission(kwargs.get("uid"), Capability.LIST_FILES)
+    q = self._search_query(self._files_query(kwargs.get("records", False)), BinFile, BinFileTag, BinFileProp, "binfile_id", **kwargs)
+    state = kwargs.get("state")
+    if state is not None:
+      if state not in self.state_map:
+        raise FPLUnknownState("unknown state %s" % (state))
+      q = q.filter(BinFile.state_id == self.state_map[state])
+    if kwargs.get("fileset_id") is not None:
+      q = q.filter(BinFile.fileset_id == kwargs.get("fileset_id"))
+    if kwargs.get("source") is not None:
+      q = q.filter(BinFile.source == kwargs.get("source"))
+    if kwargs.get("since") is not None:
+      q = q.filter(BinFile.create_date >= kwargs.get("since"))
+    if kwargs.get("until") is not None:
+      q = q.filter(BinFile.create_date < kwargs.get("until"))
+    bfs, next_cursor = self._keyset_page(q, BinFile.id, kwargs.get("count", -1), kwargs.get("cursor"))
+    return self._load_files(bfs, **kwargs), next_cursor
+
+  def search_filesets(self, **kwargs):
+    # As search_files for filesets, which can be matched on name_pattern,
+    # tags, properties, version and revision
+    self.perm_manager.check_permission(kwargs.get("uid"), Capability.LIST_FILESETS)
+    q = self._search_query(self._filesets_query(kwargs.get("records", False)), FileSet, TagAssoc, PropAssoc, "fileset_id", **kwargs)
+    if kwargs.get("version") is not None:
+      q = q.filter(FileSet.version == kwargs.get("version"))
+    if kwargs.get("revision") is not None:
+      q = q.filter(FileSet.revision == kwargs.get("revision"))
+    fss, next_cursor = self._keyset_page(q, FileSet.id, kwargs.get("count", -1), kwargs.get("cursor"))
+    return self._load_filesets(fss, **kwargs), next_cursor
+
+  def _search_query(self, q, entity, tag_assoc, prop_assoc, key, **kwargs):
+    # Each tag and property is an inner join through the association
+    # table.  An object has a tag at most once and a property name at
+    # most once so the joins never produce duplicate rows.
+    for tag in kwargs.get("tags") or []:
+      ta = aliased(tag_assoc)
+      t = aliased(Tag)
+      q = q.join(ta, getattr(ta, key) == entity.id).join(t, and_(t.id == ta.tag_id, t.tag == tag))
+    for name, value in (kwargs.get("properties") or {}).items():
+      pa = aliased(prop_assoc)
+      p = aliased(Property)
+      cond = and_(p.id == pa.prop_id, p.name == name)
+      if value is not None:
+        cond = and_(cond, p.value == value)
+      q = q.join(pa, getattr(pa, key) == entity.id).join(p, cond)
+    if kwargs.get("name_pattern"):
+      q = q.filter(entity.name.like(glob_to_like(kwargs.get("name_pattern")), escape="\\"))
+    return q
+
+  def _upload_paths(self, upload_id):
+    # upload ids come from clients so make sure they can't be used to
+    # reach outside of the uploads directory
+    if upload_id is None or not UPLOAD_ID_RE.match(upload_id):
+      raise FPLUploadNotFound("upload %s not found" % (upload_id))
+    updir = os.path.join(self.repo.repopath, UPLOAD_DIR)
+    return os.path.join(updir, upload_id + ".json"), os.path.join(updir, upload_id)
+
+  def start_upload(self, **kwargs):
+    # Begin an upload that can be sent in several parts, resuming after
+    # a failure, with append_upload and added to the fileset with
+    # finish_upload.  Returns the upload id.
+    self.perm_manager.check_permission(kwargs.get("uid"), Capability.ADD_FILE)
+    self._check_repo_path(kwargs.get("path"), kwargs.get("name"))
+    details = dict((k, kwargs.get(k)) for k in ["fileset_id", "name", "path", "primary", "source"])
+    upload_id = uuid.uuid4().hex
+    meta, data = self._upload_paths(upload_id)
+    if not os.path.isdir(os.path.dirname(data)):
+      os.makedirs(os.path.dirname(data), 0o700, exist_ok=True)
+    io.open(data, "wb").close()
+    with io.open(meta, "w") as fob:
+      fob.write(json.dumps(details))
+    return upload_id
+
+  def upload_offset(self, **kwargs):
+    # The number of bytes received so far, which is where the next part
+    # of the upload must start
+    self.perm_manager.check_permission(kwargs.get("uid"), Capability.ADD_FILE)
+    meta, data = self._check_upload(kwargs.get("upload_id"))
+    return os.path.getsize(data)
+
+  def _check_upload(self, upload_id):
+    meta, data = self._upload_paths(upload_id)
+    if not os.path.exists(meta):
+      raise FPLUploadNotFound("upload %s not found" % (upload_id))
+    return meta, data
+
+  def append_upload(self, **kwargs):
+    # Add the contents of source_fob to the upload.  offset must be where
+    # the previous part finished, returns the new offset.  With length
+    # the part must be exactly that many bytes long, otherwise it is
+    # thrown away and FPLUploadLengthMismatch raised.
+    self.perm_manager.check_permission(kwargs.get("uid"), Capability.ADD_FILE)
+    upload_id = kwargs.get("upload_id")
+    srcfob = kwargs.get("source_fob")
+    length = kwargs.get("length")
+    meta, data = self._check_upload(upload_id)
+    with io.open(data, "ab") as fob:
+      # a client retrying a part while the first attempt is still being
+      # received must wait for it and then find the offset has moved on
+      fcntl.flock(fob.fileno(), fcntl.LOCK_EX)
+      current = os.fstat(fob.fileno()).st_size
+      offset = kwargs.get("offset", current)
+      if offset != current:
+        raise FPLUploadOffsetMismatch("upload %s is at offset %d not %d" % (upload_id, current, offset), current)
+      remaining = length
+      while remaining is None or remaining > 0:
+        chunk = srcfob.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+        if not chunk:
+          break
+        fob.write(chunk)
+        if remaining is not None:
+          remaining -= len(chunk)
+      if length is not None and (remaining > 0 or srcfob.read(1)):
+        fob.flush()
+        fob.truncate(current)
+        raise FPLUploadLengthMismatch("part of upload %s is not %d bytes long" % (upload_id, length))
+      fob.flush()
+      return os.fstat(fob.fileno()).st_size
+
+  def finish_upload(self, **kwargs):
+    # Add the uploaded data to the repo as described by start_upload
+    uid = kwargs.get("uid")
+    upload_id = kwargs.get("upload_id")
+    self.perm_manager.check_permission(uid, Capability.ADD_FILE)
+    meta, data = self._check_upload(upload_id)
+    with io.open(meta, "r") as fob:
+      details = json.loads(fob.read())
+    with io.open(data, "rb") as fob:
+      bf = self.add_file(uid=uid, source_fob=fob, **details)
+    self.cancel_upload(uid=uid, upload_id=upload_id)
+    return bf
+
+  def cancel_upload(self, **kwargs):
+    self.perm_manager.check_permission(kwargs.get("uid"), Capability.ADD_FILE)
+    meta, data = self._check_upload(kwargs.get("upload_id"))
+    for f in [data, meta]:
+      if os.path.exists(f):
+        os.remove(f)
+
+  def verify_files(self, **kwargs):
+    # Re-hash stored files and compare them with their checksums using a
+    # pool of worker processes.  All files are checked unless file_ids
+    # or fileset_id is given.  With older_than only files not verified
+    # since then are checked; the results are committed every batch_size
+    # files so an interrupted run resumes where it stopped when run again
+    # with the same older_than.  A check of the whole store also looks
+    # for orphaned files in the repo.  Returns a VerifyReport.
+    self.perm_manager.check_permission(kwargs.get("uid"), Capability.GET_FILES)
+    file_ids = kwargs.get("file_ids")
+    fileset_id = kwargs.get("fileset_id")
+    older_than = kwargs.get("older_than")
+    workers = kwargs.get("workers") or os.cpu_count() or 1
+    batch_size = kwargs.get("batch_size", 500)
+    start = time.time()
+    q = self.session.query(BinFile.id, BinFile.path, BinFile.name, BinFile.checksum, BinFile.ztype)
+    if file_ids is not None:
+      q = q.filter(BinFile.id.in_(file_ids))
+    if fileset_id is not None:
+      q = q.filter(BinFile.fileset_id == fileset_id)
+    if older_than is not None:
+      q = q.outerjoin(Verification, Verification.binfile_id == BinFile.id).filter(
+        or_(Verification.verified == None, Verification.verified < older_than))
+    def tasks():
+      last_id = 0
+      while True:
+        rows = q.filter(BinFile.id > last_id).order_by(BinFile.id).limit(batch_size).all()
+        for row in rows:
+          yield (row.id, os.path.join(self.repo.repopath, self.repo.locate(row)), row.ztype, row.checksum)
+        if len(rows) < batch_size:
+          break
+        last_id = rows[-1].id
+    found = {"ok":[], "missing":[], "corrupt":[]}
+    size = 0
+    pending = []
+    for file_id, status, nbytes in self._run_verify(tasks(), workers):
+      found[status].append(file_id)
+      size += nbytes
+      pending.append((file_id, status))
+      if len(pending) >= batch_size:
+        self._record_verifications(pending)
+        pending = []
+    self._record_verifications(pending)
+    orphaned = []
+    if file_ids is None and fileset_id is None:
+      orphaned = self._find_orphans()
+    return VerifyReport(checked=sum([len(v) for v in found.values()]),
+                        ok=len(found["ok"]),
+                        missing=found["missing"],
+                        corrupt=found["corrupt"],
+                        orphaned=orphaned,
+                        size=size,
+                        elapsed=time.time() - start)
+
+  def _run_verify(self, tasks, workers):
+    # Keep a bounded number of files in flight so a huge store doesn't
+    # queue every file up front, and a slow file doesn't hold the others
+    if workers == 1:
+      for task in tasks:
+        yield _verify_blob(task)
+      return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+      in_flight = set()
+      for task in tasks:
+        in_flight.add(pool.submit(_verify_blob, task))
+        if len(in_flight) >= workers * 4:
+          done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+          for fut in done:
+            yield fut.result()
+      for fut in in_flight:
+        yield fut.result()
+
+  def _record_verifications(self, results):
+    if not results:
+      return
+    now = datetime.now()
+    ids = [file_id for file_id, status in results]
+    self.session.query(Verification).filter(Verification.binfile_id.in_(ids)).delete(synchronize_session=False)
+    self.session.add_all([Verification(binfile_id=file_id, verified=now, status=status)
+                          for file_id, status in results])
+    self.session.commit()
+
+  def _find_orphans(self):
+    # Files in the repo that no binfile refers to
+    known = set()
+    for row in self.session.query(BinFile.path, BinFile.name, BinFile.checksum, BinFile.ztype):
+      known.add(os.path.normpath(self.repo.locate(row)))
+    orphaned = []
+    for root, dirs, files in os.walk(self.repo.repopath):
+      reldir = os.path.relpath(root, self.repo.repopath)
+      dirs[:] = sorted([d for d in dirs if os.path.normpath(os.path.join(reldir, d)) not in STORE_DIRS])
+      for f in sorted(files):
+        relpath = os.path.normpath(os.path.join(reldir, f))
+        if reldir == "." and f in STORE_FILES:
+          continue
+        if relpath not in known:
+          orphaned.append(relpath)
+    return orphaned
+
   def get_file(self, **kwargs):
     uid = kwargs.get("uid")
     file_id = kwargs.get("file_id")
@@ -191,58 +1004,160 @@ class Fruitpile(object):
       raise FPLFileExists("Destination for get file exists, dest=%s" % (to_file))
     if not os.access(os.path.dirname(to_file), os.W_OK):
       raise FPLCannotWriteFile("Destination file directory not writeable %s" % (to_file))
-    srcfob = self.repo.open(os.path.join(bf.path,bf.name),"r")
-    snkfob = io.open(to_file, "wb")
-    copyfileobj(srcfob, snkfob)
-    srcfob.close()
-    snkfob.close()
-    return True
+    # The repo picks the cheapest way to copy the file and reports the
+    # one it used
+    return self.repo.export(self.repo.locate(bf), to_file, bf.ztype)
+
+  def open_file(self, **kwargs):
+    # Open the contents of a file in the store for reading, returns the
+    # binfile and a file handler the caller must close
+    uid = kwargs.get("uid")
+    file_id = kwargs.get("file_id")
+    self.perm_manager.check_permission(uid, Capability.GET_FILES)
+    bf = self.session.query(BinFile).filter(BinFile.id == file_id).first()
+    if bf is None:
+      raise FPLBinFileNotExists("binfile with id=%d cannot be found" % (file_id))
+    return bf, self.repo.open_content(self.repo.locate(bf), bf.ztype)
 
   def tag_fileset(self, **kwargs):
+    self.perm_manager.check_permission(kwargs.get("uid"), Capability.TAG_FILESET)
+    return self._tag(TagAssoc, "fileset_id", [kwargs.get("fileset").id], [kwargs.get("tag")]) > 0
+
+  def tag_many(self, **kwargs):
+    # Add every tag in tags to every fileset in fileset_ids, or every
+    # file in binfile_ids, with a single insert.  Returns the number of
+    # tags added, ones the objects already have are skipped.
     uid = kwargs.get("uid")
-    fs = kwargs.get("fileset")
-    tag = kwargs.get("tag")
-    self.perm_manager.check_permission(uid, Capability.TAG_FILESET)
-    tags = self.session.query(Tag).filter(Tag.tag == tag).all()
-    if tags == []:
-      tag = Tag(tag=tag)
-      self.session.add(tag)
+    if kwargs.get("fileset_ids") is not None:
+      self.perm_manager.check_permission(uid, Capability.TAG_FILESET)
+      ids = self._existing_ids(FileSet, kwargs.get("fileset_ids"), FPLFileSetNotExists, "fileset id")
+      return self._tag(TagAssoc, "fileset_id", ids, kwargs.get("tags") or [])
+    if kwargs.get("binfile_ids") is not None:
+      self.perm_manager.check_permission(uid, Capability.TAG_BINFILE)
+      ids = self._existing_ids(BinFile, kwargs.get("binfile_ids"), FPLBinFileNotExists, "file id")
+      return self._tag(BinFileTag, "binfile_id", ids, kwargs.get("tags") or [])
+    raise FPLNoFilesSpecified("no filesets or files to tag")
+
+  def _resolve_tags(self, tags):
+    # Map tag strings to ids, from the cache where possible and adding
+    # any tags that don't exist yet.  New ids only go in the cache once
+    # the caller has committed.
+    ids = dict((tag, self._tag_ids[tag]) for tag in tags if tag in self._tag_ids)
+    missing = [tag for tag in set(tags) if tag not in ids]
+    def lookup(wanted):
+      for i in range(0, len(wanted), IN_CLAUSE_LIMIT):
+        for tag_id, tag in self.session.query(Tag.id, Tag.tag).filter(Tag.tag.in_(wanted[i:i + IN_CLAUSE_LIMIT])):
+          ids[tag] = tag_id
+    if missing:
+      lookup(missing)
+      missing = [tag for tag in missing if tag not in ids]
+    if missing:
+      insert_ignore(self.session, Tag.__table__, [{"tag": tag} for tag in missing])
+      lookup(missing)
+    return ids
+
+  def _tag(self, assoc, key, obj_ids, tags):
+    if not obj_ids or not tags:
+      return 0
+    try:
+      tag_ids = self._resolve_tags(tags)
+      rows = [{"tag_id": tag_id, key: obj_id} for tag_id in tag_ids.values() for obj_id in obj_ids]
+      added = insert_ignore(self.session, assoc.__table__, rows)
       self.session.commit()
-    else:
-      tag = tags[0]
-      existing_tags = fs.tags(self.session)
-      if tag.tag in existing_tags:
-        return False
-    tag_assoc = TagAssoc(tag_id=tag.id, fileset_id=fs.id)
-    self.session.add(tag_assoc)
-    self.session.commit()
-    return True
+    except IntegrityError:
+      self.session.rollback()
+      raise
+    self._tag_ids.update(tag_ids)
+    return added
 
   def add_fileset_property(self, **kwargs):
-    uid = kwargs.get("uid")
-    fileset = kwargs.get("fileset")
-    name = kwargs.get("name")
-    value = kwargs.get("value")
-    update = kwargs.get("update", False)
-    self.perm_manager.check_permission(uid, Capability.ADD_FILESET_PROPERTY)
-    pas = self.session.query(PropAssoc).filter(PropAssoc.fileset_id == fileset.id).all()
-    for pa in pas:
-      prop = self.session.query(Property).filter(Property.id == pa.prop_id).one()
-      if prop.name == name:
-        if not update:
-          raise FPLPropertyExists(name)
-        self.perm_manager.check_permission(uid, Capability.UPDATE_FILESET_PROPERTY)
-        prop.value = value
-        self.session.commit()
-        return True
-    prop = Property(name=name, value=value)
-    self.session.add(prop)
-    self.session.commit()
-    pa = PropAssoc(prop_id=prop.id, fileset_id=fileset.id)
-    self.session.add(pa)
-    self.session.commit()
+    self.perm_manager.check_permission(kwargs.get("uid"), Capability.ADD_FILESET_PROPERTY)
+    self._set_properties(PropAssoc, PropAssoc.fileset_id, [kwargs.get("fileset").id],
+                         {kwargs.get("name"): kwargs.get("value")},
+                         kwargs.get("uid"), Capability.UPDATE_FILESET_PROPERTY, kwargs.get("update", False))
     return True
 
+  def set_fileset_properties(self, **kwargs):
+    # Bulk version of add_fileset_property, setting every property in the
+    # properties dict on every fileset in fileset_ids in one transaction.
+    # Nothing is changed if any of them fails.  Returns the number of
+    # properties added or changed.
+    self.perm_manager.check_permission(kwargs.get("uid"), Capability.ADD_FILESET_PROPERTY)
+    fileset_ids = self._existing_ids(FileSet, kwargs.get("fileset_ids"), FPLFileSetNotExists, "fileset id")
+    return self._set_properties(PropAssoc, PropAssoc.fileset_id, fileset_ids, kwargs.get("properties") or {},
+                                kwargs.get("uid"), Capability.UPDATE_FILESET_PROPERTY, kwargs.get("update", False))
+
+  def _existing_ids(self, entity, ids, exc, label):
+    ids = sorted(set(ids or []))
+    found = set()
+    for i in range(0, len(ids), IN_CLAUSE_LIMIT):
+      q = self.session.query(entity.id).filter(entity.id.in_(ids[i:i + IN_CLAUSE_LIMIT]))
+      found.update(row[0] for row in q)
+    missing = [obj_id for obj_id in ids if obj_id not in found]
+    if missing:
+      raise exc("%s %s not found" % (label, ",".join(str(obj_id) for obj_id in missing)))
+    return ids
+
+  def _intern_properties(self, pairs):
+    # Properties are shared (name, value) pairs, so a value used on many
+    # filesets or files is stored once.  Returns a dict of pair to id,
+    # adding the pairs that aren't there yet.
+    pairs = list(set(pairs))
+    ids = {}
+    def lookup(wanted):
+      for i in range(0, len(wanted), IN_CLAUSE_LIMIT):
+        q = self.session.query(Property.id, Property.name, Property.value).filter(
+          tuple_(Property.name, Property.value).in_(wanted[i:i + IN_CLAUSE_LIMIT]))
+        for prop_id, name, value in q:
+          ids[(name, value)] = prop_id
+    lookup(pairs)
+    missing = [pair for pair in pairs if pair not in ids]
+    if missing:
+      insert_ignore(self.session, Property.__table__, [{"name": name, "value": value} for name, value in missing])
+      lookup(missing)
+    return ids
+
+  def _set_properties(self, assoc, key, obj_ids, properties, uid, update_cap, update):
+    # Point each object's properties at the interned values with one
+    # lookup of the current values and one commit.  Existing values are
+    # only replaced if update is set.
+    if not obj_ids or not properties:
+      return 0
+    names = list(properties.keys())
+    current = {}
+    for i in range(0, len(obj_ids), IN_CLAUSE_LIMIT):
+      q = self.session.query(key, assoc.prop_id, Property.name).join(Property, Property.id == assoc.prop_id).filter(
+        key.in_(obj_ids[i:i + IN_CLAUSE_LIMIT]), Property.name.in_(names))
+      for obj_id, prop_id, name in q:
+        current[(obj_id, name)] = prop_id
+    if current:
+      if not update:
+        raise FPLPropertyExists(sorted(set(name for obj_id, name in current))[0])
+      self.perm_manager.check_permission(uid, update_cap)
+    try:
+      prop_ids = self._intern_properties(properties.items())
+      new_rows = []
+      moves = {}
+      for name, value in properties.items():
+        prop_id = prop_ids[(name, value)]
+        for obj_id in obj_ids:
+          old_id = current.get((obj_id, name))
+          if old_id is None:
+            new_rows.append({"prop_id": prop_id, key.key: obj_id})
+          elif old_id != prop_id:
+            moves.setdefault((old_id, prop_id), []).append(obj_id)
+      if new_rows:
+        self.session.execute(assoc.__table__.insert(), new_rows)
+      for (old_id, prop_id), ids in moves.items():
+        for i in range(0, len(ids), IN_CLAUSE_LIMIT):
+          self.session.query(assoc).filter(key.in_(ids[i:i + IN_CLAUSE_LIMIT]), assoc.prop_id == old_id).update(
+            {assoc.prop_id: prop_id}, synchronize_session=False)
+      self.session.commit()
+    except IntegrityError:
+      self.session.rollback()
+      raise
+    return len(new_rows) + sum(len(ids) for ids in moves.values())
+
   def get_fileset(self, **kwargs):
     uid = kwargs.get("uid")
     fileset_id = kwargs.get("fileset_id", None)
@@ -259,50 +1174,23 @@ class Fruitpile(object):
     return fss
 
   def tag_binfile(self, **kwargs):
-    uid = kwargs.get("uid")
-    bf = kwargs.get("binfile")
-    tag = kwargs.get("tag")
-    self.perm_manager.check_permission(uid, Capability.TAG_BINFILE)
-    tags = self.session.query(Tag).filter(Tag.tag == tag).all()
-    if tags == []:
-      tag = Tag(tag=tag)
-      self.session.add(tag)
-      self.session.commit()
-    else:
-      tag = tags[0]
-      existing_tags = bf.tags(self.session)
-      if tag.tag in existing_tags:
-        return False
-    binfile_tag = BinFileTag(tag_id=tag.id, binfile_id=bf.id)
-    self.session.add(binfile_tag)
-    self.session.commit()
-    return True
+    self.perm_manager.check_permission(kwargs.get("uid"), Capability.TAG_BINFILE)
+    return self._tag(BinFileTag, "binfile_id", [kwargs.get("binfile").id], [kwargs.get("tag")]) > 0
 
   def add_binfile_property(self, **kwargs):
-    uid = kwargs.get("uid")
-    binfile = kwargs.get("binfile")
-    name = kwargs.get("name")
-    value = kwargs.get("value")
-    update = kwargs.get("update", False)
-    self.perm_manager.check_permission(uid, Capability.ADD_BINFILE_PROPERTY)
-    pas = self.session.query(BinFileProp).filter(BinFileProp.binfile_id == binfile.id).all()
-    for pa in pas:
-      prop = self.session.query(Property).filter(Property.id == pa.prop_id).one()
-      if prop.name == name:
-        if not update:
-          raise FPLPropertyExists(name)
-        self.perm_manager.check_permission(uid, Capability.UPDATE_BINFILE_PROPERTY)
-        prop.value = value
-        self.session.commit()
-        return True
-    prop = Property(name=name, value=value)
-    self.session.add(prop)
-    self.session.commit()
-    pa = BinFileProp(prop_id=prop.id, binfile_id=binfile.id)
-    self.session.add(pa)
-    self.session.commit()
+    self.perm_manager.check_permission(kwargs.get("uid"), Capability.ADD_BINFILE_PROPERTY)
+    self._set_properties(BinFileProp, BinFileProp.binfile_id, [kwargs.get("binfile").id],
+                         {kwargs.get("name"): kwargs.get("value")},
+                         kwargs.get("uid"), Capability.UPDATE_BINFILE_PROPERTY, kwargs.get("update", False))
     return True
 
+  def set_binfile_properties(self, **kwargs):
+    # As set_fileset_properties for the files in binfile_ids
+    self.perm_manager.check_permission(kwargs.get("uid"), Capability.ADD_BINFILE_PROPERTY)
+    binfile_ids = self._existing_ids(BinFile, kwargs.get("binfile_ids"), FPLBinFileNotExists, "file id")
+    return self._set_properties(BinFileProp, BinFileProp.binfile_id, binfile_ids, kwargs.get("properties") or {},
+                                kwargs.get("uid"), Capability.UPDATE_BINFILE_PROPERTY, kwargs.get("update", False))
+
   def get_binfile(self, **kwargs):
     uid = kwargs.get("uid")
     binfile_id = kwargs.get("binfile_id", None)
@@ -17,23 +17,48 @@
 from .db.schema import *
 from .fp_exc import FPLPermissionDenied
 from .fp_constants import Capability
+from sqlalchemy import event
+import time
 
 
 class PermissionManager(object):
 
-  def __init__(self, session):
+  def __init__(self, session, ttl=60):
     self.session = session
+    # Permission sets are cached per user for ttl seconds (None means
+    # until invalidated).  Changes made to user_perms through this
+    # session invalidate the cache straight away, the ttl catches
+    # changes made by other processes.
+    self.ttl = ttl
+    self._cache = {}
+    event.listen(session, "after_flush", self._after_flush)
+
+  def _after_flush(self, session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+      if isinstance(obj, UserPermission):
+        self.invalidate(obj.user_id)
+
+  def invalidate(self, uid=None):
+    if uid is None:
+      self._cache.clear()
+    else:
+      self._cache.pop(uid, None)
+
+  def user_permissions(self, uid):
+    now = time.time()
+    cached = self._cache.get(uid)
+    if cached is not None and (cached[0] is None or now < cached[0]):
+      return cached[1]
+    perms = self.session.query(UserPermission.perm_id).filter(UserPermission.user_id == uid).all()
+    user_perms = frozenset([perm.perm_id for perm in perms])
+    self._cache[uid] = (None if self.ttl is None else now + self.ttl, user_perms)
+    return user_perms
 
   def check_permission(self, uid, permission):
-    perms = self.session.query(UserPermission).filter(UserPermission.user_id == uid).all()
-    user_perms = set([perm.perm_id for perm in perms])
-    # Sanity check that we got a set of user permissions through
-    assert type(user_perms) == type(set())
+    user_perms = self.user_permissions(uid)
     if permission not in user_perms:
       # The user doesn't have suitable permission to do this operation.
       # Raising an exception simplifies processing elsewhere since we
       # can allow the exception to propogate up through the stack until
       # we need to report it to the user.
       raise FPLPermissionDenied("user does not have permission %s" % (permission))
-
-  
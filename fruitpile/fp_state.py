@@ -18,16 +18,85 @@ from .db.schema import *
 from .fp_constants import Capability
 from .fp_exc import FPLCannotTransitionState, FPLInvalidStateTransition, FPLUnknownState, FPLPermissionDenied
 from collections import namedtuple
+from sqlalchemy import func
 from .fp_trans import TRANS_FN
 
 StateTransition = namedtuple("StateTransition", ["new_state","capability","transfn","data"])
+# Plain data versions of the State and TransitionFunctionData rows so a
+# compiled state machine holds nothing tied to a session
+StateInfo = namedtuple("StateInfo", ["id","name"])
+TransitionData = namedtuple("TransitionData", ["id","data"])
+CompiledStates = namedtuple("CompiledStates", ["version","states","transitions","start_state"])
+
+# Compiled transition tables keyed by store, see create_state_machine
+_COMPILED = {}
+
+def _no_transfn(uid, perm_man, old_state, new_state, d):
+  return None
+
+def schema_version(session):
+  return session.query(func.max(Migration.id)).scalar()
+
+def compile_states(session, version=None):
+  states = {}
+  for sid, name in session.query(State.id, State.name).order_by(State.id):
+    states[name] = StateInfo(id=sid, name=name)
+  names = dict((si.id, si.name) for si in states.values())
+  data = {}
+  for did, trans_id, d in session.query(TransitionFunctionData.id,
+                                        TransitionFunctionData.trans_id,
+                                        TransitionFunctionData.data).order_by(TransitionFunctionData.id):
+    data.setdefault(trans_id, []).append(TransitionData(id=did, data=d))
+  transitions = dict((nm, {}) for nm in states)
+  start_states = list(states)
+  q = session.query(Transition.id, Transition.start_id, Transition.end_id,
+                    Transition.perm_id, TransitionFunction.transfn).outerjoin(
+                      TransitionFunction, Transition.transfn_id == TransitionFunction.id)
+  for tid, start_id, end_id, perm_id, transfn in q:
+    # For each transition add the state transition to the
+    # transition map for this start state
+    end = names[end_id]
+    transitions[names[start_id]][end] = \
+              StateTransition(new_state=end,
+                              capability=perm_id,
+                              transfn=TRANS_FN[transfn] if transfn is not None else _no_transfn,
+                              data=data.get(tid, []))
+    try:
+      del start_states[start_states.index(end)]
+    except ValueError:
+      # state was already removed from the list
+      pass
+  assert len(start_states) == 1
+  # We currently only support the notion of a single start state
+  # which is identified by a state which you cannot arrive at.
+  # This will break if you have a state such as "open" which can
+  # be returned to (hence the assert above).  In this case the
+  # simple solution is to create a "new" state which transitions
+  # to "open" and have "open" being the state you can return to,
+  # until the system is configured to handle this case.  In all
+  # circumstances there must be at least one starting state.
+  # While multiple start states do make sense in some scenarios
+  # this system doesn't appear to need such functionality.
+  return CompiledStates(version=version, states=states,
+                        transitions=transitions, start_state=start_states[0])
+
+def invalidate_compiled_states(key=None):
+  if key is None:
+    _COMPILED.clear()
+  else:
+    _COMPILED.pop(key, None)
 
 class StateMachine(object):
-  def __init__(self):
+  def __init__(self, compiled=None):
     self._state = None
     self._state_dict = {}
     self._transitions = {}
-
+    if compiled is not None:
+      # The compiled tables are only ever read so are shared between
+      # all the state machines built from them
+      self._state = compiled.start_state
+      self._state_dict = compiled.states
+      self._transitions = compiled.transitions
   @property
   def state(self):
     return self._state
@@ -36,19 +105,29 @@ class StateMachine(object):
   def state_id(self):
     return self._state_dict[self._state].id
 
+  def state_ids(self):
+    return dict((name, si.id) for name, si in self._state_dict.items())
+
   def is_valid_state(self, state):
     return state in self._state_dict
 
-  def transit(self, uid, perm_man, old_state, new_state, external_data):
+  def transition(self, old_state, new_state):
+    # Look up the transition from old_state to new_state without
+    # checking permissions or running its transition function
     try:
       valid_trans = self._transitions[old_state]
     except KeyError:
-      raise FPLUnknownState("An unknown state: %s" % (self._state))
+      raise FPLUnknownState("An unknown state: %s" % (old_state))
     try:
-      trans_control = valid_trans[new_state]
+      return valid_trans[new_state]
     except KeyError:
-      raise FPLInvalidStateTransition("Invalid state transition from %s to %s" % (self._state, new_state))
-    perm_man.check_permission(uid, trans_control.capability)
+      raise FPLInvalidStateTransition("Invalid state transition from %s to %s" % (old_state, new_state))
+
+  def apply(self, uid, perm_man, trans_control, old_state, new_state, external_data):
+    # Run the transition function for a transition the caller has
+    # already checked the permission for.  The state machine is shared
+    # by every file (and thread) so its own state is left alone, the
+    # caller records the new state on the file.
     try:
       if trans_control.transfn is not None:
         d = {"data":trans_control.data}
@@ -57,50 +136,25 @@ class StateMachine(object):
     except Exception as exc:
       if isinstance(exc, FPLPermissionDenied):
         raise exc
-      raise FPLCannotTransitionState("Transit state function for %s->%s rejected state transition" % (self._state, new_state), exc)
-    self._state = new_state
+      raise FPLCannotTransitionState("Transit state function for %s->%s rejected state transition" % (old_state, new_state), exc)
     return new_state
 
-  @staticmethod
-  def create_state_machine(session):
-    states = session.query(State).all()
-    state_names = [state.name for state in states]
-    sm = StateMachine()
-    for nm in state_names:
-      sm._transitions[nm] = {}
-    for s in states:
-      sm._state_dict[s.name] = s
-    start_states = state_names[:]
-    transitions = session.query(Transition).all()
-    for t in transitions:
-      # For each transition add the state transition to the
-      # transition map for this start state
-      if t.transfn_id is not None:
-        trnsfn = TRANS_FN[t.transfn.transfn]
-      else:
-        trnsfn = lambda a,b,c,d,e: None
-      sm._transitions[t.start.name][t.end.name] = \
-                StateTransition(new_state=t.end.name,
-                                capability=t.perm_id,
-                                transfn=trnsfn,
-                                data=t.transfuncdata)
-      try:
-        del start_states[start_states.index(t.end.name)]
-      except ValueError:
-        # state was already removed from the list
-        pass
-    assert len(start_states) == 1
-    # We currently only support the notion of a single start state
-    # which is identified by a state which you cannot arrive at.
-    # This will break if you have a state such as "open" which can
-    # be returned to (hence the assert above).  In this case the
-    # simple solution is to create a "new" state which transitions
-    # to "open" and have "open" being the state you can return to,
-    # until the system is configured to handle this case.  In all
-    # circumstances there must be at least one starting state.
-    # While multiple start states do make sense in some scenarios
-    # this system doesn't appear to need such functionality.
-    sm._state = session.query(State).filter(State.name == start_states[0]).first().name
-    return sm
+  def transit(self, uid, perm_man, old_state, new_state, external_data):
+    trans_control = self.transition(old_state, new_state)
+    perm_man.check_permission(uid, trans_control.capability)
+    return self.apply(uid, perm_man, trans_control, old_state, new_state, external_data)
 
-  
+  @staticmethod
+  def create_state_machine(session, key=None):
+    # Without a key the tables are compiled from the database each time.
+    # With a key (the store's database path) the compiled tables are
+    # cached and reused for as long as the schema version is unchanged,
+    # which costs a single query on each open.
+    if key is None:
+      return StateMachine(compile_states(session))
+    version = schema_version(session)
+    compiled = _COMPILED.get(key)
+    if compiled is None or compiled.version != version:
+      compiled = compile_states(session, version)
+      _COMPILED[key] = compiled
+    return StateMachine(compiled)
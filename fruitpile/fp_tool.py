@@ -17,33 +17,58 @@
 # along with Fruitpile.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import print_function
 from __future__ import unicode_literals
-from fruitpile import Fruitpile, FPLInvalidState, FPLBinFileNotExists, FPLInvalidTargetForStateChange, FPLInvalidStateTransition, FPLFileSetExists, FPLFileExists, FPLCannotWriteFile, FPLPropertyExists
+from fruitpile import Fruitpile, build_manifest, parse_date, parse_properties, FPLBinFileExists, FPLInvalidCursor, FPLInvalidState, FPLBinFileNotExists, FPLInvalidTargetForStateChange, FPLInvalidStateTransition, FPLCannotTransitionState, FPLPermissionDenied, FPLFileSetExists, FPLFileExists, FPLCannotWriteFile, FPLPropertyExists, FPLUnknownState, FPLNeedsUpgrade
+from fruitpile.repo import REPO_TYPES
 from argparse import ArgumentParser
 import pwd
 import os
 import sys
+from datetime import datetime, timedelta
 from jinja2 import Template
 
 def fp_init_repo(ns):
   fp = Fruitpile(ns.path)
   owner = os.getuid()
-  fp.init(uid=owner, username=pwd.getpwuid(owner)[0])
+  fp.init(uid=owner, username=pwd.getpwuid(owner)[0],
+          repo_type=getattr(ns, "repo_type", "FileManager"),
+          db_url=getattr(ns, "db_url", None),
+          repo_path=getattr(ns, "repo_path", None))
   fp.open()
   fp.close()
 
+FILESET_TEMPLATE = '{{ " %-10s %10s %8s %8s %-39s"|format(item.repo_name, item.id,item.version,item.revision,item.name) }}'
+
+def _print_items(items, template, show_tags, show_props, outfob):
+  for item in items:
+    print(template.render(item=item), file=outfob)
+    if show_tags:
+      print("  "+",".join(item.loaded_tags), file=outfob)
+    if show_props:
+      for pk,pv in item.loaded_properties.items():
+        print("  {}={}".format(pk, pv), file=outfob)
+
 def fp_list_filesets(ns, outfob=sys.stdout, errfob=sys.stderr):
-  template = Template('{{ " %-10s %10s %8s %8s %-39s"|format(item.repo.name, item.id,item.version,item.revision,item.name) }}')
+  template = Template(FILESET_TEMPLATE)
   fp = Fruitpile(ns.path)
   owner = os.getuid()
   fp.open()
-  fss = fp.list_filesets(uid=owner, count=ns.count, start_at=ns.start_at)
-  for fs in fss:
-    print(template.render(item=fs), file=outfob)
-    if ns.tags:
-      print("  "+",".join(fs.tags(fp.session)), file=outfob)
-    if ns.properties:
-      for pk,pv in fs.properties(fp.session).items():
-        print("  {}={}".format(pk, pv), file=outfob)
+  show_tags = getattr(ns, "tags", False)
+  show_props = getattr(ns, "properties", False)
+  cursor = getattr(ns, "cursor", None)
+  if cursor is not None:
+    try:
+      fss, next_cursor = fp.page_filesets(uid=owner, count=int(ns.count), cursor=cursor,
+                                          with_tags=show_tags, with_properties=show_props, records=True)
+    except FPLInvalidCursor:
+      print("invalid cursor '{0}'".format(cursor), file=errfob)
+      fp.close()
+      return 1
+  else:
+    fss = fp.iter_filesets(uid=owner, count=int(ns.count), start_at=int(ns.start_at),
+                           with_tags=show_tags, with_properties=show_props, records=True)
+  _print_items(fss, template, show_tags, show_props, outfob)
+  if cursor is not None and next_cursor is not None:
+    print("next-cursor: {}".format(next_cursor), file=outfob)
   fp.close()
 
 def fp_add_filesets(ns, outfob=sys.stdout, errfob=sys.stderr):
@@ -86,6 +111,16 @@ def fp_add_binfile_tags(ns, outfob=sys.stdout, errfob=sys.stderr):
   fp = Fruitpile(ns.path)
   owner = os.getuid()
   fp.open()
+  ids = getattr(ns, "ids", None)
+  if ids:
+    try:
+      fp.tag_many(uid=owner, tags=[ns.tag], binfile_ids=ids)
+    except FPLBinFileNotExists as e:
+      print(str(e), file=errfob)
+      fp.close()
+      return 1
+    fp.close()
+    return
   bfs = fp.get_binfile(uid=owner, binfile_id=ns.id)
   if bfs == []:
     print("Artifact id {0} not found".format(ns.id), file=errfob)
@@ -109,7 +144,7 @@ def fp_add_file(ns, outfob=sys.stdout, errfob=sys.stderr):
   fp = Fruitpile(ns.path)
   owner = os.getuid()
   fp.open()
-  fss = fp.list_filesets(uid=owner)
+  fss = fp.list_filesets(uid=owner, records=True)
   bf = None
   for fs in fss:
     if fs.name == ns.fileset:
@@ -125,28 +160,125 @@ def fp_add_file(ns, outfob=sys.stdout, errfob=sys.stderr):
     print("Failed to add file, fileset '{0}' not found".format(str(ns.fileset)), file=errfob)
   fp.close()
 
-def fp_list_files(ns, outfob=sys.stdout, errfob=sys.stdout):
-  if ns.long:
-    template = Template("""{{ "%10d/%-10d"|format(item.fileset_id,item.id) }} {{ "%s/%s"|format(item.path,item.name)}}
-{{ item.state.name }} {{ "auxilliary" if not item.primary }}
+def fp_add_many_files(ns, outfob=sys.stdout, errfob=sys.stderr):
+  fp = Fruitpile(ns.path)
+  owner = os.getuid()
+  fp.open()
+  fss = fp.get_fileset(uid=owner, name=ns.fileset)
+  if fss == []:
+    print("Failed to add files, fileset '{0}' not found".format(str(ns.fileset)), file=errfob)
+    fp.close()
+    return 1
+  manifest = build_manifest(ns.source_dir, ns.repopath, ns.auxilliary or [])
+  try:
+    bfs = fp.add_files(uid=owner,
+                       fileset_id=fss[0].id,
+                       files=manifest,
+                       source=ns.origin,
+                       workers=ns.jobs)
+  except FPLBinFileExists as e:
+    print("Failed to add files, {0}".format(str(e)), file=errfob)
+    fp.close()
+    return 1
+  print("Added {0} files to fileset '{1}' ({2} bytes)".format(len(bfs), ns.fileset, sum([bf.ingest_stats.size for bf in bfs])), file=outfob)
+  fp.close()
+
+def _file_template(long_format):
+  if long_format:
+    return Template("""{{ "%10d/%-10d"|format(item.fileset_id,item.id) }} {{ "%s/%s"|format(item.path,item.name)}}
+{{ item.state_name }} {{ "auxilliary" if not item.primary }}
 cksum: {{ item.checksum }}
 --""")
+  return Template("""{{ "%6d %10d"|format(item.fileset_id,item.id) }} {{ "%10s"|format(item.state_name) }} {{ "A" if not item.primary }}{{ "P" if item.primary }} {{ "%s/%s"|format(item.path,item.name)}}""")
+
+def fp_list_files(ns, outfob=sys.stdout, errfob=sys.stdout):
+  template = _file_template(ns.long)
+  fp = Fruitpile(ns.path)
+  owner = os.getuid()
+  fp.open()
+  show_tags = getattr(ns, "tags", False)
+  show_props = getattr(ns, "properties", False)
+  cursor = getattr(ns, "cursor", None)
+  if cursor is not None:
+    try:
+      bfs, next_cursor = fp.page_files(uid=owner, count=int(ns.count), cursor=cursor,
+                                       with_tags=show_tags, with_properties=show_props, records=True)
+    except FPLInvalidCursor:
+      print("invalid cursor '{0}'".format(cursor), file=errfob)
+      fp.close()
+      return 1
   else:
-    template = Template("""{{ "%6d %10d"|format(item.fileset_id,item.id) }} {{ "%10s"|format(item.state.name) }} {{ "A" if not item.primary }}{{ "P" if item.primary }} {{ "%s/%s"|format(item.path,item.name)}}""")
+    bfs = fp.iter_files(uid=owner, count=int(ns.count), start_at=int(ns.start_at),
+                        with_tags=show_tags, with_properties=show_props, records=True)
+  _print_items(bfs, template, show_tags, show_props, outfob)
+  if cursor is not None and next_cursor is not None:
+    print("next-cursor: {}".format(next_cursor), file=outfob)
+  fp.close()
+
+def _print_search(search, ns, template, outfob, errfob, **kwargs):
+  show_tags = getattr(ns, "tags", False)
+  show_props = getattr(ns, "properties", False)
+  cursor = getattr(ns, "cursor", None)
+  try:
+    items, next_cursor = search(uid=os.getuid(), count=int(getattr(ns, "count", -1)), cursor=cursor,
+                                name_pattern=getattr(ns, "name", None),
+                                tags=getattr(ns, "tag", None),
+                                properties=parse_properties(getattr(ns, "prop", None)),
+                                with_tags=show_tags, with_properties=show_props, records=True, **kwargs)
+  except FPLInvalidCursor:
+    print("invalid cursor '{0}'".format(cursor), file=errfob)
+    return 1
+  except FPLUnknownState:
+    print("unknown state '{0}'".format(kwargs.get("state")), file=errfob)
+    return 1
+  _print_items(items, template, show_tags, show_props, outfob)
+  if next_cursor is not None:
+    print("next-cursor: {}".format(next_cursor), file=outfob)
+
+def fp_search_files(ns, outfob=sys.stdout, errfob=sys.stderr):
   fp = Fruitpile(ns.path)
   owner = os.getuid()
   fp.open()
-  bfs = fp.list_files(uid=owner, count=ns.count, start_at=ns.start_at)
-  for bf in bfs:
-    print(template.render(item=bf), file=outfob)
-    if ns.tags:
-      print("  "+",".join(bf.tags(fp.session)), file=outfob)
-    if ns.properties:
-      for pk,pv in bf.properties(fp.session).items():
-        print("  {}={}".format(pk,pv), file=outfob)
+  kwargs = {}
+  if getattr(ns, "fileset", None):
+    fss = fp.get_fileset(uid=owner, name=ns.fileset)
+    if not fss:
+      print("fileset '{0}' not found".format(str(ns.fileset)), file=errfob)
+      fp.close()
+      return 1
+    kwargs["fileset_id"] = fss[0].id
+  ret = _print_search(fp.search_files, ns, _file_template(getattr(ns, "long", False)), outfob, errfob,
+                      state=getattr(ns, "state", None),
+                      source=getattr(ns, "source", None),
+                      since=getattr(ns, "since", None),
+                      until=getattr(ns, "until", None),
+                      **kwargs)
   fp.close()
+  return ret
+
+def fp_search_filesets(ns, outfob=sys.stdout, errfob=sys.stderr):
+  fp = Fruitpile(ns.path)
+  fp.open()
+  ret = _print_search(fp.search_filesets, ns, Template(FILESET_TEMPLATE), outfob, errfob,
+                      version=getattr(ns, "version", None),
+                      revision=getattr(ns, "revision", None))
+  fp.close()
+  return ret
+
+def _transit_error(exc, state, file_id):
+  if isinstance(exc, FPLBinFileNotExists):
+    return "file id {0} cannot be found".format(file_id)
+  if isinstance(exc, FPLInvalidTargetForStateChange):
+    return "attempted to change state on an auxilliary file"
+  if isinstance(exc, FPLPermissionDenied):
+    return "permission denied changing file id {0} to state '{1}'".format(file_id, state)
+  if isinstance(exc, FPLCannotTransitionState):
+    return "the transition to state '{0}' for file id {1} was rejected".format(state, file_id)
+  return "the transition to state '{0}' for file id {1} is not permitted".format(state, file_id)
 
 def fp_transit_file(ns, outfob=sys.stdout, errfob=sys.stderr):
+  if getattr(ns, "all", False):
+    return fp_transit_fileset(ns, outfob, errfob)
   fp = Fruitpile(ns.path)
   owner = os.getuid()
   fp.open()
@@ -162,6 +294,32 @@ def fp_transit_file(ns, outfob=sys.stdout, errfob=sys.stderr):
     print("the transition to state '{0}' for file id {1} is not permitted".format(ns.state, ns.id), file=errfob)
   fp.close()
 
+def fp_transit_fileset(ns, outfob=sys.stdout, errfob=sys.stderr):
+  if not getattr(ns, "fileset", None):
+    print("a fileset must be given with --all", file=errfob)
+    return 1
+  fp = Fruitpile(ns.path)
+  owner = os.getuid()
+  fp.open()
+  try:
+    fss = fp.get_fileset(uid=owner, name=ns.fileset)
+    if fss == []:
+      print("fileset '{0}' not found".format(str(ns.fileset)), file=errfob)
+      return 1
+    results = fp.transit_files(uid=owner, fileset_id=fss[0].id, req_state=ns.state)
+  except FPLInvalidState:
+    print("requested state '{0}' is not recognised".format(ns.state), file=errfob)
+    return 1
+  finally:
+    fp.close()
+  failed = 0
+  for res in results:
+    if res.error is not None:
+      print(_transit_error(res.error, ns.state, res.file_id), file=errfob)
+      failed += 1
+  print("{0} of {1} files moved to state '{2}'".format(len(results) - failed, len(results), ns.state), file=outfob)
+  return 1 if failed else 0
+
 def fp_get_file(ns, outfob=sys.stdout, errfob=sys.stderr):
   fp = Fruitpile(ns.path)
   owner = os.getuid()
@@ -176,8 +334,55 @@ def fp_get_file(ns, outfob=sys.stdout, errfob=sys.stderr):
     print("the target file '{}' already exists, not overwriting".format(ns.to_file), file=errfob)
   except FPLCannotWriteFile as e:
     print("the target file '{}' cannot be written to".format(ns.to_file), file=errfob)
+  else:
+    if getattr(ns, "verbose", False):
+      print("copied file id {0} to '{1}' using {2}".format(ns.id, ns.to_file, found), file=outfob)
   fp.close()
     
+def fp_verify(ns, outfob=sys.stdout, errfob=sys.stderr):
+  fp = Fruitpile(ns.path)
+  owner = os.getuid()
+  fp.open()
+  kwargs = {}
+  if getattr(ns, "fileset", None):
+    fss = fp.get_fileset(uid=owner, name=ns.fileset)
+    if fss == []:
+      print("fileset '{0}' not found".format(str(ns.fileset)), file=errfob)
+      fp.close()
+      return 1
+    kwargs["fileset_id"] = fss[0].id
+  if getattr(ns, "id", None):
+    kwargs["file_ids"] = ns.id
+  if getattr(ns, "max_age", None) is not None:
+    kwargs["older_than"] = datetime.now() - timedelta(hours=ns.max_age)
+  report = fp.verify_files(uid=owner, workers=getattr(ns, "jobs", None), **kwargs)
+  fp.close()
+  for file_id in report.missing:
+    print("file id {0} is missing".format(file_id), file=errfob)
+  for file_id in report.corrupt:
+    print("file id {0} is corrupt".format(file_id), file=errfob)
+  for path in report.orphaned:
+    print("orphaned file {0}".format(path), file=errfob)
+  print("verified {0} files ({1} bytes) in {2:.1f}s: {3} ok, {4} missing, {5} corrupt, {6} orphaned".format(
+    report.checked, report.size, report.elapsed, report.ok,
+    len(report.missing), len(report.corrupt), len(report.orphaned)), file=outfob)
+  return 1 if report.missing or report.corrupt or report.orphaned else 0
+
+def fp_upgrade(ns, outfob=sys.stdout, errfob=sys.stderr):
+  fp = Fruitpile(ns.path)
+  fp.open(upgrade=True)
+  def progress(step, done, total):
+    if not done:
+      print("applying migration {0}: {1}".format(step.id, step.name), file=outfob)
+    elif total:
+      print("  {0}/{1} rows".format(done, total), file=outfob)
+    else:
+      print("  {0} rows".format(done), file=outfob)
+  applied = fp.migrate(progress=progress, batch_size=getattr(ns, "batch_size", None))
+  fp.close()
+  if not applied:
+    print("store is up to date", file=outfob)
+
 def fp_serve_repo(ns):
   print("SERVE: %s" % (ns))
 
@@ -188,12 +393,18 @@ def fp_tool_main(args):
 
   # init
   parser_init = subparsers.add_parser("init", help="Help for the init command")
+  parser_init.add_argument("-r", "--repo-type", default="FileManager",
+                           choices=sorted(REPO_TYPES.keys()),
+                           help="How files are kept in the store, BlobStore keeps a single copy of identical files")
+  parser_init.add_argument("-d", "--db-url", help="SQLAlchemy URL of the database to keep the metadata in (default fpl.db in the store)")
+  parser_init.add_argument("-p", "--repo-path", help="Where to keep the files (default the store directory)")
   parser_init.set_defaults(func=fp_init_repo)
 
   # list filesets
   parser_list_fss = subparsers.add_parser("lsfs", help="List filesets in store")
   parser_list_fss.add_argument("-c", "--count", metavar="COUNT", default=-1, help="Limit results to COUNT")
   parser_list_fss.add_argument("-s", "--start-at", metavar="START_AT", default=1, help="Start returning results from START_AT item")
+  parser_list_fss.add_argument("-C", "--cursor", metavar="CURSOR", nargs="?", const="", help="Page through filesets using cursors, resuming from CURSOR if given")
   parser_list_fss.add_argument("-t", "--tags", action='store_true', default=False, help="Report tags associated with each fileset")
   parser_list_fss.add_argument("-p", "--properties", action='store_true', default=False, help="Report properties associated with each fileset")
 
@@ -225,26 +436,90 @@ def fp_tool_main(args):
                                help="Path to the file in the repo fileset")
   parser_add_file.set_defaults(func=fp_add_file)
 
+  # add many files
+  parser_add_many = subparsers.add_parser("addmany", help="Add a directory tree of files to a fileset")
+  parser_add_many.add_argument("-f","--fileset", required=True,
+                               help="Name of the fileset to add the files to")
+  parser_add_many.add_argument("-d","--source-dir", required=True,
+                               help="Directory containing the files to add to the store")
+  parser_add_many.add_argument("-o","--origin", required=True,
+                               help="Origin of these files")
+  parser_add_many.add_argument("-p", "--repopath", required=True,
+                               help="Path to the files in the repo fileset")
+  parser_add_many.add_argument("-a","--auxilliary", action='append', metavar="PATTERN",
+                               help="Add files matching PATTERN as auxilliary files")
+  parser_add_many.add_argument("-j","--jobs", type=int, default=4,
+                               help="Number of files to copy into the store at once")
+  parser_add_many.set_defaults(func=fp_add_many_files)
+
   # list files
   parser_list_files = subparsers.add_parser("ls", help="List files in the repo")
   parser_list_files.add_argument("-l", "--long", action='store_true', default=False,
                                  help="Give a longer list of file information")
   parser_list_files.add_argument("-c", "--count", metavar="COUNT", default=-1, help="Limit results to COUNT")
   parser_list_files.add_argument("-s", "--start-at", metavar="START_AT", default=1, help="Start returning results from START_AT item")
+  parser_list_files.add_argument("-C", "--cursor", metavar="CURSOR", nargs="?", const="", help="Page through files using cursors, resuming from CURSOR if given")
   parser_list_files.add_argument("-t", "--tags", action="store_true", help="Show tags for artifacts")
   parser_list_files.add_argument("-p", "--properties", action="store_true", help="Show properties for artifacts")
   parser_list_files.set_defaults(func=fp_list_files)
 
   # transit file
   parser_transit_file = subparsers.add_parser("transit", help="transit file state in repo")
-  parser_transit_file.add_argument("-i","--id", type=int, required=True, help="File id of the file to be transitted")
+  transit_group = parser_transit_file.add_mutually_exclusive_group(required=True)
+  transit_group.add_argument("-i","--id", type=int, help="File id of the file to be transitted")
+  transit_group.add_argument("-a","--all", action="store_true", help="Transit all the primary files in the fileset given with -f")
+  parser_transit_file.add_argument("-f","--fileset", help="Name of the fileset to transit with --all")
   parser_transit_file.add_argument("-s","--state", required=True, help="New state of the item")
   parser_transit_file.set_defaults(func=fp_transit_file)
 
+  # bring the store schema up to date
+  parser_upgrade = subparsers.add_parser("upgrade", help="apply schema migrations to the store")
+  parser_upgrade.add_argument("-b","--batch-size", type=int, help="Number of rows changed per transaction by data migrations")
+  parser_upgrade.set_defaults(func=fp_upgrade)
+
+  # verify the files in the store
+  parser_verify = subparsers.add_parser("verify", help="check stored files against their checksums")
+  parser_verify.add_argument("-f","--fileset", help="Only verify the files in this fileset")
+  parser_verify.add_argument("-i","--id", type=int, action="append", help="Only verify the file with this id (can be repeated)")
+  parser_verify.add_argument("-a","--max-age", type=float, metavar="HOURS", help="Skip files verified in the last HOURS hours, rerun with the same value to resume")
+  parser_verify.add_argument("-j","--jobs", type=int, help="Number of worker processes (default number of cpus)")
+  parser_verify.set_defaults(func=fp_verify)
+
+  # search for files
+  parser_search = subparsers.add_parser("search", help="search for files by name, tag, property, state and date")
+  parser_search.add_argument("-l", "--long", action='store_true', default=False, help="Long listing format")
+  parser_search.add_argument("-n", "--name", metavar="PATTERN", help="Only files with names matching the shell style PATTERN")
+  parser_search.add_argument("-T", "--tag", action="append", help="Only files with this tag (can be repeated)")
+  parser_search.add_argument("-P", "--prop", action="append", metavar="NAME[=VALUE]", help="Only files with this property, or with it set to VALUE (can be repeated)")
+  parser_search.add_argument("-S", "--state", help="Only files in this state")
+  parser_search.add_argument("-f", "--fileset", help="Only files in this fileset")
+  parser_search.add_argument("-o", "--source", help="Only files from this source")
+  parser_search.add_argument("--since", type=parse_date, metavar="DATE", help="Only files added at or after DATE (ISO 8601)")
+  parser_search.add_argument("--until", type=parse_date, metavar="DATE", help="Only files added before DATE (ISO 8601)")
+  parser_search.add_argument("-c", "--count", metavar="COUNT", default=-1, help="Limit results to COUNT")
+  parser_search.add_argument("-C", "--cursor", metavar="CURSOR", help="Resume from the CURSOR printed by the previous search")
+  parser_search.add_argument("-t", "--tags", action="store_true", help="Show tags for artifacts")
+  parser_search.add_argument("-p", "--properties", action="store_true", help="Show properties for artifacts")
+  parser_search.set_defaults(func=fp_search_files)
+
+  # search for filesets
+  parser_search_fss = subparsers.add_parser("searchfs", help="search for filesets by name, tag, property, version and revision")
+  parser_search_fss.add_argument("-n", "--name", metavar="PATTERN", help="Only filesets with names matching the shell style PATTERN")
+  parser_search_fss.add_argument("-T", "--tag", action="append", help="Only filesets with this tag (can be repeated)")
+  parser_search_fss.add_argument("-P", "--prop", action="append", metavar="NAME[=VALUE]", help="Only filesets with this property, or with it set to VALUE (can be repeated)")
+  parser_search_fss.add_argument("-V", "--version", help="Only filesets with this version")
+  parser_search_fss.add_argument("-R", "--revision", help="Only filesets with this revision")
+  parser_search_fss.add_argument("-c", "--count", metavar="COUNT", default=-1, help="Limit results to COUNT")
+  parser_search_fss.add_argument("-C", "--cursor", metavar="CURSOR", help="Resume from the CURSOR printed by the previous search")
+  parser_search_fss.add_argument("-t", "--tags", action='store_true', default=False, help="Report tags associated with each fileset")
+  parser_search_fss.add_argument("-p", "--properties", action='store_true', default=False, help="Report properties associated with each fileset")
+  parser_search_fss.set_defaults(func=fp_search_filesets)
+
   # get a file
   parser_get_file = subparsers.add_parser("get", help="retrieve a file from the repo")
   parser_get_file.add_argument("-i","--id", type=int, required=True, help="File id of the file to be retrieved from the repo")
   parser_get_file.add_argument("-t","--to-file", required=True, help="Name of the file to copy the contents to")
+  parser_get_file.add_argument("-v","--verbose", action="store_true", help="Report how the file was copied")
   parser_get_file.set_defaults(func=fp_get_file)
 
   # tag a fileset
@@ -263,7 +538,9 @@ def fp_tool_main(args):
 
   # add tag to binfile
   parser_tag_binfile = subparsers.add_parser("tag", help="tag an artifact")
-  parser_tag_binfile.add_argument("-i", "--id", type=int, required=True, help="Artifact id to add the tag to")
+  tag_binfile_target = parser_tag_binfile.add_mutually_exclusive_group(required=True)
+  tag_binfile_target.add_argument("-i", "--id", type=int, help="Artifact id to add the tag to")
+  tag_binfile_target.add_argument("-I", "--ids", type=int, nargs="+", metavar="ID", help="Artifact ids to add the tag to")
   parser_tag_binfile.add_argument("-t", "--tag", required=True, help="Tag to add the artifact")
   parser_tag_binfile.set_defaults(func=fp_add_binfile_tags)
 
@@ -272,8 +549,12 @@ def fp_tool_main(args):
   parser_serve.set_defaults(func=fp_serve_repo)
   
   ns = parser.parse_args(args)
-  ns.func(ns)
+  try:
+    return ns.func(ns)
+  except FPLNeedsUpgrade as e:
+    print(str(e), file=sys.stderr)
+    return 1
   
   
 if __name__ == "__main__":
-  fp_tool_main(sys.argv[1:])
+  sys.exit(fp_tool_main(sys.argv[1:]))
@@ -20,17 +20,23 @@ from .fp_exc import FPLCannotTransitionState, FPLInvalidStateTransition, FPLUnkn
 
 def check_auxilliary_file_in_fileset(uid, perm_man, old_state, new_state, d):
   bf = d["bf"]
-  target_names = set([dt.data[5:] for dt in d["data"]])
+  target_names = frozenset([dt.data[5:] for dt in d["data"]])
   fs_id = bf.fileset_id
-  # perm manager carries the session, so we'll borrow it here
-  bfs = perm_man.session.query(BinFile).filter(BinFile.fileset_id==fs_id).filter(BinFile.primary==False).all()
-  for bf0 in bfs:
-    for t0 in target_names:
-      if bf0.name.endswith(t0):
-        target_names.discard(bf0.name)
-        break
-  if target_names != set([]):
-    raise FPLCannotTransitionState("Transition disallowed by check auxilliary file in fileset")
+  # A bulk transit passes a dict in aux_cache so that each fileset is
+  # only checked once for the run
+  cache = d.get("aux_cache")
+  key = (fs_id, target_names)
+  if cache is not None and key in cache:
+    found = cache[key]
+  else:
+    # perm manager carries the session, so we'll borrow it here
+    q = perm_man.session.query(BinFile.name).filter(BinFile.fileset_id==fs_id).filter(
+      BinFile.primary==False).filter(BinFile.name.in_(target_names)).distinct()
+    found = len(q.all()) == len(target_names)
+    if cache is not None:
+      cache[key] = found
+  if not found:
+    raise FPLCannotTransitionState("Transition disallowed by check auxilliary file in fileset", None)
   return
 
 TRANS_FN = {"check_auxilliary_file_in_fileset": check_auxilliary_file_in_fileset}
@@ -15,9 +15,10 @@
 # You should have received a copy of the GNU General Public License
 # along with Fruitpile.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import print_function
-from flask import jsonify, abort, make_response
+from flask import jsonify, abort, make_response, Response, stream_with_context
+import json
 from flask_restful import Resource
-from flask.ext.httpauth import HTTPBasicAuth
+from flask_httpauth import HTTPBasicAuth
 
 auth = HTTPBasicAuth()
 
@@ -41,3 +42,14 @@ class FruitpileResource(Resource):
 
   def __init__(self):
     super(FruitpileResource, self).__init__()
+
+def stream_json_list(items, to_dict):
+  # Stream a JSON array one element at a time so that large listings
+  # are never built up in memory in full
+  def generate():
+    sep = "["
+    for item in items:
+      yield sep + json.dumps(to_dict(item))
+      sep = ","
+    yield "[]" if sep == "[" else "]"
+  return Response(stream_with_context(generate()), mimetype="application/json")
@@ -17,8 +17,12 @@
 from __future__ import print_function
 from ..fp_ops import *
 from .v1 import init_v1_api
+from .service import FruitpileService
 
 def init_api(app):
   fppath = app.config["FRUITPILE_STORE"]
-  api = init_v1_api(app, fppath)
+  service = FruitpileService(fppath)
+  app.extensions["fruitpile"] = service
+  app.teardown_appcontext(service.remove_session)
+  api = init_v1_api(app, service)
   return api
@@ -0,0 +1,34 @@
+# -*- mode: python -*-
+# Copyright (c) 2016 Dominic Binks (software-fool on github)
+# This file is part of Fruitpile.
+#
+# Fruitpile is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fruitpile is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fruitpile.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import print_function
+from ..fp_ops import Fruitpile
+
+class FruitpileService(object):
+  # Application scoped access to a Fruitpile store.  The store is opened
+  # once when the application starts, so the engine (and its connection
+  # pool) and the static data are shared by every request.  Each thread
+  # gets its own session which is removed at the end of the request.
+
+  def __init__(self, path):
+    self.fp = Fruitpile(path)
+    self.fp.open(scoped=True)
+
+  def remove_session(self, exc=None):
+    self.fp.session.remove()
+
+  def close(self):
+    self.fp.close()
@@ -16,13 +16,22 @@
 # along with Fruitpile.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import print_function
 from .files import FruitpileFiles
+from .file import FruitpileFile
 from .filesets import FruitpileFilesets
 from .fileset import FruitpileFileset
+from .uploads import FruitpileFilesetFiles, FruitpileFilesetUploads, FruitpileUpload
+from .search import FruitpileFilesSearch, FruitpileFilesetsSearch
 from flask_restful import Api
 
-def init_v1_api(app, fppath):
+def init_v1_api(app, service):
   api = Api(app, prefix="/v1")
-  api.add_resource(FruitpileFiles, '/files', resource_class_kwargs={"fppath":fppath}, endpoint='files')
-  api.add_resource(FruitpileFilesets, '/filesets', resource_class_kwargs={"fppath":fppath}, endpoint='filesets')
-  api.add_resource(FruitpileFileset, '/fileset/<int:id>', resource_class_kwargs={"fppath":fppath}, endpoint='fileset')
+  api.add_resource(FruitpileFiles, '/files', resource_class_kwargs={"service":service}, endpoint='files')
+  api.add_resource(FruitpileFilesSearch, '/files/search', resource_class_kwargs={"service":service}, endpoint='files_search')
+  api.add_resource(FruitpileFile, '/files/<int:id>', resource_class_kwargs={"service":service}, endpoint='file')
+  api.add_resource(FruitpileFilesets, '/filesets', resource_class_kwargs={"service":service}, endpoint='filesets')
+  api.add_resource(FruitpileFilesetsSearch, '/filesets/search', resource_class_kwargs={"service":service}, endpoint='filesets_search')
+  api.add_resource(FruitpileFileset, '/fileset/<int:id>', resource_class_kwargs={"service":service}, endpoint='fileset')
+  api.add_resource(FruitpileFilesetFiles, '/filesets/<int:id>/files', resource_class_kwargs={"service":service}, endpoint='fileset_files')
+  api.add_resource(FruitpileFilesetUploads, '/filesets/<int:id>/uploads', resource_class_kwargs={"service":service}, endpoint='fileset_uploads')
+  api.add_resource(FruitpileUpload, '/uploads/<upload_id>', resource_class_kwargs={"service":service}, endpoint='upload')
   return api
@@ -0,0 +1,52 @@
+# Copyright (c) 2016 Dominic Binks (software-fool on github)
+# This file is part of Fruitpile.
+#
+# Fruitpile is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fruitpile is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fruitpile.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import print_function
+from flask import request, Response
+from flask_restful import abort
+from werkzeug.wsgi import wrap_file
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from ..api_utils import FruitpileResource
+from ...fp_exc import FPLBinFileNotExists
+import os
+
+
+class FruitpileFile(FruitpileResource):
+  def __init__(self, **kwargs):
+    self.fp = kwargs["service"].fp
+    super(FruitpileFile,self).__init__()
+
+  def get(self, id):
+    # Stream the contents of the file a block at a time.  The checksum
+    # is the ETag, so If-None-Match and Range (with If-Range) requests
+    # are handled by make_conditional letting clients resume downloads.
+    try:
+      bf, fh = self.fp.open_file(uid=os.getuid(), file_id=id)
+    except FPLBinFileNotExists:
+      abort(404, message="file {} not found".format(id))
+    # the size is recorded when the file is added, finding it from the
+    # file means decompressing all of a compressed one
+    size = bf.size if bf.size is not None else fh.size()
+    rv = Response(wrap_file(request.environ, fh),
+                  mimetype="application/octet-stream",
+                  direct_passthrough=True)
+    rv.content_length = size
+    rv.set_etag(bf.checksum)
+    rv.headers.set("Content-Disposition", "attachment", filename=bf.name)
+    try:
+      return rv.make_conditional(request, accept_ranges=True, complete_length=size)
+    except RequestedRangeNotSatisfiable:
+      fh.close()
+      raise
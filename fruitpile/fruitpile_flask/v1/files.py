@@ -15,29 +15,40 @@
 # You should have received a copy of the GNU General Public License
 # along with Fruitpile.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import print_function
-from flask_restful import reqparse
-from ..api_utils import FruitpileResource
-from ...fp_ops import Fruitpile
+from flask_restful import reqparse, abort
+from ..api_utils import FruitpileResource, stream_json_list
+from ...fp_exc import FPLInvalidCursor
 import os
 
+def binfile_to_dict(bf):
+  return {"fileset_id":bf.fileset_id,
+          "fileset": bf.fileset_name,
+          "name":bf.name,
+          "primary":bf.primary,
+          "state": bf.state_name,
+          "create_date":str(bf.create_date),
+          "update_date":str(bf.update_date),
+          "source": bf.source}
+
 class FruitpileFiles(FruitpileResource):
   def __init__(self, **kwargs):
-    self.fp = Fruitpile(kwargs["fppath"])
-    self.fp.open()
+    self.fp = kwargs["service"].fp
     super(FruitpileFiles,self).__init__()
 
   def get(self):
     parser = reqparse.RequestParser()
-    parser.add_argument('count', type=int, help='number of files to return in one block')
-    parser.add_argument('start_at', type=int, help='position to start at')
+    parser.add_argument('count', type=int, help='number of files to return in one block', location='args')
+    parser.add_argument('start_at', type=int, help='position to start at', location='args')
+    parser.add_argument('cursor', help='cursor returned in X-Next-Cursor by the previous page', location='args')
     args = parser.parse_args()
-    bfs = self.fp.list_files(uid=os.getuid(), count=args["count"], start_at=args["start_at"])
-    bfss = [{"fileset_id":bf.fileset_id,
-             "fileset": bf.fileset.name,
-             "name":bf.name,
-             "primary":bf.primary,
-             "state": bf.state.name,
-             "create_date":str(bf.create_date),
-             "update_date":str(bf.update_date),
-             "source": bf.source} for bf in bfs]
-    return bfss
+    if args["cursor"] is None:
+      bfs = self.fp.iter_files(uid=os.getuid(), count=args["count"], start_at=args["start_at"], records=True)
+      return stream_json_list(bfs, binfile_to_dict)
+    try:
+      bfs, next_cursor = self.fp.page_files(uid=os.getuid(), count=args["count"], cursor=args["cursor"], records=True)
+    except FPLInvalidCursor:
+      abort(400, message="invalid cursor")
+    headers = {}
+    if next_cursor is not None:
+      headers["X-Next-Cursor"] = next_cursor
+    return [binfile_to_dict(bf) for bf in bfs], 200, headers
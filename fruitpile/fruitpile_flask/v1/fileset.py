@@ -17,15 +17,13 @@
 from __future__ import print_function
 from flask_restful import reqparse, fields, marshal_with
 from ..api_utils import FruitpileResource
-from ...fp_ops import Fruitpile
 import os
 
 
 class FruitpileFileset(FruitpileResource):
   def __init__(self, **kwargs):
-    self.fp = Fruitpile(kwargs["fppath"])
-    self.fp.open()
-    super(FruitpileFilesets,self).__init__()
+    self.fp = kwargs["service"].fp
+    super(FruitpileFileset,self).__init__()
 
   def get(self, id):
     pass
@@ -15,30 +15,41 @@
 # You should have received a copy of the GNU General Public License
 # along with Fruitpile.  If not, see <http://www.gnu.org/licenses/>.
 from __future__ import print_function
-from flask_restful import reqparse, fields, marshal_with
-from ..api_utils import FruitpileResource
-from ...fp_ops import Fruitpile
+from flask_restful import reqparse, fields, marshal_with, abort
+from ..api_utils import FruitpileResource, stream_json_list
+from ...fp_exc import FPLInvalidCursor
 import os
 
 
+def fileset_to_dict(fs):
+  return {"fileset_id":fs.id,
+          "name":fs.name,
+          "version":fs.version,
+          "revision":fs.revision,
+          "repo":fs.repo_name}
+
 class FruitpileFilesets(FruitpileResource):
   def __init__(self, **kwargs):
-    self.fp = Fruitpile(kwargs["fppath"])
-    self.fp.open()
+    self.fp = kwargs["service"].fp
     super(FruitpileFilesets,self).__init__()
 
   def get(self):
     parser = reqparse.RequestParser()
-    parser.add_argument('count', type=int, help='number of files to return in one block')
-    parser.add_argument('start_at', type=int, help='position to start at')
+    parser.add_argument('count', type=int, help='number of files to return in one block', location='args')
+    parser.add_argument('start_at', type=int, help='position to start at', location='args')
+    parser.add_argument('cursor', help='cursor returned in X-Next-Cursor by the previous page', location='args')
     args = parser.parse_args()
-    fss = self.fp.list_filesets(uid=os.getuid(), count=args["count"], start_at=args["start_at"])
-    fsss = [{"fileset_id":fs.id,
-             "name":fs.name,
-             "version":fs.version,
-             "revision":fs.revision,
-             "repo":fs.repo.name} for fs in fss]
-    return fsss
+    if args["cursor"] is None:
+      fss = self.fp.iter_filesets(uid=os.getuid(), count=args["count"], start_at=args["start_at"], records=True)
+      return stream_json_list(fss, fileset_to_dict)
+    try:
+      fss, next_cursor = self.fp.page_filesets(uid=os.getuid(), count=args["count"], cursor=args["cursor"], records=True)
+    except FPLInvalidCursor:
+      abort(400, message="invalid cursor")
+    headers = {}
+    if next_cursor is not None:
+      headers["X-Next-Cursor"] = next_cursor
+    return [fileset_to_dict(fs) for fs in fss], 200, headers
 
   new_fs_fields = { 'id': fields.Integer, 'url': fields.Url("fileset") }
 
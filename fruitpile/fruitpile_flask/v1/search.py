@@ -0,0 +1,95 @@
+# -*- mode: python -*-
+# Copyright (c) 2016 Dominic Binks (software-fool on github)
+# This file is part of Fruitpile.
+#
+# Fruitpile is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fruitpile is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fruitpile.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import print_function
+from flask_restful import reqparse, abort
+from ..api_utils import FruitpileResource
+from ...fp_ops import parse_date, parse_properties
+from ...fp_exc import FPLInvalidCursor, FPLUnknownState
+from .files import binfile_to_dict
+from .filesets import fileset_to_dict
+import os
+
+def search_parser():
+  parser = reqparse.RequestParser()
+  parser.add_argument('namePattern', help='shell style pattern the name must match', location='args')
+  parser.add_argument('tag', action='append', help='tag to match, may be repeated', location='args')
+  parser.add_argument('property', action='append', help='name=value or name of a property to match, may be repeated', location='args')
+  parser.add_argument('size', type=int, help='number of results to return', location='args')
+  parser.add_argument('cursor', help='cursor returned in X-Next-Cursor by the previous page', location='args')
+  return parser
+
+def paged_response(items, next_cursor, to_dict):
+  headers = {}
+  if next_cursor is not None:
+    headers["X-Next-Cursor"] = next_cursor
+  return [to_dict(item) for item in items], 200, headers
+
+class FruitpileFilesSearch(FruitpileResource):
+  def __init__(self, **kwargs):
+    self.fp = kwargs["service"].fp
+    super(FruitpileFilesSearch,self).__init__()
+
+  def get(self):
+    parser = search_parser()
+    parser.add_argument('state', help='state the files must be in', location='args')
+    parser.add_argument('fileset_id', type=int, help='fileset the files must be in', location='args')
+    parser.add_argument('source', help='where the files must have come from', location='args')
+    parser.add_argument('since', type=parse_date, help='only files added at or after this time', location='args')
+    parser.add_argument('until', type=parse_date, help='only files added before this time', location='args')
+    args = parser.parse_args()
+    try:
+      bfs, next_cursor = self.fp.search_files(uid=os.getuid(),
+                                              name_pattern=args["namePattern"],
+                                              tags=args["tag"],
+                                              properties=parse_properties(args["property"]),
+                                              state=args["state"],
+                                              fileset_id=args["fileset_id"],
+                                              source=args["source"],
+                                              since=args["since"],
+                                              until=args["until"],
+                                              count=args["size"],
+                                              cursor=args["cursor"],
+                                              records=True)
+    except FPLInvalidCursor:
+      abort(400, message="invalid cursor")
+    except FPLUnknownState:
+      abort(400, message="unknown state %s" % (args["state"]))
+    return paged_response(bfs, next_cursor, binfile_to_dict)
+
+class FruitpileFilesetsSearch(FruitpileResource):
+  def __init__(self, **kwargs):
+    self.fp = kwargs["service"].fp
+    super(FruitpileFilesetsSearch,self).__init__()
+
+  def get(self):
+    parser = search_parser()
+    parser.add_argument('version', help='version the filesets must have', location='args')
+    parser.add_argument('revision', help='revision the filesets must have', location='args')
+    args = parser.parse_args()
+    try:
+      fss, next_cursor = self.fp.search_filesets(uid=os.getuid(),
+                                                 name_pattern=args["namePattern"],
+                                                 tags=args["tag"],
+                                                 properties=parse_properties(args["property"]),
+                                                 version=args["version"],
+                                                 revision=args["revision"],
+                                                 count=args["size"],
+                                                 cursor=args["cursor"],
+                                                 records=True)
+    except FPLInvalidCursor:
+      abort(400, message="invalid cursor")
+    return paged_response(fss, next_cursor, fileset_to_dict)
@@ -0,0 +1,161 @@
+# Copyright (c) 2016 Dominic Binks (software-fool on github)
+# This file is part of Fruitpile.
+#
+# Fruitpile is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fruitpile is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fruitpile.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import print_function
+from flask import request, url_for
+from flask_restful import reqparse, inputs, abort
+from werkzeug.http import parse_content_range_header
+from ..api_utils import FruitpileResource
+from .files import binfile_to_dict
+from ...fp_ops import FileRecord
+from ...fp_exc import FPLBinFileExists, FPLInvalidPath, FPLUploadNotFound, FPLUploadOffsetMismatch, FPLUploadLengthMismatch
+import os
+
+
+def new_file_args():
+  parser = reqparse.RequestParser()
+  parser.add_argument('name', required=True, help='Name of the file', location='args')
+  parser.add_argument('path', default='', help='Path to the file in the repo fileset', location='args')
+  parser.add_argument('primary', type=inputs.boolean, default=True, help='Whether this is a primary file', location='args')
+  parser.add_argument('source', help='Origin of the file', location='args')
+  args = parser.parse_args()
+  if args["source"] is None:
+    args["source"] = request.remote_addr
+  return args
+
+def added_file(bf):
+  d = binfile_to_dict(FileRecord.from_binfile(bf))
+  d["id"] = bf.id
+  d["checksum"] = bf.checksum
+  return d, 201, {"Location": url_for("file", id=bf.id)}
+
+def check_fileset(fp, fileset_id):
+  if fp.get_fileset(uid=os.getuid(), fileset_id=fileset_id) == []:
+    abort(404, message="fileset {} not found".format(fileset_id))
+
+
+class FruitpileFilesetFiles(FruitpileResource):
+  def __init__(self, **kwargs):
+    self.fp = kwargs["service"].fp
+    super(FruitpileFilesetFiles,self).__init__()
+
+  def post(self, id):
+    # The request body is the file, it is hashed and written to the repo
+    # as it is read so it is never held in memory or staged on disk
+    args = new_file_args()
+    check_fileset(self.fp, id)
+    try:
+      bf = self.fp.add_file(uid=os.getuid(),
+                            source_fob=request.stream,
+                            fileset_id=id,
+                            name=args["name"],
+                            path=args["path"],
+                            primary=args["primary"],
+                            source=args["source"])
+    except FPLBinFileExists:
+      abort(409, message="file {} already exists in fileset {}".format(args["name"], id))
+    except FPLInvalidPath as exc:
+      abort(400, message=str(exc))
+    return added_file(bf)
+
+
+class FruitpileFilesetUploads(FruitpileResource):
+  def __init__(self, **kwargs):
+    self.fp = kwargs["service"].fp
+    super(FruitpileFilesetUploads,self).__init__()
+
+  def post(self, id):
+    # Start a resumable upload, the parts are sent to the upload's url
+    args = new_file_args()
+    check_fileset(self.fp, id)
+    try:
+      upload_id = self.fp.start_upload(uid=os.getuid(),
+                                       fileset_id=id,
+                                       name=args["name"],
+                                       path=args["path"],
+                                       primary=args["primary"],
+                                       source=args["source"])
+    except FPLInvalidPath as exc:
+      abort(400, message=str(exc))
+    return ({"upload_id":upload_id, "offset":0}, 201,
+            {"Location": url_for("upload", upload_id=upload_id)})
+
+
+def upload_status(upload_id, offset, status=200):
+  headers = {}
+  if offset > 0:
+    headers["Range"] = "bytes=0-{}".format(offset - 1)
+  return {"upload_id":upload_id, "offset":offset}, status, headers
+
+class FruitpileUpload(FruitpileResource):
+  def __init__(self, **kwargs):
+    self.fp = kwargs["service"].fp
+    super(FruitpileUpload,self).__init__()
+
+  def get(self, upload_id):
+    # How much has been received, so a client knows where to resume
+    try:
+      return upload_status(upload_id, self.fp.upload_offset(uid=os.getuid(), upload_id=upload_id))
+    except FPLUploadNotFound:
+      abort(404, message="upload {} not found".format(upload_id))
+
+  def put(self, upload_id):
+    # Each part is sent with Content-Range: bytes START-END/TOTAL, where
+    # START must be the current offset.  TOTAL can be * until it is known.
+    # When all TOTAL bytes have arrived the file is added to the fileset.
+    # "bytes */TOTAL" with no body just completes the upload.
+    crange = None
+    if "Content-Range" in request.headers:
+      crange = parse_content_range_header(request.headers["Content-Range"])
+      if crange is None:
+        abort(400, message="invalid Content-Range")
+    try:
+      offset = self.fp.upload_offset(uid=os.getuid(), upload_id=upload_id)
+      if crange is not None and crange.start is not None:
+        # only the bytes the range covers are taken from the body
+        offset = self.fp.append_upload(uid=os.getuid(),
+                                       upload_id=upload_id,
+                                       offset=crange.start,
+                                       length=crange.stop - crange.start,
+                                       source_fob=request.stream)
+      elif crange is None:
+        offset = self.fp.append_upload(uid=os.getuid(),
+                                       upload_id=upload_id,
+                                       offset=offset,
+                                       source_fob=request.stream)
+      total = offset if crange is None else crange.length
+      if total is None or offset < total:
+        return upload_status(upload_id, offset, 202)
+      if offset > total:
+        abort(400, message="upload {} is longer than {} bytes".format(upload_id, total))
+      bf = self.fp.finish_upload(uid=os.getuid(), upload_id=upload_id)
+    except FPLUploadNotFound:
+      abort(404, message="upload {} not found".format(upload_id))
+    except FPLUploadLengthMismatch:
+      abort(400, message="body does not match Content-Range")
+    except FPLUploadOffsetMismatch as exc:
+      body, status, headers = upload_status(upload_id, exc.offset, 409)
+      return dict(body, message="upload resumes at offset {}".format(exc.offset)), status, headers
+    except FPLBinFileExists:
+      self.fp.cancel_upload(uid=os.getuid(), upload_id=upload_id)
+      abort(409, message="file already exists in the fileset")
+    return added_file(bf)
+
+  def delete(self, upload_id):
+    try:
+      self.fp.cancel_upload(uid=os.getuid(), upload_id=upload_id)
+    except FPLUploadNotFound:
+      abort(404, message="upload {} not found".format(upload_id))
+    return "", 204
@@ -13,3 +13,10 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with Fruitpile.  If not, see <http://www.gnu.org/licenses/>.
+
+from .filemanager import FileManager
+from .blobstore import BlobStore
+
+# Maps the Repo.repo_type column to the class which manages that repo
+REPO_TYPES = {"FileManager": FileManager,
+              "BlobStore": BlobStore}
@@ -0,0 +1,72 @@
+# Copyright (c) 2016 Dominic Binks (software-fool on github)
+# This file is part of Fruitpile.
+#
+# Fruitpile is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fruitpile is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fruitpile.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import logging
+import uuid
+from .filemanager import FileManager
+from .compression import CODECS
+
+logger = logging.getLogger(__name__)
+
+class BlobStore(FileManager):
+  # A content addressed store.  Blobs are keyed by their checksum so
+  # identical artifacts are only ever stored once no matter how many
+  # filesets they appear in.  The logical path of a file is only kept
+  # in the database.
+
+  BLOB_DIR = "blobs"
+  TMP_DIR = os.path.join(BLOB_DIR, ".tmp")
+
+  def __init__(self, repopath, compression="gzip"):
+    super(BlobStore, self).__init__(repopath, compression)
+
+  def blob_path(self, checksum, ztype=None):
+    # compressed blobs get the codec's suffix so the same contents
+    # stored both ways don't collide
+    suffix = CODECS[ztype].suffix if ztype else ""
+    return os.path.join(self.BLOB_DIR, checksum[:2], checksum[2:4], checksum + suffix)
+
+  def locate(self, bf):
+    return self.blob_path(bf.checksum, bf.ztype)
+
+  def has_blob(self, checksum, ztype=None):
+    return os.path.exists(os.path.join(self.repopath, self.blob_path(checksum, ztype)))
+
+  def ingest(self, path, srcfob, hasher):
+    # The key is not known until the data has been read so the blob is
+    # written to a temporary file and moved into place once the checksum
+    # is known.  If the blob is already in the store the copy is simply
+    # thrown away.
+    tmppath = os.path.join(self.TMP_DIR, uuid.uuid4().hex)
+    tmpdest = os.path.join(self.repopath, tmppath)
+    try:
+      stats = self._ingest_to(tmppath, os.path.basename(path), srcfob, hasher)
+    except Exception:
+      if os.path.exists(tmpdest):
+        os.remove(tmpdest)
+      raise
+    dest = os.path.join(self.repopath, self.blob_path(stats.checksum, stats.ztype))
+    if os.path.exists(dest):
+      os.remove(tmpdest)
+      logger.debug("blob %s for %s already in store" % (stats.checksum, path))
+    else:
+      blobdir = os.path.dirname(dest)
+      if not os.path.isdir(blobdir):
+        os.makedirs(blobdir, 0o700, exist_ok=True)
+      os.rename(tmpdest, dest)
+      logger.debug("ingested %s as blob %s: %d bytes in %.3fs (%.0f bytes/s)" % (path, stats.checksum, stats.size, stats.elapsed, stats.rate))
+    return stats
@@ -0,0 +1,150 @@
+# Copyright (c) 2016 Dominic Binks (software-fool on github)
+# This file is part of Fruitpile.
+#
+# Fruitpile is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fruitpile is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fruitpile.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import io
+import zlib
+import lzma
+
+# Largest piece of decompressed data produced at once so a small, very
+# compressible input can't balloon in memory
+CHUNK_OUT = 1024*1024
+
+# Streaming codecs the repo can use to store files, the name is what is
+# recorded in BinFile.ztype
+class GzipCodec(object):
+  name = "gzip"
+  suffix = ".gz"
+
+  def compressor(self):
+    # wbits=31 writes a gzip header so stored files can be read with
+    # the standard tools
+    return zlib.compressobj(6, zlib.DEFLATED, 31)
+
+  def decompress(self, chunks):
+    d = zlib.decompressobj(31)
+    for chunk in chunks:
+      data = d.decompress(chunk, CHUNK_OUT)
+      while data:
+        yield data
+        data = d.decompress(d.unconsumed_tail, CHUNK_OUT)
+    data = d.flush()
+    if data:
+      yield data
+
+class XzCodec(object):
+  name = "xz"
+  suffix = ".xz"
+
+  def compressor(self):
+    return lzma.LZMACompressor()
+
+  def decompress(self, chunks):
+    d = lzma.LZMADecompressor()
+    for chunk in chunks:
+      data = d.decompress(chunk, CHUNK_OUT)
+      while True:
+        if data:
+          yield data
+        if d.eof or d.needs_input:
+          break
+        data = d.decompress(b"", CHUNK_OUT)
+
+CODECS = {"gzip": GzipCodec(), "xz": XzCodec()}
+
+# Leading bytes of formats that are already compressed
+COMPRESSED_MAGIC = [b"\x1f\x8b",            # gzip
+                    b"BZh",                 # bzip2
+                    b"\xfd7zXZ\x00",        # xz
+                    b"\x28\xb5\x2f\xfd",    # zstd
+                    b"PK\x03\x04",          # zip, jar, whl, apk, docx
+                    b"7z\xbc\xaf\x27\x1c",  # 7z
+                    b"\x89PNG",             # png
+                    b"\xff\xd8\xff",        # jpeg
+                    b"GIF8",                # gif
+                    b"\x5d\x00\x00"]        # lzma
+
+COMPRESSED_EXTENSIONS = set([".gz", ".tgz", ".bz2", ".tbz2", ".xz", ".txz",
+                             ".zst", ".zip", ".jar", ".war", ".whl", ".apk",
+                             ".7z", ".rar", ".png", ".jpg", ".jpeg", ".gif",
+                             ".mp3", ".mp4", ".deb", ".rpm", ".dmg", ".lz4"])
+
+# Only compress when a sample shrinks to at most this fraction of its size
+MIN_SAVING = 0.9
+
+def choose_codec(name, head, codec):
+  # Decide from the file name and the first block of data whether the
+  # file is worth compressing with codec.  Returns the codec or None.
+  if codec is None or not head:
+    return None
+  if os.path.splitext(name)[1].lower() in COMPRESSED_EXTENSIONS:
+    return None
+  for magic in COMPRESSED_MAGIC:
+    if head.startswith(magic):
+      return None
+  # a quick low effort compression of the sample tells us whether the
+  # data is compressible, random or encrypted data won't be
+  sample = head[:64*1024]
+  if len(zlib.compress(sample, 1)) > len(sample) * MIN_SAVING:
+    return None
+  return CODECS[codec]
+
+def _read_chunks(fob, chunk_size):
+  while True:
+    chunk = fob.read(chunk_size)
+    if not chunk:
+      break
+    yield chunk
+
+class DecompressingReader(object):
+  # Read only file handler for a compressed file in the repo that gives
+  # back the original contents.  It can't seek.
+
+  def __init__(self, path, codec, chunk_size=CHUNK_OUT):
+    self.path = path
+    self.codec = CODECS[codec]
+    self.chunk_size = chunk_size
+    self.fob = io.open(path, "rb")
+    self._data = self.codec.decompress(_read_chunks(self.fob, chunk_size))
+    self._buf = b""
+    self._size = None
+    self.is_open = True
+
+  def read(self, n=None):
+    if not self.is_open:
+      raise IOError("file not open")
+    while n is None or len(self._buf) < n:
+      try:
+        self._buf += next(self._data)
+      except StopIteration:
+        break
+    if n is None:
+      data, self._buf = self._buf, b""
+    else:
+      data, self._buf = self._buf[:n], self._buf[n:]
+    return data
+
+  def size(self):
+    # The size of the original contents, which means decompressing the
+    # whole file once
+    if self._size is None:
+      with io.open(self.path, "rb") as fob:
+        self._size = sum([len(d) for d in self.codec.decompress(_read_chunks(fob, self.chunk_size))])
+    return self._size
+
+  def close(self):
+    self.fob.close()
+    self.is_open = False
@@ -15,11 +15,136 @@
 # along with Fruitpile.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import errno
 import logging
 import io
+import time
+import shutil
+from collections import namedtuple
+from .compression import choose_codec, DecompressingReader
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
 
 logger = logging.getLogger(__name__)
 
+CHUNK_SIZE = 1024*1024
+
+class IngestStats(namedtuple("IngestStats", ["checksum", "size", "elapsed", "ztype"])):
+  # size is the size of the original data, ztype the compression used
+  # to store it (if any)
+  __slots__ = ()
+
+  def __new__(cls, checksum, size, elapsed, ztype=None):
+    return super(IngestStats, cls).__new__(cls, checksum, size, elapsed, ztype)
+
+  @property
+  def rate(self):
+    # bytes per second, guarding against very small files being copied
+    # faster than the clock resolution
+    if self.elapsed <= 0:
+      return float(self.size)
+    return self.size / self.elapsed
+
+def copy_and_checksum(srcfob, snkfob, hasher, chunk_size=CHUNK_SIZE, head=b"", codec=None):
+  # Copy srcfob to snkfob computing the checksum of the data on the way
+  # through so the source only needs to be read once.  srcfob can be any
+  # object with a read method, it does not need to be seekable.  head is
+  # data already read from srcfob.  With a codec the data is compressed
+  # as it is written, the checksum is always of the original data.
+  m = hasher()
+  size = 0
+  start = time.time()
+  z = codec.compressor() if codec is not None else None
+  chunk = head
+  while True:
+    if not chunk:
+      chunk = srcfob.read(chunk_size)
+      if not chunk:
+        break
+    m.update(chunk)
+    snkfob.write(z.compress(chunk) if z is not None else chunk)
+    size += len(chunk)
+    chunk = None
+  if z is not None:
+    snkfob.write(z.flush())
+  return IngestStats(checksum=m.hexdigest(), size=size, elapsed=time.time() - start,
+                     ztype=codec.name if codec is not None else None)
+
+# ioctl to share the source's extents with the destination on filesystems
+# that support it (btrfs, xfs)
+FICLONE = 0x40049409
+
+# The ways of copying a file out of the store, fastest first
+COPY_METHODS = ("reflink", "copy_file_range", "sendfile", "copy")
+
+# errors meaning a copy method isn't available for these files, so the
+# next one should be tried
+_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.ENOTTY,
+                errno.EOPNOTSUPP, errno.EBADF, errno.EPERM)
+
+def _reflink(srcfd, snkfd, size):
+  if fcntl is None:
+    raise OSError(errno.ENOSYS, "reflink not available")
+  fcntl.ioctl(snkfd, FICLONE, srcfd)
+
+def _copy_file_range(srcfd, snkfd, size):
+  if not hasattr(os, "copy_file_range"):
+    raise OSError(errno.ENOSYS, "copy_file_range not available")
+  offset = 0
+  while offset < size:
+    n = os.copy_file_range(srcfd, snkfd, size - offset, offset, offset)
+    if n == 0:
+      break
+    offset += n
+
+def _sendfile(srcfd, snkfd, size):
+  if not hasattr(os, "sendfile"):
+    raise OSError(errno.ENOSYS, "sendfile not available")
+  offset = 0
+  while offset < size:
+    n = os.sendfile(snkfd, srcfd, offset, min(size - offset, 1 << 30))
+    if n == 0:
+      break
+    offset += n
+
+def _copy(srcfd, snkfd, size):
+  while True:
+    chunk = os.read(srcfd, CHUNK_SIZE)
+    if not chunk:
+      break
+    # os.write can write less than it was given, on a nearly full disk
+    # for example, so keep going until all of the chunk is written
+    view = memoryview(chunk)
+    while view:
+      view = view[os.write(snkfd, view):]
+
+_COPY_FNS = {"reflink": _reflink,
+             "copy_file_range": _copy_file_range,
+             "sendfile": _sendfile,
+             "copy": _copy}
+
+def copy_file(srcfd, snkfd, methods=COPY_METHODS):
+  # Copy the whole of the file open on srcfd to snkfd using the first
+  # of methods the kernel and filesystem will do for these files, so the
+  # data doesn't pass through the interpreter unless it has to.
+  # Returns the name of the method used.
+  size = os.fstat(srcfd).st_size
+  for method in methods:
+    try:
+      _COPY_FNS[method](srcfd, snkfd, size)
+      return method
+    except OSError as exc:
+      if exc.errno not in _UNSUPPORTED:
+        raise
+      logger.debug("%s copy unavailable: %s" % (method, exc))
+      # start again from the beginning in case some data was copied
+      os.lseek(srcfd, 0, os.SEEK_SET)
+      os.lseek(snkfd, 0, os.SEEK_SET)
+      os.ftruncate(snkfd, 0)
+  raise IOError("no copy method available")
+
 class FileHandler(object):
 
   def __init__(self, fob):
@@ -44,24 +169,92 @@ class FileHandler(object):
       data = self.fob.read()
     return data
 
+  def seek(self, offset, whence=os.SEEK_SET):
+    if not self.is_open:
+      raise IOError("file not open")
+    return self.fob.seek(offset, whence)
+
+  def tell(self):
+    return self.fob.tell()
+
+  def fileno(self):
+    return self.fob.fileno()
+
+  def size(self):
+    return os.fstat(self.fob.fileno()).st_size
+
   @staticmethod
   def create_file(path, mode):
     return FileHandler(io.open(path, 'b'+mode))
 
 
 class FileManager(object):
-  def __init__(self, repopath):
+  # compression is the codec (see compression.CODECS) used for files
+  # that are worth compressing, None stores everything as it is
+  def __init__(self, repopath, compression="gzip"):
     self.repopath = repopath
+    self.compression = compression
 
   def open(self, path, mode):
     dest = os.path.join(self.repopath, path)
     logger.debug("opening file %s with mode %s" % (path, mode))
     filedir = os.path.dirname(dest)
     if not os.path.isdir(filedir):
-      os.makedirs(filedir, 0o700)
+      os.makedirs(filedir, 0o700, exist_ok=True)
     fh = FileHandler.create_file(dest, mode)
     return fh
 
+  def locate(self, bf):
+    # Where in the repo the contents of the binfile are kept
+    return os.path.join(bf.path, bf.name)
+
+  def _ingest_to(self, path, name, srcfob, hasher):
+    # Write srcfob to path choosing from the first block and the name
+    # whether to compress it
+    head = srcfob.read(CHUNK_SIZE)
+    codec = choose_codec(name, head, self.compression)
+    fh = self.open(path, "w")
+    try:
+      return copy_and_checksum(srcfob, fh, hasher, head=head, codec=codec)
+    finally:
+      fh.close()
+
+  def ingest(self, path, srcfob, hasher):
+    stats = self._ingest_to(path, os.path.basename(path), srcfob, hasher)
+    logger.debug("ingested %s: %d bytes in %.3fs (%.0f bytes/s)" % (path, stats.size, stats.elapsed, stats.rate))
+    return stats
+
+  def discard(self, bf):
+    # Remove the contents of a binfile that was never recorded
+    try:
+      os.remove(os.path.join(self.repopath, self.locate(bf)))
+    except FileNotFoundError:
+      pass
+
+  def open_content(self, path, ztype=None):
+    # Open the file at path for reading its original contents
+    if ztype:
+      return DecompressingReader(os.path.join(self.repopath, path), ztype)
+    return self.open(path, "r")
+
+  def export(self, path, to_file, ztype=None):
+    # Copy the file at path in the repo to to_file outside of it,
+    # returns the copy method used
+    if ztype:
+      # compressed files have to come through here to be decompressed
+      srcfob = self.open_content(path, ztype)
+      try:
+        with io.open(to_file, "wb") as snkfob:
+          shutil.copyfileobj(srcfob, snkfob, CHUNK_SIZE)
+      finally:
+        srcfob.close()
+      return "decompress"
+    with io.open(os.path.join(self.repopath, path), "rb") as srcfob:
+      with io.open(to_file, "wb") as snkfob:
+        method = copy_file(srcfob.fileno(), snkfob.fileno())
+    logger.debug("exported %s to %s using %s" % (path, to_file, method))
+    return method
+
   def close(self):
     # nothing to do
     pass
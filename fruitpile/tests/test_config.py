@@ -0,0 +1,192 @@
+# Copyright (c) 2016 Dominic Binks (software-fool on github)
+# This file is part of Fruitpile.
+#
+# Fruitpile is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fruitpile is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fruitpile.  If not, see <http://www.gnu.org/licenses/>.
+import unittest
+import os
+import sqlite3
+from configparser import ConfigParser
+
+from sqlalchemy import create_engine
+
+from fruitpile import Fruitpile, FPLConfiguration, FPLExists
+from fruitpile.db.schema import Base
+from fruitpile.fp_config import CONFIG_FILE, SQLITE_DEFAULTS, load_config, sqlite_pragmas
+from fruitpile.tests.test_fruitpile import clear_tree
+
+
+class TestStoreConfig(unittest.TestCase):
+
+  def setUp(self):
+    self.store_path = "/tmp/store%d" % (os.getpid())
+    clear_tree(self.store_path)
+    fp = Fruitpile(self.store_path)
+    fp.init(uid=1046, username="db")
+    fp.session.close()
+    fp.engine.dispose()
+    self.cfgpath = os.path.join(self.store_path, CONFIG_FILE)
+
+  def tearDown(self):
+    clear_tree(self.store_path)
+
+  def _write_sqlite_config(self, **settings):
+    config = ConfigParser()
+    config.read(self.cfgpath)
+    for name, value in settings.items():
+      config.set("sqlite", name, value)
+    with open(self.cfgpath, "w") as f:
+      config.write(f)
+
+  def _pragma(self, fp, name):
+    conn = fp.session.connection()
+    return conn.exec_driver_sql("PRAGMA %s" % (name)).scalar()
+
+  def test_init_writes_default_config(self):
+    self.assertTrue(os.path.exists(self.cfgpath))
+    config = ConfigParser()
+    config.read(self.cfgpath)
+    self.assertEqual(config.items("sqlite"), SQLITE_DEFAULTS)
+
+  def test_open_applies_pragmas(self):
+    fp = Fruitpile(self.store_path)
+    fp.open()
+    self.assertEqual(self._pragma(fp, "journal_mode"), "wal")
+    self.assertEqual(self._pragma(fp, "synchronous"), 1)
+    self.assertEqual(self._pragma(fp, "busy_timeout"), 5000)
+    self.assertEqual(self._pragma(fp, "cache_size"), -16000)
+    self.assertEqual(self._pragma(fp, "temp_store"), 2)
+    fp.close()
+
+  def test_open_applies_configured_pragmas(self):
+    self._write_sqlite_config(journal_mode="delete", synchronous="full", busy_timeout="250")
+    fp = Fruitpile(self.store_path)
+    fp.open(scoped=True)
+    self.assertEqual(self._pragma(fp, "journal_mode"), "delete")
+    self.assertEqual(self._pragma(fp, "synchronous"), 2)
+    self.assertEqual(self._pragma(fp, "busy_timeout"), 250)
+    fp.close()
+
+  def test_open_without_config_file(self):
+    os.unlink(self.cfgpath)
+    fp = Fruitpile(self.store_path)
+    fp.open()
+    self.assertEqual(self._pragma(fp, "journal_mode"), "wal")
+    fp.close()
+
+  def test_invalid_values(self):
+    for name, value in [("journal_mode", "sideways"), ("busy_timeout", "soon"), ("synchronous", "1; DROP TABLE users")]:
+      self._write_sqlite_config(**{name: value})
+      with self.assertRaises(FPLConfiguration):
+        sqlite_pragmas(load_config(self.store_path))
+      self._write_sqlite_config(**dict(SQLITE_DEFAULTS))
+
+  def test_unreadable_config_file(self):
+    with open(self.cfgpath, "w") as f:
+      f.write("not an ini file\n")
+    fp = Fruitpile(self.store_path)
+    with self.assertRaises(FPLConfiguration):
+      fp.open()
+
+  def test_reader_not_blocked_by_writer(self):
+    fp = Fruitpile(self.store_path)
+    fp.open()
+    fp.add_new_fileset(uid=1046, name="fs1", version="1", revision="1")
+    writer = sqlite3.connect(os.path.join(self.store_path, "fpl.db"), timeout=0)
+    writer.execute("BEGIN IMMEDIATE")
+    writer.execute("INSERT INTO filesets (name, version, revision, repo_id) VALUES ('fs2', '1', '1', 1)")
+    self.assertEqual([fs.name for fs in fp.list_filesets(uid=1046)], ["fs1"])
+    writer.rollback()
+    writer.close()
+    fp.close()
+
+
+# Set FRUITPILE_TEST_DB_URL (e.g. to postgresql://localhost/fruitpile_test)
+# to run these against a database server; the tables are dropped after
+# each test.  Otherwise a sqlite database outside the store stands in.
+TEST_DB_URL = os.environ.get("FRUITPILE_TEST_DB_URL")
+
+class TestExternalDatabase(unittest.TestCase):
+
+  def setUp(self):
+    self.store_path = "/tmp/store%d" % (os.getpid())
+    self.node_path = "/tmp/node%d" % (os.getpid())
+    self.repo_path = "/tmp/repo%d" % (os.getpid())
+    self.db_file = "/tmp/fpldb%d.db" % (os.getpid())
+    self.db_url = TEST_DB_URL or "sqlite:///%s" % (self.db_file)
+    self._clear()
+    self.fp = Fruitpile(self.store_path)
+    self.fp.init(uid=1046, username="db", db_url=self.db_url, repo_path=self.repo_path)
+    self.fp.session.close()
+    self.fp.engine.dispose()
+
+  def tearDown(self):
+    self._clear()
+
+  def _clear(self):
+    for path in [self.store_path, self.node_path, self.repo_path]:
+      clear_tree(path)
+    if TEST_DB_URL:
+      engine = create_engine(TEST_DB_URL)
+      Base.metadata.drop_all(bind=engine)
+      engine.dispose()
+    elif os.path.exists(self.db_file):
+      os.unlink(self.db_file)
+
+  def test_init_records_database_and_repo(self):
+    config = load_config(self.store_path)
+    self.assertEqual(config.get("database", "url"), self.db_url)
+    self.assertEqual(config.get("repo", "path"), self.repo_path)
+    self.assertFalse(os.path.exists(os.path.join(self.store_path, "fpl.db")))
+    self.assertTrue(os.path.isdir(self.repo_path))
+
+  def test_files_kept_in_repo_path(self):
+    fp = Fruitpile(self.store_path)
+    fp.open()
+    fs = fp.add_new_fileset(uid=1046, name="fs1", version="1", revision="1")
+    bf = fp.add_file(uid=1046, source_file="requirements.txt", fileset_id=fs.id,
+                     name="requirements.txt", path="deploy", primary=True, source="buildbot")
+    self.assertTrue(os.path.exists(os.path.join(self.repo_path, fp.repo.locate(bf))))
+    self.assertEqual(os.listdir(self.store_path), [CONFIG_FILE])
+    fp.close()
+
+  def test_stores_share_database(self):
+    os.mkdir(self.node_path)
+    with open(os.path.join(self.store_path, CONFIG_FILE)) as src:
+      with open(os.path.join(self.node_path, CONFIG_FILE), "w") as dst:
+        dst.write(src.read())
+    fp1 = Fruitpile(self.store_path)
+    fp1.open()
+    fp2 = Fruitpile(self.node_path)
+    fp2.open(scoped=True)
+    fp1.add_new_fileset(uid=1046, name="fs1", version="1", revision="1")
+    self.assertEqual([fs.name for fs in fp2.list_filesets(uid=1046)], ["fs1"])
+    fp2.close()
+    fp1.close()
+
+  def test_init_on_database_in_use(self):
+    fp = Fruitpile(self.node_path)
+    with self.assertRaises(FPLExists):
+      fp.init(uid=1046, username="db", db_url=self.db_url)
+    self.assertFalse(os.path.exists(self.node_path))
+
+  def test_bad_database_url(self):
+    for url in ["not a url", "nosuchdb://localhost/fpl"]:
+      fp = Fruitpile(self.node_path)
+      with self.assertRaises(FPLConfiguration):
+        fp.init(uid=1046, username="db", db_url=url)
+      self.assertFalse(os.path.exists(self.node_path))
+
+
+if __name__ == "__main__":
+  unittest.main()
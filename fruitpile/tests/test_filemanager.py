@@ -16,8 +16,11 @@
 import unittest
 import os.path
 import io
+import gzip
+from hashlib import sha256
+from unittest import mock
 
-from fruitpile.repo.filemanager import FileHandler
+from fruitpile.repo.filemanager import FileHandler, FileManager, copy_and_checksum, copy_file, COPY_METHODS
 
 mydir = os.path.dirname(__file__)
 
@@ -72,5 +75,149 @@ class TestFileHandler(unittest.TestCase):
       fh.read()
 
 
+class TestFileManagerIngest(unittest.TestCase):
+
+  def setUp(self):
+    self.repopath = "/tmp/test_filemanager.%d" % (os.getpid())
+
+  def tearDown(self):
+    for root, dirs, files in os.walk(self.repopath, topdown=False):
+      for f in files:
+        os.remove(os.path.join(root, f))
+      os.rmdir(root)
+
+  def test_copy_and_checksum(self):
+    contents = b"abcdefghij" * 1000
+    snk = io.BytesIO()
+    stats = copy_and_checksum(io.BytesIO(contents), snk, sha256, chunk_size=64)
+    self.assertEqual(snk.getvalue(), contents)
+    self.assertEqual(stats.checksum, sha256(contents).hexdigest())
+    self.assertEqual(stats.size, len(contents))
+    self.assertGreater(stats.rate, 0)
+
+  def test_ingest_a_stream(self):
+    fm = FileManager(self.repopath)
+    filename = "%s/data/example_file.txt" % (mydir)
+    contents = io.open(filename, "rb").read()
+    stats = fm.ingest("deploy/example.txt", io.BytesIO(contents), sha256)
+    self.assertEqual(stats.checksum, sha256(contents).hexdigest())
+    self.assertEqual(stats.size, len(contents))
+    data = io.open(os.path.join(self.repopath, "deploy/example.txt"), "rb").read()
+    self.assertEqual(data, contents)
+
+
+class TestFileManagerExport(unittest.TestCase):
+
+  def setUp(self):
+    self.repopath = "/tmp/test_filemanager.%d" % (os.getpid())
+    self.to_file = "/tmp/test_export.%d" % (os.getpid())
+    self.contents = os.urandom(3 * 1024 * 1024 + 17)
+    self.fm = FileManager(self.repopath)
+    self.fm.ingest("deploy/blob", io.BytesIO(self.contents), sha256)
+
+  def tearDown(self):
+    for root, dirs, files in os.walk(self.repopath, topdown=False):
+      for f in files:
+        os.remove(os.path.join(root, f))
+      os.rmdir(root)
+    if os.path.exists(self.to_file):
+      os.remove(self.to_file)
+
+  def test_export_a_file(self):
+    method = self.fm.export("deploy/blob", self.to_file)
+    self.assertTrue(method in COPY_METHODS)
+    self.assertEqual(io.open(self.to_file, "rb").read(), self.contents)
+
+  def test_each_copy_method(self):
+    src = os.path.join(self.repopath, "deploy/blob")
+    for method in COPY_METHODS:
+      with io.open(src, "rb") as srcfob, io.open(self.to_file, "wb") as snkfob:
+        try:
+          used = copy_file(srcfob.fileno(), snkfob.fileno(), methods=(method,))
+        except IOError:
+          # not every filesystem can do every method (reflink especially)
+          continue
+      self.assertEqual(used, method)
+      self.assertEqual(io.open(self.to_file, "rb").read(), self.contents)
+
+  def test_falls_back_to_plain_copy(self):
+    src = os.path.join(self.repopath, "deploy/blob")
+    with io.open(src, "rb") as srcfob, io.open(self.to_file, "wb") as snkfob:
+      used = copy_file(srcfob.fileno(), snkfob.fileno(), methods=("reflink", "copy"))
+    self.assertTrue(used in ("reflink", "copy"))
+    self.assertEqual(io.open(self.to_file, "rb").read(), self.contents)
+
+  def test_plain_copy_handles_short_writes(self):
+    src = os.path.join(self.repopath, "deploy/blob")
+    real_write = os.write
+    def short_write(fd, data):
+      return real_write(fd, bytes(data[:100000]))
+    with io.open(src, "rb") as srcfob, io.open(self.to_file, "wb") as snkfob:
+      with mock.patch("os.write", side_effect=short_write):
+        copy_file(srcfob.fileno(), snkfob.fileno(), methods=("copy",))
+    self.assertEqual(io.open(self.to_file, "rb").read(), self.contents)
+
+
+class TestFileManagerCompression(unittest.TestCase):
+
+  def setUp(self):
+    self.repopath = "/tmp/test_filemanager.%d" % (os.getpid())
+    self.to_file = "/tmp/test_export.%d" % (os.getpid())
+    self.text = b"".join([b"line %d of the test log\n" % (i) for i in range(100000)])
+
+  def tearDown(self):
+    for root, dirs, files in os.walk(self.repopath, topdown=False):
+      for f in files:
+        os.remove(os.path.join(root, f))
+      os.rmdir(root)
+    if os.path.exists(self.to_file):
+      os.remove(self.to_file)
+
+  def test_text_is_compressed(self):
+    fm = FileManager(self.repopath)
+    stats = fm.ingest("logs/test.log", io.BytesIO(self.text), sha256)
+    self.assertEqual(stats.ztype, "gzip")
+    self.assertEqual(stats.size, len(self.text))
+    self.assertEqual(stats.checksum, sha256(self.text).hexdigest())
+    stored = os.path.join(self.repopath, "logs/test.log")
+    self.assertLess(os.path.getsize(stored), len(self.text) // 4)
+    self.assertEqual(gzip.open(stored).read(), self.text)
+    fh = fm.open_content("logs/test.log", stats.ztype)
+    self.assertEqual(fh.size(), len(self.text))
+    self.assertEqual(fh.read(10), self.text[:10])
+    self.assertEqual(fh.read(), self.text[10:])
+    fh.close()
+
+  def test_export_decompresses(self):
+    fm = FileManager(self.repopath)
+    stats = fm.ingest("logs/test.log", io.BytesIO(self.text), sha256)
+    self.assertEqual(fm.export("logs/test.log", self.to_file, stats.ztype), "decompress")
+    self.assertEqual(io.open(self.to_file, "rb").read(), self.text)
+
+  def test_xz_codec(self):
+    fm = FileManager(self.repopath, compression="xz")
+    stats = fm.ingest("logs/test.log", io.BytesIO(self.text), sha256)
+    self.assertEqual(stats.ztype, "xz")
+    fh = fm.open_content("logs/test.log", stats.ztype)
+    self.assertEqual(fh.read(), self.text)
+    fh.close()
+
+  def test_compressed_data_is_not_recompressed(self):
+    fm = FileManager(self.repopath)
+    data = gzip.compress(self.text)
+    stats = fm.ingest("logs/test.log.dat", io.BytesIO(data), sha256)
+    self.assertEqual(stats.ztype, None)
+    stats = fm.ingest("logs/random", io.BytesIO(os.urandom(100000)), sha256)
+    self.assertEqual(stats.ztype, None)
+    stats = fm.ingest("logs/test.zip", io.BytesIO(self.text), sha256)
+    self.assertEqual(stats.ztype, None)
+
+  def test_compression_turned_off(self):
+    fm = FileManager(self.repopath, compression=None)
+    stats = fm.ingest("logs/test.log", io.BytesIO(self.text), sha256)
+    self.assertEqual(stats.ztype, None)
+    self.assertEqual(io.open(os.path.join(self.repopath, "logs/test.log"), "rb").read(), self.text)
+
+
 if __name__ == "__main__":
   unittest.main()
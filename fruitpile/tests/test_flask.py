@@ -0,0 +1,350 @@
+# Copyright (c) 2016 Dominic Binks (software-fool on github)
+# This file is part of Fruitpile.
+#
+# Fruitpile is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fruitpile is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fruitpile.  If not, see <http://www.gnu.org/licenses/>.
+import unittest
+import io
+import os
+import json
+from base64 import b64encode
+from hashlib import sha256
+from flask import Flask
+
+from fruitpile import Fruitpile
+from fruitpile.fruitpile_flask import init_api
+
+AUTH = {"Authorization": "Basic %s" % (b64encode(b"fruitpile:Fru1tpi13R").decode("ascii"))}
+
+def clear_tree(path):
+  if os.path.exists(path):
+    for root, dirs, files in os.walk(path, topdown=False):
+      for name in files:
+        os.remove(os.path.join(root, name))
+      for name in dirs:
+        os.rmdir(os.path.join(root, name))
+    os.rmdir(path)
+
+
+class FlaskStore(object):
+  # Builds a store owned by the user running the tests (the api uses the
+  # process's uid) and an app serving it through a test client
+  repo_type = "FileManager"
+
+  def setUp(self):
+    self.store_path = "/tmp/store%d" % (os.getpid())
+    clear_tree(self.store_path)
+    fp = Fruitpile(self.store_path)
+    fp.init(uid=os.getuid(), username="db", repo_type=self.repo_type)
+    fp.open()
+    self.fs = fp.add_new_fileset(uid=os.getuid(), name="test-1", version="1", revision="123")
+    self.fs_id = self.fs.id
+    fp.close()
+    app = Flask(__name__)
+    app.config["FRUITPILE_STORE"] = self.store_path
+    init_api(app)
+    self.service = app.extensions["fruitpile"]
+    self.client = app.test_client()
+
+  def tearDown(self):
+    self.service.close()
+    clear_tree(self.store_path)
+
+  def post_file(self, name, contents, fileset_id=None):
+    rv = self.client.post("/v1/filesets/%d/files" % (fileset_id or self.fs_id),
+                          query_string={"name":name, "path":"deploy", "source":"buildbot"},
+                          data=io.BytesIO(contents), headers=AUTH)
+    self.assertEqual(rv.status_code, 201)
+    return rv.get_json()
+
+
+class TestFlaskFile(FlaskStore, unittest.TestCase):
+
+  def setUp(self):
+    super(TestFlaskFile, self).setUp()
+    self.contents = os.urandom(10000)
+    self.bf = self.post_file("random.bin", self.contents)
+
+  def get(self, **headers):
+    headers.update(AUTH)
+    return self.client.get("/v1/files/%d" % (self.bf["id"]), headers=headers)
+
+  def test_get_file(self):
+    rv = self.get()
+    self.assertEqual(rv.status_code, 200)
+    self.assertEqual(rv.data, self.contents)
+    self.assertEqual(rv.headers["Content-Length"], str(len(self.contents)))
+    self.assertEqual(rv.headers["ETag"], '"%s"' % (self.bf["checksum"]))
+    self.assertEqual(rv.headers["Accept-Ranges"], "bytes")
+
+  def test_get_unknown_file(self):
+    rv = self.client.get("/v1/files/%d" % (self.bf["id"] + 100), headers=AUTH)
+    self.assertEqual(rv.status_code, 404)
+
+  def test_get_without_auth(self):
+    rv = self.client.get("/v1/files/%d" % (self.bf["id"]))
+    self.assertEqual(rv.status_code, 403)
+
+  def test_get_range(self):
+    rv = self.get(Range="bytes=100-1099")
+    self.assertEqual(rv.status_code, 206)
+    self.assertEqual(rv.data, self.contents[100:1100])
+    self.assertEqual(rv.headers["Content-Range"], "bytes 100-1099/%d" % (len(self.contents)))
+    self.assertEqual(rv.headers["Content-Length"], "1000")
+
+  def test_get_range_not_satisfiable(self):
+    rv = self.get(Range="bytes=%d-" % (len(self.contents) + 10))
+    self.assertEqual(rv.status_code, 416)
+    self.assertEqual(rv.headers["Content-Range"], "bytes */%d" % (len(self.contents)))
+
+  def test_get_range_if_range(self):
+    rv = self.get(Range="bytes=100-199", **{"If-Range": '"%s"' % (self.bf["checksum"])})
+    self.assertEqual(rv.status_code, 206)
+    self.assertEqual(rv.data, self.contents[100:200])
+    rv = self.get(Range="bytes=100-199", **{"If-Range": '"%s"' % ("0" * 64)})
+    self.assertEqual(rv.status_code, 200)
+    self.assertEqual(rv.data, self.contents)
+
+  def test_get_if_none_match(self):
+    rv = self.get(**{"If-None-Match": '"%s"' % (self.bf["checksum"])})
+    self.assertEqual(rv.status_code, 304)
+    self.assertEqual(rv.data, b"")
+    rv = self.get(**{"If-None-Match": '"%s"' % ("0" * 64)})
+    self.assertEqual(rv.status_code, 200)
+    self.assertEqual(rv.data, self.contents)
+
+
+class TestFlaskCompressedFile(FlaskStore, unittest.TestCase):
+  repo_type = "BlobStore"
+
+  def setUp(self):
+    super(TestFlaskCompressedFile, self).setUp()
+    self.contents = b"".join([b"line %d of a very compressible file\n" % (n) for n in range(5000)])
+    self.bf = self.post_file("build.log", self.contents)
+
+  def test_stored_compressed(self):
+    blobs = []
+    for root, dirs, files in os.walk(os.path.join(self.store_path, "blobs")):
+      blobs.extend([os.path.join(root, f) for f in files])
+    self.assertEqual(len(blobs), 1)
+    self.assertLess(os.path.getsize(blobs[0]), len(self.contents))
+
+  def test_content_length_is_original_size(self):
+    rv = self.client.get("/v1/files/%d" % (self.bf["id"]), headers=AUTH)
+    self.assertEqual(rv.status_code, 200)
+    self.assertEqual(rv.headers["Content-Length"], str(len(self.contents)))
+    self.assertEqual(rv.data, self.contents)
+
+  def test_get_range(self):
+    headers = {"Range":"bytes=50000-50999"}
+    headers.update(AUTH)
+    rv = self.client.get("/v1/files/%d" % (self.bf["id"]), headers=headers)
+    self.assertEqual(rv.status_code, 206)
+    self.assertEqual(rv.data, self.contents[50000:51000])
+    self.assertEqual(rv.headers["Content-Range"], "bytes 50000-50999/%d" % (len(self.contents)))
+
+
+class TestFlaskAddFile(FlaskStore, unittest.TestCase):
+
+  def test_post_file(self):
+    contents = os.urandom(200000)
+    bf = self.post_file("random.bin", contents)
+    self.assertEqual(bf["checksum"], sha256(contents).hexdigest())
+    self.assertEqual(bf["name"], "random.bin")
+    self.assertEqual(bf["fileset_id"], self.fs_id)
+    rv = self.client.get("/v1/files/%d" % (bf["id"]), headers=AUTH)
+    self.assertEqual(rv.data, contents)
+
+  def test_post_existing_file(self):
+    self.post_file("random.bin", b"first")
+    rv = self.client.post("/v1/filesets/%d/files" % (self.fs_id),
+                          query_string={"name":"random.bin", "path":"deploy"},
+                          data=io.BytesIO(b"second"), headers=AUTH)
+    self.assertEqual(rv.status_code, 409)
+
+  def test_post_to_unknown_fileset(self):
+    rv = self.client.post("/v1/filesets/%d/files" % (self.fs_id + 100),
+                          query_string={"name":"random.bin"},
+                          data=io.BytesIO(b"contents"), headers=AUTH)
+    self.assertEqual(rv.status_code, 404)
+
+  def test_post_outside_repo(self):
+    rv = self.client.post("/v1/filesets/%d/files" % (self.fs_id),
+                          query_string={"name":"escape.bin", "path":"../.."},
+                          data=io.BytesIO(b"contents"), headers=AUTH)
+    self.assertEqual(rv.status_code, 400)
+
+
+class TestFlaskUploads(FlaskStore, unittest.TestCase):
+
+  def setUp(self):
+    super(TestFlaskUploads, self).setUp()
+    self.contents = os.urandom(100000)
+
+  def start(self):
+    rv = self.client.post("/v1/filesets/%d/uploads" % (self.fs_id),
+                          query_string={"name":"big.bin", "path":"deploy", "source":"buildbot"},
+                          headers=AUTH)
+    self.assertEqual(rv.status_code, 201)
+    self.assertEqual(rv.get_json()["offset"], 0)
+    return rv.get_json()["upload_id"], rv.headers["Location"]
+
+  def put(self, url, start, end, total="*", data=None):
+    headers = {"Content-Range":"bytes %d-%d/%s" % (start, end, total)}
+    headers.update(AUTH)
+    if data is None:
+      data = self.contents[start:end + 1]
+    return self.client.put(url, data=io.BytesIO(data), headers=headers)
+
+  def test_upload_in_parts(self):
+    upload_id, url = self.start()
+    rv = self.put(url, 0, 39999)
+    self.assertEqual(rv.status_code, 202)
+    self.assertEqual(rv.get_json()["offset"], 40000)
+    self.assertEqual(rv.headers["Range"], "bytes=0-39999")
+    rv = self.client.get(url, headers=AUTH)
+    self.assertEqual(rv.status_code, 200)
+    self.assertEqual(rv.get_json()["offset"], 40000)
+    rv = self.put(url, 40000, 99999, total=len(self.contents))
+    self.assertEqual(rv.status_code, 201)
+    bf = rv.get_json()
+    self.assertEqual(bf["checksum"], sha256(self.contents).hexdigest())
+    rv = self.client.get(rv.headers["Location"], headers=AUTH)
+    self.assertEqual(rv.data, self.contents)
+    rv = self.client.get(url, headers=AUTH)
+    self.assertEqual(rv.status_code, 404)
+
+  def test_complete_with_empty_part(self):
+    upload_id, url = self.start()
+    self.assertEqual(self.put(url, 0, 99999).status_code, 202)
+    headers = {"Content-Range":"bytes */%d" % (len(self.contents))}
+    headers.update(AUTH)
+    rv = self.client.put(url, data=b"", headers=headers)
+    self.assertEqual(rv.status_code, 201)
+    self.assertEqual(rv.get_json()["checksum"], sha256(self.contents).hexdigest())
+
+  def test_resume_at_wrong_offset(self):
+    upload_id, url = self.start()
+    self.assertEqual(self.put(url, 0, 39999).status_code, 202)
+    rv = self.put(url, 0, 39999)
+    self.assertEqual(rv.status_code, 409)
+    self.assertEqual(rv.get_json()["offset"], 40000)
+    self.assertEqual(rv.headers["Range"], "bytes=0-39999")
+    rv = self.put(url, 50000, 99999)
+    self.assertEqual(rv.status_code, 409)
+    self.assertEqual(rv.get_json()["offset"], 40000)
+    rv = self.put(url, 40000, 99999, total=len(self.contents))
+    self.assertEqual(rv.status_code, 201)
+
+  def test_part_does_not_match_range(self):
+    upload_id, url = self.start()
+    rv = self.put(url, 0, 39999, data=self.contents[:40001])
+    self.assertEqual(rv.status_code, 400)
+    rv = self.put(url, 0, 39999, data=self.contents[:39999])
+    self.assertEqual(rv.status_code, 400)
+    rv = self.client.get(url, headers=AUTH)
+    self.assertEqual(rv.get_json()["offset"], 0)
+
+  def test_invalid_content_range(self):
+    upload_id, url = self.start()
+    headers = {"Content-Range":"bytes nonsense"}
+    headers.update(AUTH)
+    rv = self.client.put(url, data=b"abc", headers=headers)
+    self.assertEqual(rv.status_code, 400)
+
+  def test_cancel_upload(self):
+    upload_id, url = self.start()
+    self.assertEqual(self.put(url, 0, 39999).status_code, 202)
+    rv = self.client.delete(url, headers=AUTH)
+    self.assertEqual(rv.status_code, 204)
+    rv = self.client.delete(url, headers=AUTH)
+    self.assertEqual(rv.status_code, 404)
+    rv = self.put(url, 40000, 99999)
+    self.assertEqual(rv.status_code, 404)
+
+  def test_unknown_upload(self):
+    rv = self.client.get("/v1/uploads/%s" % ("0" * 32), headers=AUTH)
+    self.assertEqual(rv.status_code, 404)
+    rv = self.client.delete("/v1/uploads/%s" % ("0" * 32), headers=AUTH)
+    self.assertEqual(rv.status_code, 404)
+
+
+class TestFlaskListing(FlaskStore, unittest.TestCase):
+
+  def setUp(self):
+    super(TestFlaskListing, self).setUp()
+    fp = self.service.fp
+    self.fs_ids = [self.fs_id]
+    for n in range(2, 8):
+      self.fs_ids.append(fp.add_new_fileset(uid=os.getuid(), name="test-%d" % (n), version="1", revision="123").id)
+    fp.session.remove()
+    self.names = []
+    for n in range(7):
+      self.names.append("file%d.txt" % (n))
+      self.post_file(self.names[-1], b"contents %d" % (n))
+
+  def pages(self, url, count):
+    items = []
+    pages = 0
+    cursor = ""
+    while cursor is not None:
+      rv = self.client.get(url, query_string={"count":count, "cursor":cursor}, headers=AUTH)
+      self.assertEqual(rv.status_code, 200)
+      page = rv.get_json()
+      self.assertLessEqual(len(page), count)
+      items.extend(page)
+      pages += 1
+      cursor = rv.headers.get("X-Next-Cursor")
+    return items, pages
+
+  def test_list_files_streamed(self):
+    rv = self.client.get("/v1/files", headers=AUTH)
+    self.assertEqual(rv.status_code, 200)
+    self.assertTrue(rv.is_streamed)
+    self.assertEqual([bf["name"] for bf in json.loads(rv.data)], self.names)
+
+  def test_list_filesets_streamed(self):
+    rv = self.client.get("/v1/filesets", headers=AUTH)
+    self.assertEqual(rv.status_code, 200)
+    self.assertTrue(rv.is_streamed)
+    self.assertEqual([fs["fileset_id"] for fs in json.loads(rv.data)], self.fs_ids)
+
+  def test_list_empty_is_valid_json(self):
+    rv = self.client.get("/v1/files", query_string={"start_at":100}, headers=AUTH)
+    self.assertEqual(rv.status_code, 200)
+    self.assertEqual(json.loads(rv.data), [])
+
+  def test_page_files(self):
+    bfs, pages = self.pages("/v1/files", 3)
+    self.assertEqual(pages, 3)
+    self.assertEqual([bf["name"] for bf in bfs], self.names)
+
+  def test_page_filesets(self):
+    fss, pages = self.pages("/v1/filesets", 2)
+    self.assertEqual(pages, 4)
+    self.assertEqual([fs["fileset_id"] for fs in fss], self.fs_ids)
+
+  def test_last_page_has_no_cursor(self):
+    rv = self.client.get("/v1/files", query_string={"count":7, "cursor":""}, headers=AUTH)
+    self.assertEqual(len(rv.get_json()), 7)
+    self.assertNotIn("X-Next-Cursor", rv.headers)
+
+  def test_invalid_cursor(self):
+    rv = self.client.get("/v1/files", query_string={"count":3, "cursor":"garbage"}, headers=AUTH)
+    self.assertEqual(rv.status_code, 400)
+    rv = self.client.get("/v1/filesets", query_string={"count":3, "cursor":"garbage"}, headers=AUTH)
+    self.assertEqual(rv.status_code, 400)
+
+
+if __name__ == "__main__":
+  unittest.main()
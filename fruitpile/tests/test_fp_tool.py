@@ -20,6 +20,7 @@ import sys
 import sqlite3
 from argparse import Namespace
 from io import StringIO
+from contextlib import redirect_stdout, redirect_stderr
 
 
 from fruitpile.fp_tool import (
@@ -28,12 +29,17 @@ from fruitpile.fp_tool import (
   fp_list_filesets,
   fp_add_filesets,
   fp_add_file,
+  fp_add_many_files,
   fp_list_files,
   fp_transit_file,
   fp_get_file,
+  fp_verify,
   fp_add_fileset_tags,
   fp_add_fileset_props,
-  fp_add_binfile_tags)
+  fp_add_binfile_tags,
+  fp_search_files,
+  fp_search_filesets)
+from fruitpile.repo.filemanager import COPY_METHODS
 from fruitpile.tests.test_fruitpile import clear_tree
 
 
@@ -50,7 +56,7 @@ class TestFPToolInit(unittest.TestCase):
     conn = sqlite3.connect(os.path.join(self.path,"fpl.db"))
     curs = conn.execute("SELECT * FROM SQLITE_MASTER")
     rows = curs.fetchall()
-    self.assertEqual(len(rows), 33)
+    self.assertEqual(len(rows), 42)
     curs = conn.execute("select * from repos")
     rows = curs.fetchall()
     self.assertEqual(len(rows), 1)
@@ -218,6 +224,55 @@ class TestFPToolFileOps(unittest.TestCase):
     self.check_output(ns, ["1","1","untested","P","build-1/requirements.txt",
                            "2","2","untested","P","build-2/requirements.txt"])
 
+  def test_add_many_files_from_directory(self):
+    ns = Namespace(path=self.path,
+                   fileset="build-1",
+                   source_dir=os.path.join(os.path.dirname(__file__), "data"),
+                   repopath="builds",
+                   auxilliary=["*.txt"],
+                   origin="buildbot",
+                   jobs=2)
+    fob = StringIO()
+    fp_add_many_files(ns, outfob=fob)
+    self.assertEqual(fob.getvalue().split()[:5], ["Added","1","files","to","fileset"])
+    ns = Namespace(path=self.path, long=False,
+                   count=-1, start_at=1, tags=False, properties=False)
+    self.check_output(ns, ["1","1","untested","A","builds/example_file.txt"])
+
+  def test_add_many_files_to_non_existent_fileset(self):
+    ns = Namespace(path=self.path,
+                   fileset="build-71",
+                   source_dir=os.path.join(os.path.dirname(__file__), "data"),
+                   repopath="builds",
+                   auxilliary=None,
+                   origin="buildbot",
+                   jobs=2)
+    fob = StringIO()
+    fp_add_many_files(ns, errfob=fob)
+    self.assertEqual(fob.getvalue().split(),
+                     ["Failed","to","add","files,","fileset","'build-71'","not","found"])
+
+  def test_list_files_with_cursor(self):
+    for fs in ["build-1", "build-2", "build-3"]:
+      ns = Namespace(path=self.path, fileset=fs, name="requirements-%s.txt" % (fs),
+                     repopath="builds", auxilliary=False, origin="buildbot",
+                     source_file="requirements.txt")
+      fp_add_file(ns)
+    fob = StringIO()
+    ns = Namespace(path=self.path, long=False, count=2, start_at=1, cursor="")
+    fp_list_files(ns, outfob=fob)
+    lines = fob.getvalue().splitlines()
+    self.assertEqual(len(lines), 3)
+    self.assertEqual(lines[2].split()[0], "next-cursor:")
+    ns = Namespace(path=self.path, long=False, count=2, start_at=1, cursor=lines[2].split()[1])
+    self.check_output(ns, ["3","3","untested","P","builds/requirements-build-3.txt"])
+
+  def test_list_files_with_invalid_cursor(self):
+    fob = StringIO()
+    ns = Namespace(path=self.path, long=False, count=2, start_at=1, cursor="bogus")
+    self.assertEqual(fp_list_files(ns, errfob=fob), 1)
+    self.assertEqual(fob.getvalue(), "invalid cursor 'bogus'\n")
+
   def test_add_file_long_list(self):
     tmp_path = "/tmp/sample_file%d.txt" % (os.getpid())
     tmp_fob = io.open(tmp_path, "wb")
@@ -503,6 +558,46 @@ class TestFPToolTransitOperations(unittest.TestCase):
     self._check_fails_withdrawn()
 
 
+  def test_transit_all_files_in_fileset(self):
+    ns = Namespace(path=self.path, fileset="build-1", name="setup.py", repopath="builds",
+                   auxilliary=False, origin="buildbot", source_file="requirements.txt")
+    fp_add_file(ns)
+    ns = Namespace(path=self.path, id=None, all=True, fileset="build-1", state="testing")
+    outfob = StringIO()
+    errfob = StringIO()
+    self.assertEqual(fp_transit_file(ns, outfob=outfob, errfob=errfob), 0)
+    self.assertEqual(outfob.getvalue(), "2 of 2 files moved to state 'testing'\n")
+    self.assertEqual(errfob.getvalue(), "")
+    fob = StringIO()
+    ns = Namespace(path=self.path, long=False, count=-1,
+                   start_at=1, tags=False, properties=False)
+    fp_list_files(ns, outfob=fob)
+    self.assertEqual(fob.getvalue().split(), [
+      "1","1","testing","P","builds/requirements.txt",
+      "1","2","untested","A","builds/requirements-2.txt",
+      "1","3","untested","A","builds/test_report",
+      "1","4","testing","P","builds/setup.py"])
+
+  def test_transit_all_reports_failed_files(self):
+    ns = Namespace(path=self.path, fileset="build-1", name="setup.py", repopath="builds",
+                   auxilliary=False, origin="buildbot", source_file="requirements.txt")
+    fp_add_file(ns)
+    fp_transit_file(Namespace(path=self.path, id=4, state="testing"))
+    ns = Namespace(path=self.path, id=None, all=True, fileset="build-1", state="testing")
+    outfob = StringIO()
+    errfob = StringIO()
+    self.assertEqual(fp_transit_file(ns, outfob=outfob, errfob=errfob), 1)
+    self.assertEqual(outfob.getvalue(), "1 of 2 files moved to state 'testing'\n")
+    self.assertEqual(errfob.getvalue(),
+      "the transition to state 'testing' for file id 4 is not permitted\n")
+
+  def test_transit_all_unknown_fileset(self):
+    ns = Namespace(path=self.path, id=None, all=True, fileset="build-2", state="testing")
+    errfob = StringIO()
+    self.assertEqual(fp_transit_file(ns, errfob=errfob), 1)
+    self.assertEqual(errfob.getvalue(), "fileset 'build-2' not found\n")
+
+
 class TestFPToolGetFileOperations(unittest.TestCase):
 
   def setUp(self):
@@ -553,6 +648,19 @@ class TestFPToolGetFileOperations(unittest.TestCase):
     nbytes = io.open("requirements.txt", "rb").read()
     self.assertEqual(obytes, nbytes)
 
+  def test_get_a_copy_of_a_file_verbose(self):
+    ns = Namespace(path=self.path, id=1, to_file=self.dest_path, verbose=True)
+    outfob = StringIO()
+    errfob = StringIO()
+    fp_get_file(ns, outfob=outfob, errfob=errfob)
+    self.assertEqual(errfob.getvalue(), "")
+    words = outfob.getvalue().split()
+    self.assertEqual(words[:-1], ["copied","file","id","1","to","'%s'" % (self.dest_path),"using"])
+    self.assertTrue(words[-1] in COPY_METHODS + ("decompress",))
+    obytes = io.open(self.dest_path, "rb").read()
+    nbytes = io.open("requirements.txt", "rb").read()
+    self.assertEqual(obytes, nbytes)
+
   def test_get_a_copy_of_auxilliary_file(self):
     ns = Namespace(path=self.path, id=2, to_file=self.dest_path)
     outfob = StringIO()
@@ -596,6 +704,79 @@ class TestFPToolGetFileOperations(unittest.TestCase):
       "the target file '{}' cannot be written to\n".format(new_path))
 
 
+class TestFPToolVerify(unittest.TestCase):
+
+  def setUp(self):
+    self.path = "/tmp/fptool.%d" % (os.getpid())
+    ns = Namespace(path=self.path)
+    fp_init_repo(ns)
+    ns = Namespace(path=self.path, version="3.1", revision="1", name="build-1")
+    fp_add_filesets(ns)
+    for name in ["requirements.txt", "requirements-2.txt"]:
+      ns = Namespace(path=self.path, fileset="build-1", name=name, repopath="builds",
+                     auxilliary=False, origin="buildbot", source_file="requirements.txt")
+      fp_add_file(ns)
+
+  def tearDown(self):
+    clear_tree(self.path)
+
+  def _verify(self, **kwargs):
+    ns = Namespace(path=self.path, jobs=1, **kwargs)
+    outfob = StringIO()
+    errfob = StringIO()
+    rc = fp_verify(ns, outfob=outfob, errfob=errfob)
+    return rc, outfob.getvalue().split(), errfob.getvalue()
+
+  def test_verify_store(self):
+    rc, words, err = self._verify()
+    self.assertEqual(rc, 0)
+    self.assertEqual(words[:2], ["verified", "2"])
+    self.assertEqual(words[-8:], ["2","ok,","0","missing,","0","corrupt,","0","orphaned"])
+    self.assertEqual(err, "")
+
+  def test_verify_reports_missing_file(self):
+    os.remove(os.path.join(self.path, "builds", "requirements-2.txt"))
+    rc, words, err = self._verify()
+    self.assertEqual(rc, 1)
+    self.assertEqual(err, "file id 2 is missing\n")
+
+  def test_verify_exit_status(self):
+    self.assertFalse(fp_tool_main([self.path, "verify", "-j", "1"]))
+    with io.open(os.path.join(self.path, "builds", "requirements-2.txt"), "wb") as fob:
+      fob.write(b"corrupted")
+    self.assertEqual(fp_tool_main([self.path, "verify", "-j", "1"]), 1)
+
+  def test_verify_one_file(self):
+    rc, words, err = self._verify(id=[1])
+    self.assertEqual(rc, 0)
+    self.assertEqual(words[:2], ["verified", "1"])
+
+  def test_verify_resume(self):
+    self._verify(id=[1])
+    rc, words, err = self._verify(max_age=1)
+    self.assertEqual(words[:2], ["verified", "1"])
+
+  def test_verify_unmigrated_store(self):
+    conn = sqlite3.connect(os.path.join(self.path, "fpl.db"))
+    conn.execute("DROP TABLE verifications")
+    conn.execute("DELETE FROM migrations WHERE id > 2")
+    conn.commit()
+    conn.close()
+    errfob = StringIO()
+    with redirect_stderr(errfob):
+      self.assertEqual(fp_tool_main([self.path, "verify", "-j", "1"]), 1)
+    self.assertEqual(errfob.getvalue(), "the store needs upgrading, run fp_tool upgrade\n")
+    with redirect_stdout(StringIO()):
+      fp_tool_main([self.path, "upgrade"])
+    rc, words, err = self._verify()
+    self.assertEqual(rc, 0)
+
+  def test_verify_unknown_fileset(self):
+    rc, words, err = self._verify(fileset="build-2")
+    self.assertEqual(rc, 1)
+    self.assertEqual(err, "fileset 'build-2' not found\n")
+
+
 class TestFPToolTagFileSetOperations(unittest.TestCase):
 
   def setUp(self):
@@ -813,5 +994,100 @@ class TestFPToolTagBinFileOperations(unittest.TestCase):
       "1","2","untested","A","builds/requirements-2.txt"])
 
 
+  def test_tag_many_binfiles_by_id(self):
+    ns = Namespace(path=self.path, ids=[1, 2], tag="RC1")
+    fob = StringIO()
+    fp_add_binfile_tags(ns, outfob=fob, errfob=fob)
+    self.assertEqual(fob.getvalue(), "")
+    outfob = StringIO()
+    ns = Namespace(path=self.path, tags=True,
+                   count=-1, start_at=1, properties=False, long=False)
+    fp_list_files(ns, outfob=outfob, errfob=outfob)
+    self.assertEqual(outfob.getvalue().split(), [
+      "1","1","untested","P","builds/requirements.txt",
+      "RC1",
+      "1","2","untested","A","builds/requirements-2.txt",
+      "RC1"])
+
+  def test_tag_many_binfiles_missing_id(self):
+    ns = Namespace(path=self.path, ids=[1, 5, 7], tag="RC1")
+    fob = StringIO()
+    self.assertEqual(fp_add_binfile_tags(ns, outfob=fob, errfob=fob), 1)
+    self.assertEqual(fob.getvalue(), "file id 5,7 not found\n")
+
+  def test_tag_many_from_cli(self):
+    fp_tool_main([self.path, "tag", "--ids", "1", "2", "-t", "RC1"])
+    with self.assertRaises(SystemExit):
+      fp_tool_main([self.path, "tag", "--ids", "1", "-i", "2", "-t", "RC1"])
+
+class TestFPToolSearch(unittest.TestCase):
+
+  def setUp(self):
+    self.path = "/tmp/fptool.%d" % (os.getpid())
+    fp_init_repo(Namespace(path=self.path))
+    for build in ["build-1", "build-2"]:
+      fob = StringIO()
+      fp_add_filesets(Namespace(path=self.path, version="3.1", revision="1", name=build), outfob=fob)
+      for name, aux in [("requirements.txt", False), ("requirements-2.txt", True)]:
+        ns = Namespace(path=self.path,
+                       fileset=build,
+                       name=name,
+                       repopath=build,
+                       auxilliary=aux,
+                       origin="buildbot",
+                       source_file="requirements.txt")
+        fp_add_file(ns, outfob=fob)
+      self.assertEqual(fob.getvalue(), "")
+    fob = StringIO()
+    fp_add_binfile_tags(Namespace(path=self.path, id=3, tag="RC1"), outfob=fob, errfob=fob)
+    fp_add_fileset_tags(Namespace(path=self.path, id=2, tag="RC1"), outfob=fob, errfob=fob)
+    self.assertEqual(fob.getvalue(), "")
+
+  def tearDown(self):
+    clear_tree(self.path)
+
+  def _search(self, fn, **kwargs):
+    outfob = StringIO()
+    errfob = StringIO()
+    ret = fn(Namespace(path=self.path, **kwargs), outfob=outfob, errfob=errfob)
+    return ret, outfob.getvalue(), errfob.getvalue()
+
+  def test_search_by_tag(self):
+    ret, out, err = self._search(fp_search_files, tag=["RC1"])
+    self.assertEqual(err, "")
+    self.assertEqual(out.split(), ["2","3","untested","P","build-2/requirements.txt"])
+
+  def test_search_by_name_and_fileset(self):
+    ret, out, err = self._search(fp_search_files, name="*-2.txt", fileset="build-1")
+    self.assertEqual(err, "")
+    self.assertEqual(out.split(), ["1","2","untested","A","build-1/requirements-2.txt"])
+
+  def test_search_pages(self):
+    ret, out, err = self._search(fp_search_files, count=3, state="untested")
+    lines = out.splitlines()
+    self.assertEqual(len(lines), 4)
+    self.assertTrue(lines[3].startswith("next-cursor: "))
+    ret, out, err = self._search(fp_search_files, count=3, state="untested", cursor=lines[3].split()[1])
+    self.assertEqual(out.split(), ["2","4","untested","A","build-2/requirements-2.txt"])
+
+  def test_search_unknown_state(self):
+    ret, out, err = self._search(fp_search_files, state="nosuchstate")
+    self.assertEqual(ret, 1)
+    self.assertEqual(err, "unknown state 'nosuchstate'\n")
+
+  def test_search_unknown_fileset(self):
+    ret, out, err = self._search(fp_search_files, fileset="build-3")
+    self.assertEqual(ret, 1)
+    self.assertEqual(err, "fileset 'build-3' not found\n")
+
+  def test_search_filesets(self):
+    ret, out, err = self._search(fp_search_filesets, tag=["RC1"], tags=True)
+    self.assertEqual(err, "")
+    self.assertEqual(out.split(), ["default","2","3.1","1","build-2","RC1"])
+
+  def test_search_command_line(self):
+    fp_tool_main([self.path, "search", "-T", "RC1", "-P", "nosuchprop", "--since", "2016-01-01"])
+
+
 if __name__ == "__main__":
   unittest.main()
@@ -18,10 +18,21 @@ import unittest
 import io
 import os
 import sqlite3
+import threading
+import time
+from unittest import mock
 from datetime import datetime, timedelta
+from hashlib import sha256
+from sqlalchemy import event
 
 from fruitpile import (
   Fruitpile,
+  build_manifest,
+  parse_date,
+  parse_properties,
+  TransitResult,
+  FileRecord,
+  FilesetRecord,
   FPLExists,
   FPLConfiguration,
   FPLRepoInUse,
@@ -36,19 +47,33 @@ from fruitpile import (
   FPLInvalidTargetForStateChange,
   FPLFileExists,
   FPLCannotTransitionState,
-  FPLPropertyExists)
+  FPLPropertyExists,
+  FPLInvalidCursor,
+  FPLNoFilesSpecified,
+  FPLUploadNotFound,
+  FPLUploadOffsetMismatch,
+  FPLUploadLengthMismatch,
+  FPLUnknownState,
+  FPLFileSetNotExists,
+  FPLInvalidPath)
 from fruitpile.db.schema import (
   State,
+  FileSet,
   BinFile,
+  TagAssoc,
+  BinFileTag,
   User,
   UserPermission,
   Tag,
   Property,
   PropAssoc,
   BinFileProp,
+  Migration,
+  Verification,
   downgrade)
 from fruitpile.fp_constants import Capability
-from fruitpile.fp_state import StateMachine
+from fruitpile.fp_state import StateMachine, TransitionData
+from fruitpile.fp_trans import check_auxilliary_file_in_fileset
 
 
 mydir = os.path.dirname(__file__)
@@ -65,6 +90,21 @@ def clear_tree(path):
       os.rmdir(root)
 
 
+class CountStatements(object):
+  # Mixin recording the SQL the store's engine runs in self.statements,
+  # for tests of how many queries an operation takes
+
+  def count_statements(self):
+    self.statements = []
+    event.listen(self.fp.engine, "before_cursor_execute", self._count)
+
+  def _count(self, conn, cursor, statement, parameters, context, executemany):
+    self.statements.append(statement)
+
+  def stop_counting(self):
+    event.remove(self.fp.engine, "before_cursor_execute", self._count)
+
+
 class TestFruitpileInitOperations(unittest.TestCase):
 
   def setUp(self):
@@ -102,7 +142,8 @@ class TestFruitpileInitOperations(unittest.TestCase):
       "transitions",
       "transfuncdata",
       "user_perms",
-      "users"
+      "users",
+      "verifications"
     ]
     for r in rows:
       if r[0] == "table":
@@ -441,6 +482,62 @@ class TestFruitpileBinFileOperations(unittest.TestCase):
     for i in range(3):
       self.assertEqual(bfs[i].name, "artifact-{}.txt".format(i + 5))
 
+  def test_page_files_with_cursor(self):
+    self._add_n_filesets_m_files_each(1, 10)
+    names = []
+    bfs, cursor = self.fp.page_files(uid=1046, count=4)
+    pages = 1
+    names.extend([bf.name for bf in bfs])
+    while cursor is not None:
+      bfs, cursor = self.fp.page_files(uid=1046, count=4, cursor=cursor)
+      names.extend([bf.name for bf in bfs])
+      pages += 1
+    self.assertEqual(pages, 3)
+    self.assertEqual(names, ["artifact-{}.txt".format(i) for i in range(1, 11)])
+
+  def test_page_files_exact_last_page(self):
+    self._add_n_filesets_m_files_each(1, 4)
+    bfs, cursor = self.fp.page_files(uid=1046, count=4)
+    self.assertEqual(len(bfs), 4)
+    self.assertEqual(cursor, None)
+    bfs, cursor = self.fp.page_files(uid=1046)
+    self.assertEqual(len(bfs), 4)
+    self.assertEqual(cursor, None)
+
+  def test_page_filesets_with_cursor(self):
+    self._add_n_filesets_m_files_each(5, 0)
+    fss, cursor = self.fp.page_filesets(uid=1046, count=3)
+    self.assertEqual([fs.name for fs in fss], ["test-1","test-2","test-3"])
+    fss, cursor = self.fp.page_filesets(uid=1046, count=3, cursor=cursor)
+    self.assertEqual([fs.name for fs in fss], ["test-4","test-5"])
+    self.assertEqual(cursor, None)
+
+  def test_page_files_with_invalid_cursor(self):
+    with self.assertRaises(FPLInvalidCursor):
+      self.fp.page_files(uid=1046, count=3, cursor="not-a-cursor")
+
+  def test_iter_files_in_batches(self):
+    self._add_n_filesets_m_files_each(1, 10)
+    bfs = self.fp.iter_files(uid=1046, batch_size=3)
+    self.assertEqual([bf.name for bf in bfs],
+                     ["artifact-{}.txt".format(i) for i in range(1, 11)])
+
+  def test_iter_files_matches_list_files(self):
+    self._add_n_filesets_m_files_each(1, 10)
+    for count, start_at in [(-1, 1), (3, 1), (-1, 7), (3, 4), (5, 2)]:
+      self.assertEqual(list(self.fp.iter_files(uid=1046, count=count, start_at=start_at, batch_size=2)),
+                       self.fp.list_files(uid=1046, count=count, start_at=start_at))
+
+  def test_iter_files_checks_permission_straight_away(self):
+    with self.assertRaises(FPLPermissionDenied):
+      self.fp.iter_files(uid=1047)
+
+  def test_iter_filesets_in_batches(self):
+    self._add_n_filesets_m_files_each(7, 0)
+    fss = list(self.fp.iter_filesets(uid=1046, batch_size=2, with_tags=True))
+    self.assertEqual([fs.name for fs in fss], ["test-{}".format(i) for i in range(1, 8)])
+    self.assertEqual(fss[0].loaded_tags, [])
+
   def test_add_same_file_and_path_twice_to_same_file_set(self):
     bfs0 = self.fp.list_files(uid=1046)
     self.assertEqual(bfs0, [])
@@ -503,6 +600,134 @@ class TestFruitpileBinFileOperations(unittest.TestCase):
     self.assertEqual(len(bfs1), 1)
     self.assertEqual(bfs1[0], bf1)
 
+  def test_add_existing_file_leaves_contents_alone(self):
+    fs = self.fp.add_new_fileset(name="test-1", version="1", revision="123", uid=1046)
+    fs2 = self.fp.add_new_fileset(name="test-2", version="1", revision="123", uid=1046)
+    self.fp.add_file(uid=1046, source_fob=io.BytesIO(b"xxxxx"), fileset_id=fs.id,
+                     name="a.bin", path="deploy", primary=True, source="buildbot")
+    for fileset_id, path in [(fs.id, "deploy"), (fs.id, "other"), (fs2.id, "deploy")]:
+      with self.assertRaises(FPLBinFileExists):
+        self.fp.add_file(uid=1046, source_fob=io.BytesIO(b"yyyyy"), fileset_id=fileset_id,
+                         name="a.bin", path=path, primary=True, source="buildbot")
+    stored = io.open(os.path.join(self.store_path, "deploy", "a.bin"), "rb").read()
+    self.assertEqual(stored, b"xxxxx")
+    self.assertFalse(os.path.exists(os.path.join(self.store_path, "other")))
+
+  def test_add_file_from_stream(self):
+    fs = self.fp.add_new_fileset(name="test-1",
+                                 version="1",
+                                 revision="123",
+                                 uid=1046)
+    filename = "%s/data/example_file.txt" % (mydir)
+    contents = io.open(filename, "rb").read()
+    bf = self.fp.add_file(
+        uid=1046,
+        source_fob=io.BytesIO(contents),
+        fileset_id=fs.id,
+        name="requirements.txt",
+        path="deploy",
+        primary=True,
+        source="buildbot")
+    self.assertEqual(bf.checksum, sha256(contents).hexdigest())
+    self.assertEqual(bf.ingest_stats.size, len(contents))
+    self.assertEqual(bf.size, len(contents))
+    stored = io.open(os.path.join(self.store_path, "deploy", "requirements.txt"), "rb").read()
+    self.assertEqual(stored, contents)
+
+  def _make_tree(self, root):
+    clear_tree(root)
+    for d in ["bin", "reports"]:
+      os.makedirs(os.path.join(root, d))
+    for i in range(5):
+      with io.open(os.path.join(root, "bin", "artifact-%d.bin" % (i)), "wb") as fob:
+        fob.write(b"artifact %d" % (i))
+    with io.open(os.path.join(root, "reports", "test_report"), "wb") as fob:
+      fob.write(b"all tests passed")
+
+  def test_build_manifest(self):
+    root = "/tmp/tree%d" % (os.getpid())
+    self._make_tree(root)
+    manifest = build_manifest(root, "deploy", ["test_*"])
+    clear_tree(root)
+    self.assertEqual(len(manifest), 6)
+    self.assertEqual(manifest[0]["name"], "artifact-0.bin")
+    self.assertEqual(manifest[0]["path"], "deploy/bin")
+    self.assertTrue(manifest[0]["primary"])
+    self.assertEqual(manifest[5]["name"], "test_report")
+    self.assertEqual(manifest[5]["path"], "deploy/reports")
+    self.assertFalse(manifest[5]["primary"])
+
+  def test_add_files_in_bulk(self):
+    root = "/tmp/tree%d" % (os.getpid())
+    self._make_tree(root)
+    fs = self.fp.add_new_fileset(name="test-1",
+                                 version="1",
+                                 revision="123",
+                                 uid=1046)
+    bfs = self.fp.add_files(uid=1046,
+                            fileset_id=fs.id,
+                            files=build_manifest(root, "deploy", ["test_*"]),
+                            source="buildbot",
+                            workers=3)
+    clear_tree(root)
+    self.assertEqual(len(bfs), 6)
+    self.assertEqual(self.fp.list_files(uid=1046), bfs)
+    self.assertEqual(bfs[2].checksum, sha256(b"artifact 2").hexdigest())
+    self.assertEqual([bf.primary for bf in bfs], [True] * 5 + [False])
+    stored = io.open(os.path.join(self.store_path, "deploy", "bin", "artifact-3.bin"), "rb").read()
+    self.assertEqual(stored, b"artifact 3")
+
+  def test_add_files_in_bulk_duplicate(self):
+    root = "/tmp/tree%d" % (os.getpid())
+    self._make_tree(root)
+    fs = self.fp.add_new_fileset(name="test-1",
+                                 version="1",
+                                 revision="123",
+                                 uid=1046)
+    manifest = build_manifest(root, "deploy")
+    self.fp.add_files(uid=1046, fileset_id=fs.id, files=manifest[:2], source="buildbot")
+    with io.open(manifest[0]["source_file"], "wb") as fob:
+      fob.write(b"changed")
+    with self.assertRaises(FPLBinFileExists):
+      self.fp.add_files(uid=1046, fileset_id=fs.id, files=manifest, source="buildbot")
+    with self.assertRaises(FPLBinFileExists):
+      self.fp.add_files(uid=1046, fileset_id=fs.id, files=[manifest[2], manifest[2]], source="buildbot")
+    clear_tree(root)
+    self.assertEqual(len(self.fp.list_files(uid=1046)), 2)
+    stored = io.open(os.path.join(self.store_path, "deploy", "bin", "artifact-0.bin"), "rb").read()
+    self.assertEqual(stored, b"artifact 0")
+    # nothing else from the batch was copied into the repo
+    self.assertEqual(sorted(os.listdir(os.path.join(self.store_path, "deploy", "bin"))),
+                     ["artifact-0.bin", "artifact-1.bin"])
+    self.assertEqual(self.fp.verify_files(uid=1046).orphaned, [])
+
+  def test_add_files_in_bulk_failed_copy(self):
+    root = "/tmp/tree%d" % (os.getpid())
+    self._make_tree(root)
+    fs = self.fp.add_new_fileset(name="test-1",
+                                 version="1",
+                                 revision="123",
+                                 uid=1046)
+    ingest = self.fp.repo.ingest
+    def failing_ingest(path, srcfob, hasher):
+      if path.endswith("artifact-3.bin"):
+        raise IOError("disk full")
+      return ingest(path, srcfob, hasher)
+    with mock.patch.object(self.fp.repo, "ingest", side_effect=failing_ingest):
+      with self.assertRaises(IOError):
+        self.fp.add_files(uid=1046, fileset_id=fs.id, files=build_manifest(root, "deploy"),
+                          source="buildbot", workers=2)
+    clear_tree(root)
+    self.assertEqual(self.fp.list_files(uid=1046), [])
+    written = []
+    for dirpath, dirs, files in os.walk(os.path.join(self.store_path, "deploy")):
+      written.extend(files)
+    self.assertEqual(written, [])
+
+  def test_add_files_in_bulk_without_permission(self):
+    with self.assertRaises(FPLPermissionDenied):
+      self.fp.add_files(uid=1047, fileset_id=1, files=[], source="buildbot")
+
   def test_add_missing_source_file(self):
     fs = self.fp.add_new_fileset(name="test-1",
                                  version="1",
@@ -575,7 +800,132 @@ def state_machine_callback_helper(uid, perm_man, old_state, new_state, obj):
   obj.called_back_new_state = new_state
 
 
-class TestFruitpileStateMachine(unittest.TestCase):
+class TestFruitpileBlobStore(unittest.TestCase):
+
+  def setUp(self):
+    self.store_path = "/tmp/store%d" % (os.getpid())
+    clear_tree(self.store_path)
+    fp = Fruitpile(self.store_path)
+    fp.init(uid=1046, username="db", repo_type="BlobStore")
+    fp.open()
+    self.fp = fp
+    self.filename = "%s/data/example_file.txt" % (mydir)
+
+  def tearDown(self):
+    self.fp.close()
+    clear_tree(self.store_path)
+
+  def _blobs(self):
+    blobs = []
+    for root, dirs, files in os.walk(os.path.join(self.store_path, "blobs")):
+      if os.path.basename(root) != ".tmp":
+        blobs.extend(files)
+    return blobs
+
+  def test_open_blob_store(self):
+    self.assertEqual(self.fp.repo.__class__.__name__, "BlobStore")
+
+  def test_init_unknown_repo_type(self):
+    fp = Fruitpile(self.store_path + "-x")
+    with self.assertRaises(FPLConfiguration):
+      fp.init(uid=1046, username="db", repo_type="Tape")
+    self.assertFalse(os.path.exists(self.store_path + "-x"))
+
+  def test_identical_files_stored_once(self):
+    bfs = []
+    for i in range(3):
+      fs = self.fp.add_new_fileset(name="test-%d" % (i), version="1",
+                                   revision="123", uid=1046)
+      bfs.append(self.fp.add_file(uid=1046,
+                                  source_file=self.filename,
+                                  fileset_id=fs.id,
+                                  name="requirements.txt",
+                                  path="deploy-%d" % (i),
+                                  primary=True,
+                                  source="buildbot"))
+    self.assertEqual(len(set([bf.checksum for bf in bfs])), 1)
+    self.assertEqual(self._blobs(), [bfs[0].checksum])
+    self.assertFalse(os.path.exists(os.path.join(self.store_path, "deploy-0")))
+
+  def test_failed_bulk_add_keeps_shared_blobs(self):
+    root = "/tmp/tree%d" % (os.getpid())
+    clear_tree(root)
+    os.makedirs(root)
+    for i in range(4):
+      with io.open(os.path.join(root, "file-%d.txt" % (i)), "wb") as fob:
+        fob.write(b"contents %d" % (i))
+    fs0 = self.fp.add_new_fileset(name="test-0", version="1", revision="123", uid=1046)
+    bf = self.fp.add_file(uid=1046, source_file=os.path.join(root, "file-0.txt"), fileset_id=fs0.id,
+                          name="file-0.txt", path="first", primary=True, source="buildbot")
+    fs = self.fp.add_new_fileset(name="test-1", version="1", revision="123", uid=1046)
+    ingest = self.fp.repo.ingest
+    def failing_ingest(path, srcfob, hasher):
+      if path.endswith("file-3.txt"):
+        raise IOError("disk full")
+      return ingest(path, srcfob, hasher)
+    with mock.patch.object(self.fp.repo, "ingest", side_effect=failing_ingest):
+      with self.assertRaises(IOError):
+        self.fp.add_files(uid=1046, fileset_id=fs.id, files=build_manifest(root, "deploy"),
+                          source="buildbot", workers=1)
+    clear_tree(root)
+    self.assertEqual(self.fp.list_files(uid=1046), [bf])
+    self.assertEqual(self._blobs(), [bf.checksum])
+
+  def test_failed_ingest_removes_temporary_file(self):
+    class BrokenSource(object):
+      def __init__(self):
+        self.reads = 0
+      def read(self, n=-1):
+        self.reads += 1
+        if self.reads > 1:
+          raise IOError("connection reset")
+        return b"x" * n
+    with self.assertRaises(IOError):
+      self.fp.repo.ingest("deploy/broken.bin", BrokenSource(), sha256)
+    self.assertEqual(os.listdir(os.path.join(self.store_path, "blobs", ".tmp")), [])
+    self.assertEqual(self._blobs(), [])
+
+  def test_get_file_from_blob_store(self):
+    fs = self.fp.add_new_fileset(name="test-1", version="1",
+                                 revision="123", uid=1046)
+    bf = self.fp.add_file(uid=1046,
+                          source_file=self.filename,
+                          fileset_id=fs.id,
+                          name="requirements.txt",
+                          path="deploy",
+                          primary=True,
+                          source="buildbot")
+    to_file = "/tmp/got_file.%d" % (os.getpid())
+    self.fp.get_file(uid=1046, file_id=bf.id, to_file=to_file)
+    self.assertEqual(io.open(self.filename, "rb").read(),
+                     io.open(to_file, "rb").read())
+    os.remove(to_file)
+
+  def test_compressed_file_in_blob_store(self):
+    text = b"".join([b"test %d passed\n" % (i) for i in range(50000)])
+    fs = self.fp.add_new_fileset(name="test-1", version="1",
+                                 revision="123", uid=1046)
+    bf = self.fp.add_file(uid=1046,
+                          source_fob=io.BytesIO(text),
+                          fileset_id=fs.id,
+                          name="test_report",
+                          path="deploy",
+                          primary=False,
+                          source="buildbot")
+    self.assertEqual(bf.ztype, "gzip")
+    self.assertEqual(bf.checksum, sha256(text).hexdigest())
+    self.assertEqual(self._blobs(), [bf.checksum + ".gz"])
+    to_file = "/tmp/got_file.%d" % (os.getpid())
+    self.assertEqual(self.fp.get_file(uid=1046, file_id=bf.id, to_file=to_file), "decompress")
+    self.assertEqual(io.open(to_file, "rb").read(), text)
+    os.remove(to_file)
+    bf, fh = self.fp.open_file(uid=1046, file_id=bf.id)
+    self.assertEqual(bf.size, len(text))
+    self.assertEqual(fh.read(), text)
+    fh.close()
+
+
+class TestFruitpileStateMachine(CountStatements, unittest.TestCase):
 
   def setUp(self):
     self.store_path = "/tmp/store%d" % (os.getpid())
@@ -609,8 +959,10 @@ class TestFruitpileStateMachine(unittest.TestCase):
 
   def test_transition_from_one_state_to_another(self):
     sm = StateMachine.create_state_machine(self.fp.session)
-    sm.transit(1046, self.fp.perm_manager, "untested", "testing", {"obj":self})
-    self.assertEqual(sm.state, "testing")
+    new_state = sm.transit(1046, self.fp.perm_manager, "untested", "testing", {"obj":self})
+    self.assertEqual(new_state, "testing")
+    # the shared state machine is not moved on by a file's transition
+    self.assertEqual(sm.state, "untested")
     self.assertEqual(self.called_back_uid, None)
     self.assertEqual(self.called_back_perm_man, None)
     self.assertEqual(self.called_back_old_state, None)
@@ -656,6 +1008,35 @@ class TestFruitpileStateMachine(unittest.TestCase):
       sm.transit(1047, self.fp.perm_manager,
                  "untested", "testing", {"obj":self})
 
+  def test_compiled_state_machine_is_shared_between_opens(self):
+    fp2 = Fruitpile(self.store_path)
+    fp2.open()
+    try:
+      self.assertIsNot(fp2.sm, self.fp.sm)
+      self.assertIs(fp2.sm._transitions, self.fp.sm._transitions)
+      self.assertEqual(fp2.sm.state, "untested")
+      self.assertEqual(fp2.state_map, self.fp.state_map)
+    finally:
+      fp2.close()
+
+  def test_reopen_with_cached_state_machine_runs_one_query(self):
+    sm = StateMachine.create_state_machine(self.fp.session, key=self.fp._sm_key())
+    self.count_statements()
+    try:
+      sm2 = StateMachine.create_state_machine(self.fp.session, key=self.fp._sm_key())
+    finally:
+      self.stop_counting()
+    self.assertEqual(len(self.statements), 1)
+    self.assertIs(sm2._transitions, sm._transitions)
+
+  def test_schema_version_change_recompiles_state_machine(self):
+    sm = StateMachine.create_state_machine(self.fp.session, key=self.fp._sm_key())
+    self.fp.session.add(Migration(id=1000, script="test"))
+    self.fp.session.commit()
+    sm2 = StateMachine.create_state_machine(self.fp.session, key=self.fp._sm_key())
+    self.assertIsNot(sm2._transitions, sm._transitions)
+    self.assertEqual(sm2._transitions, sm._transitions)
+
 
 class TestFruitpileStateTransitOperations(unittest.TestCase):
 
@@ -769,6 +1150,102 @@ class TestFruitpileStateTransitOperations(unittest.TestCase):
     bf = self.fp.transit_file(uid=1046, file_id=self.bf.id, req_state="tested")
     self.assertEqual(bf.state.name, "tested")
 
+  def test_transit_file_with_similarly_named_auxilliary_file(self):
+    af = self.fp.add_file(
+        uid=1046,
+        source_file=self.filename,
+        fileset_id=self.fs.id,
+        name="old_test_report",
+        path="deploy",
+        primary=False,
+        source="buildbot")
+    bf = self.fp.transit_file(uid=1046,
+                              file_id=self.bf.id,
+                              req_state="testing")
+    with self.assertRaises(FPLCannotTransitionState):
+      self.fp.transit_file(uid=1046, file_id=self.bf.id, req_state="tested")
+
+  def _add_primary(self, name):
+    return self.fp.add_file(
+        uid=1046,
+        source_file=self.filename,
+        fileset_id=self.fs.id,
+        name=name,
+        path="deploy",
+        primary=True,
+        source="buildbot")
+
+  def test_transit_files_by_id(self):
+    bf2 = self._add_primary("setup.py")
+    results = self.fp.transit_files(uid=1046, file_ids=[self.bf.id, bf2.id],
+                                    req_state="testing")
+    self.assertEqual(results, [TransitResult(self.bf.id, "untested", "testing", None),
+                               TransitResult(bf2.id, "untested", "testing", None)])
+    self.fp.session.rollback()
+    self.assertEqual([bf.state.name for bf in self.fp.session.query(BinFile).all()],
+                     ["testing","testing"])
+
+  def test_transit_files_in_fileset(self):
+    bf2 = self._add_primary("setup.py")
+    af = self.fp.add_file(
+        uid=1046,
+        source_file=self.filename,
+        fileset_id=self.fs.id,
+        name="test_report",
+        path="deploy",
+        primary=False,
+        source="buildbot")
+    results = self.fp.transit_files(uid=1046, fileset_id=self.fs.id, req_state="testing")
+    self.assertEqual([r.file_id for r in results], [self.bf.id, bf2.id])
+    results = self.fp.transit_files(uid=1046, fileset_id=self.fs.id, req_state="tested")
+    self.assertEqual([r.error for r in results], [None, None])
+    self.assertEqual(af.state.name, "untested")
+
+  def test_transit_files_reports_failures_without_aborting(self):
+    bf2 = self._add_primary("setup.py")
+    self.fp.transit_file(uid=1046, file_id=bf2.id, req_state="testing")
+    af = self.fp.add_file(
+        uid=1046,
+        source_file=self.filename,
+        fileset_id=self.fs.id,
+        name="coverage-report.txt",
+        path="deploy",
+        primary=False,
+        source="buildbot")
+    results = self.fp.transit_files(uid=1046, file_ids=[self.bf.id, bf2.id, af.id, 99],
+                                    req_state="testing")
+    self.assertEqual(results[0], TransitResult(self.bf.id, "untested", "testing", None))
+    self.assertTrue(isinstance(results[1].error, FPLInvalidStateTransition))
+    self.assertTrue(isinstance(results[2].error, FPLInvalidTargetForStateChange))
+    self.assertTrue(isinstance(results[3].error, FPLBinFileNotExists))
+    self.fp.session.rollback()
+    self.assertEqual(self.bf.state.name, "testing")
+
+  def test_transit_files_without_permission(self):
+    results = self.fp.transit_files(uid=1047, file_ids=[self.bf.id], req_state="testing")
+    self.assertTrue(isinstance(results[0].error, FPLPermissionDenied))
+    self.assertEqual(self.bf.state.name, "untested")
+
+  def test_transit_files_to_unknown_state(self):
+    with self.assertRaises(FPLInvalidState):
+      self.fp.transit_files(uid=1046, file_ids=[self.bf.id], req_state="happy-birthday")
+
+  def test_transit_files_without_files(self):
+    with self.assertRaises(FPLNoFilesSpecified):
+      self.fp.transit_files(uid=1046, req_state="testing")
+
+  def test_auxilliary_file_check_is_memoized(self):
+    data = [TransitionData(id=1, data="name=test_report")]
+    cache = {}
+    with self.assertRaises(FPLCannotTransitionState):
+      check_auxilliary_file_in_fileset(1046, self.fp.perm_manager, "testing", "tested",
+                                       {"bf":self.bf, "data":data, "aux_cache":cache})
+    self.assertEqual(list(cache.values()), [False])
+    # a cached answer is used without looking at the fileset again
+    cache[list(cache.keys())[0]] = True
+    check_auxilliary_file_in_fileset(1046, self.fp.perm_manager, "testing", "tested",
+                                     {"bf":self.bf, "data":data, "aux_cache":cache})
+
 
 class TestFruitpileGetFileFromRepo(unittest.TestCase):
 
@@ -834,6 +1311,236 @@ class TestFruitpileGetFileFromRepo(unittest.TestCase):
     with self.assertRaises(FPLFileExists):
       self.fp.get_file(uid=1046, file_id=self.aux.id, to_file=to_file)
 
+  def test_open_file_in_store(self):
+    bf, fh = self.fp.open_file(uid=1046, file_id=self.bf.id)
+    orig_contents = io.open(self.filename, "rb").read()
+    self.assertEqual(bf.id, self.bf.id)
+    self.assertEqual(fh.size(), len(orig_contents))
+    self.assertEqual(bf.size, len(orig_contents))
+    fh.seek(10)
+    self.assertEqual(fh.read(), orig_contents[10:])
+    fh.close()
+
+  def test_open_file_unknown_id(self):
+    with self.assertRaises(FPLBinFileNotExists):
+      self.fp.open_file(uid=1046, file_id=self.aux.id + 1)
+
+  def test_open_file_without_permission(self):
+    with self.assertRaises(FPLPermissionDenied):
+      self.fp.open_file(uid=1047, file_id=self.bf.id)
+
+
+class TestFruitpileUploads(unittest.TestCase):
+
+  def setUp(self):
+    self.store_path = "/tmp/store%d" % (os.getpid())
+    clear_tree(self.store_path)
+    fp = Fruitpile(self.store_path)
+    fp.init(uid=1046, username="db")
+    fp.open()
+    self.fp = fp
+    self.fs = self.fp.add_new_fileset(name="test-1", version="1", revision="123", uid=1046)
+    self.contents = os.urandom(100000)
+
+  def tearDown(self):
+    self.fp.close()
+    self.fp = None
+    clear_tree(self.store_path)
+
+  def _start(self):
+    return self.fp.start_upload(uid=1046, fileset_id=self.fs.id, name="big.bin",
+                                path="deploy", primary=True, source="buildbot")
+
+  def test_upload_in_parts(self):
+    upload_id = self._start()
+    self.assertEqual(self.fp.upload_offset(uid=1046, upload_id=upload_id), 0)
+    offset = self.fp.append_upload(uid=1046, upload_id=upload_id, offset=0,
+                                   source_fob=io.BytesIO(self.contents[:60000]))
+    self.assertEqual(offset, 60000)
+    offset = self.fp.append_upload(uid=1046, upload_id=upload_id, offset=60000,
+                                   source_fob=io.BytesIO(self.contents[60000:]))
+    self.assertEqual(offset, len(self.contents))
+    bf = self.fp.finish_upload(uid=1046, upload_id=upload_id)
+    self.assertEqual(bf.name, "big.bin")
+    self.assertEqual(bf.fileset_id, self.fs.id)
+    self.assertEqual(bf.checksum, sha256(self.contents).hexdigest())
+    with self.assertRaises(FPLUploadNotFound):
+      self.fp.upload_offset(uid=1046, upload_id=upload_id)
+    self.assertEqual(os.listdir(os.path.join(self.store_path, "uploads")), [])
+
+  def test_upload_at_wrong_offset(self):
+    upload_id = self._start()
+    self.fp.append_upload(uid=1046, upload_id=upload_id, offset=0,
+                          source_fob=io.BytesIO(self.contents[:60000]))
+    with self.assertRaises(FPLUploadOffsetMismatch) as exc:
+      self.fp.append_upload(uid=1046, upload_id=upload_id, offset=50000,
+                            source_fob=io.BytesIO(self.contents[50000:]))
+    self.assertEqual(exc.exception.offset, 60000)
+
+  def test_upload_part_length(self):
+    upload_id = self._start()
+    with self.assertRaises(FPLUploadLengthMismatch):
+      self.fp.append_upload(uid=1046, upload_id=upload_id, offset=0, length=1000,
+                            source_fob=io.BytesIO(self.contents[:1001]))
+    with self.assertRaises(FPLUploadLengthMismatch):
+      self.fp.append_upload(uid=1046, upload_id=upload_id, offset=0, length=1000,
+                            source_fob=io.BytesIO(self.contents[:999]))
+    self.assertEqual(self.fp.upload_offset(uid=1046, upload_id=upload_id), 0)
+    offset = self.fp.append_upload(uid=1046, upload_id=upload_id, offset=0, length=1000,
+                                   source_fob=io.BytesIO(self.contents[:1000]))
+    self.assertEqual(offset, 1000)
+
+  def test_retried_part_waits_for_the_first(self):
+    # the retry blocks until the first attempt has finished and then
+    # finds the offset has moved on rather than appending the data again
+    upload_id = self._start()
+    first_started = threading.Event()
+    release = threading.Event()
+    class SlowReader(object):
+      def __init__(self, data):
+        self.fob = io.BytesIO(data)
+      def read(self, n=-1):
+        first_started.set()
+        release.wait(5)
+        return self.fob.read(n)
+    results = []
+    def first():
+      results.append(self.fp.append_upload(uid=1046, upload_id=upload_id, offset=0,
+                                           source_fob=SlowReader(self.contents)))
+    t = threading.Thread(target=first)
+    t.start()
+    first_started.wait(5)
+    retry = threading.Thread(target=lambda: results.append(self._append_expecting_mismatch(upload_id)))
+    retry.start()
+    time.sleep(0.2)
+    release.set()
+    t.join()
+    retry.join()
+    self.assertEqual(sorted(results), [len(self.contents), len(self.contents)])
+    self.assertEqual(self.fp.upload_offset(uid=1046, upload_id=upload_id), len(self.contents))
+
+  def _append_expecting_mismatch(self, upload_id):
+    try:
+      self.fp.append_upload(uid=1046, upload_id=upload_id, offset=0,
+                            source_fob=io.BytesIO(self.contents))
+    except FPLUploadOffsetMismatch as exc:
+      return exc.offset
+
+  def test_upload_offset_without_permission(self):
+    upload_id = self._start()
+    with self.assertRaises(FPLPermissionDenied):
+      self.fp.upload_offset(uid=1047, upload_id=upload_id)
+
+  def test_unknown_upload(self):
+    with self.assertRaises(FPLUploadNotFound):
+      self.fp.upload_offset(uid=1046, upload_id="0" * 32)
+    with self.assertRaises(FPLUploadNotFound):
+      self.fp.upload_offset(uid=1046, upload_id="../fpl.db")
+
+  def test_cancel_upload(self):
+    upload_id = self._start()
+    self.fp.cancel_upload(uid=1046, upload_id=upload_id)
+    with self.assertRaises(FPLUploadNotFound):
+      self.fp.upload_offset(uid=1046, upload_id=upload_id)
+    with self.assertRaises(FPLUploadNotFound):
+      self.fp.cancel_upload(uid=1046, upload_id=upload_id)
+    with self.assertRaises(FPLUploadNotFound):
+      self.fp.cancel_upload(uid=1046, upload_id="garbage")
+
+  def test_upload_without_permission(self):
+    with self.assertRaises(FPLPermissionDenied):
+      self.fp.start_upload(uid=1047, fileset_id=self.fs.id, name="big.bin",
+                           path="deploy", primary=True, source="buildbot")
+
+  def test_add_file_outside_repo(self):
+    outside = "%s-escape" % (self.store_path)
+    clear_tree(outside)
+    os.symlink(outside, os.path.join(self.fp.repo.repopath, "link"))
+    for path, name in [("../escape", "pwned.bin"), (outside, "pwned.bin"),
+                       ("deploy/../../escape", "pwned.bin"), ("deploy", "../pwned.bin"),
+                       ("deploy", ".."), ("deploy", ""), ("link", "pwned.bin"),
+                       ("", "fpl.db"), ("", "fpl.cfg"), (".", "fpl.db-wal"),
+                       ("uploads", "0" * 32), ("uploads/x", "y"), ("", "uploads"),
+                       ("blobs/.tmp", "0" * 32)]:
+      with self.assertRaises(FPLInvalidPath):
+        self.fp.add_file(uid=1046, source_fob=io.BytesIO(self.contents), fileset_id=self.fs.id,
+                         name=name, path=path, primary=True, source="buildbot")
+      with self.assertRaises(FPLInvalidPath):
+        self.fp.start_upload(uid=1046, fileset_id=self.fs.id, name=name,
+                             path=path, primary=True, source="buildbot")
+    self.assertFalse(os.path.exists(os.path.join(self.store_path, "escape")))
+    self.assertFalse(os.path.exists(outside))
+    self.assertEqual(self.fp.list_files(uid=1046), [])
+    self.assertEqual(self.fp.list_filesets(uid=1046)[0].name, "test-1")
+
+
+class TestFruitpileVerify(unittest.TestCase):
+
+  def setUp(self):
+    self.store_path = "/tmp/store%d" % (os.getpid())
+    clear_tree(self.store_path)
+    fp = Fruitpile(self.store_path)
+    fp.init(uid=1046, username="db")
+    fp.open()
+    self.fp = fp
+    self.fs = self.fp.add_new_fileset(name="test-1", version="1", revision="123", uid=1046)
+    self.text = b"".join([b"test %d passed\n" % (i) for i in range(50000)])
+    self.bfs = []
+    for i, data in enumerate([self.text, os.urandom(50000), b"abc" * 10]):
+      self.bfs.append(self.fp.add_file(uid=1046, source_fob=io.BytesIO(data),
+                                       fileset_id=self.fs.id, name="file-%d" % (i),
+                                       path="deploy", primary=True, source="buildbot"))
+
+  def tearDown(self):
+    self.fp.close()
+    clear_tree(self.store_path)
+
+  def _stored(self, bf):
+    return os.path.join(self.store_path, self.fp.repo.locate(bf))
+
+  def test_verify_good_store(self):
+    report = self.fp.verify_files(uid=1046, workers=2)
+    self.assertEqual(report.checked, 3)
+    self.assertEqual(report.ok, 3)
+    self.assertEqual((report.missing, report.corrupt, report.orphaned), ([], [], []))
+    self.assertEqual(report.size, len(self.text) + 50000 + 30)
+
+  def test_verify_finds_problems(self):
+    self.assertEqual(self.bfs[0].ztype, "gzip")
+    with io.open(self._stored(self.bfs[0]), "r+b") as fob:
+      fob.seek(100)
+      fob.write(b"garbage")
+    with io.open(self._stored(self.bfs[1]), "r+b") as fob:
+      fob.write(b"garbage")
+    os.remove(self._stored(self.bfs[2]))
+    io.open(os.path.join(self.store_path, "deploy", "stray"), "wb").close()
+    os.makedirs(os.path.join(self.store_path, "uploads"))
+    io.open(os.path.join(self.store_path, "uploads", "part"), "wb").close()
+    report = self.fp.verify_files(uid=1046, workers=1)
+    self.assertEqual(report.ok, 0)
+    self.assertEqual(sorted(report.corrupt), [self.bfs[0].id, self.bfs[1].id])
+    self.assertEqual(report.missing, [self.bfs[2].id])
+    self.assertEqual(report.orphaned, ["deploy/stray"])
+
+  def test_verify_subset(self):
+    report = self.fp.verify_files(uid=1046, file_ids=[self.bfs[1].id], workers=1)
+    self.assertEqual(report.checked, 1)
+    report = self.fp.verify_files(uid=1046, fileset_id=self.fs.id + 1, workers=1)
+    self.assertEqual(report.checked, 0)
+
+  def test_verify_resumes(self):
+    started = datetime.now()
+    self.fp.verify_files(uid=1046, file_ids=[self.bfs[0].id, self.bfs[1].id], workers=1)
+    report = self.fp.verify_files(uid=1046, older_than=started, workers=1)
+    self.assertEqual(report.checked, 1)
+    report = self.fp.verify_files(uid=1046, older_than=started, workers=1)
+    self.assertEqual(report.checked, 0)
+    self.assertEqual(self.fp.session.query(Verification).count(), 3)
+
+  def test_verify_without_permission(self):
+    with self.assertRaises(FPLPermissionDenied):
+      self.fp.verify_files(uid=1047)
+
 
 class TestTransitionWithTransitionFunction(unittest.TestCase):
 
@@ -1210,6 +1917,398 @@ class TestBinFileProperty(unittest.TestCase):
     self.assertEqual(props[1].name, "TestDate")
     self.assertEqual(props[1].value, "2015-10-29")
 
+  def test_same_property_value_is_shared(self):
+    for bf in [self.bf, self.aux]:
+      self.fp.add_binfile_property(uid=1046, binfile=bf, name="arch", value="x86_64")
+    self.fp.add_fileset_property(uid=1046, fileset=self.fs, name="arch", value="x86_64")
+    self.assertEqual(len(self.fp.session.query(BinFileProp).all()), 2)
+    self.assertEqual(len(self.fp.session.query(PropAssoc).all()), 1)
+    props = self.fp.session.query(Property).all()
+    self.assertEqual([(p.name, p.value) for p in props], [("arch", "x86_64")])
+
+  def test_update_shared_property_value(self):
+    for bf in [self.bf, self.aux]:
+      self.fp.add_binfile_property(uid=1046, binfile=bf, name="arch", value="x86_64")
+    self.fp.add_binfile_property(uid=1046, binfile=self.aux, name="arch", value="arm", update=True)
+    self.assertEqual(self.bf.properties(self.fp.session), {"arch":"x86_64"})
+    self.assertEqual(self.aux.properties(self.fp.session), {"arch":"arm"})
+    self.fp.add_binfile_property(uid=1046, binfile=self.aux, name="arch", value="x86_64", update=True)
+    self.assertEqual(self.aux.properties(self.fp.session), {"arch":"x86_64"})
+    self.assertEqual(len(self.fp.session.query(BinFileProp).filter(BinFileProp.prop_id == 1).all()), 2)
+
+
+class TestBulkProperties(CountStatements, unittest.TestCase):
+
+  def setUp(self):
+    self.store_path = "/tmp/store%d" % (os.getpid())
+    clear_tree(self.store_path)
+    fp = Fruitpile(self.store_path)
+    fp.init(uid=1046, username="db")
+    fp.open()
+    self.fp = fp
+    filename = "%s/data/example_file.txt" % (mydir)
+    self.fss = []
+    self.bfs = []
+    for i in range(3):
+      fs = self.fp.add_new_fileset(name="test-%d" % (i), version="1",
+                                   revision="123", uid=1046)
+      self.fss.append(fs)
+      self.bfs.append(self.fp.add_file(uid=1046, source_file=filename, fileset_id=fs.id,
+                                       name="artifact-%d.txt" % (i), path="deploy",
+                                       primary=True, source="buildbot"))
+    self.count_statements()
+
+  def tearDown(self):
+    self.stop_counting()
+    self.fp.close()
+    clear_tree(self.store_path)
+
+  def test_add_property_queries(self):
+    self.fp.add_fileset_property(uid=1046, fileset=self.fss[0], name="arch", value="x86_64")
+    self.fss[1].id
+    self.statements = []
+    self.fp.add_fileset_property(uid=1046, fileset=self.fss[1], name="arch", value="x86_64")
+    # look up the current value and the interned pair then add the association
+    self.assertEqual(len(self.statements), 3)
+
+  def test_set_fileset_properties(self):
+    changed = self.fp.set_fileset_properties(uid=1046, fileset_ids=[fs.id for fs in self.fss],
+                                             properties={"arch": "x86_64", "os": "linux"})
+    self.assertEqual(changed, 6)
+    for fs in self.fss:
+      self.assertEqual(fs.properties(self.fp.session), {"arch": "x86_64", "os": "linux"})
+    self.assertEqual(self.fp.session.query(Property).count(), 2)
+    self.assertEqual(self.fp.session.query(PropAssoc).count(), 6)
+
+  def test_set_fileset_properties_existing(self):
+    self.fp.add_fileset_property(uid=1046, fileset=self.fss[1], name="arch", value="arm")
+    with self.assertRaises(FPLPropertyExists):
+      self.fp.set_fileset_properties(uid=1046, fileset_ids=[fs.id for fs in self.fss],
+                                     properties={"arch": "x86_64", "os": "linux"})
+    self.assertEqual(self.fp.session.query(PropAssoc).count(), 1)
+    changed = self.fp.set_fileset_properties(uid=1046, fileset_ids=[fs.id for fs in self.fss],
+                                             properties={"arch": "x86_64", "os": "linux"}, update=True)
+    self.assertEqual(changed, 6)
+    for fs in self.fss:
+      self.assertEqual(fs.properties(self.fp.session), {"arch": "x86_64", "os": "linux"})
+    changed = self.fp.set_fileset_properties(uid=1046, fileset_ids=[fs.id for fs in self.fss],
+                                             properties={"arch": "x86_64"}, update=True)
+    self.assertEqual(changed, 0)
+
+  def test_set_fileset_properties_missing_fileset(self):
+    with self.assertRaises(FPLFileSetNotExists):
+      self.fp.set_fileset_properties(uid=1046, fileset_ids=[1, 99], properties={"arch": "x86_64"})
+    self.assertEqual(self.fp.session.query(PropAssoc).count(), 0)
+
+  def test_set_binfile_properties(self):
+    self.fp.add_binfile_property(uid=1046, binfile=self.bfs[0], name="arch", value="arm")
+    binfile_ids = [bf.id for bf in self.bfs]
+    self.statements = []
+    changed = self.fp.set_binfile_properties(uid=1046, binfile_ids=binfile_ids,
+                                             properties={"arch": "x86_64", "os": "linux"}, update=True)
+    self.assertEqual(changed, 6)
+    # check the ids, look up the current values, intern the new values
+    # then add and update the associations
+    self.assertEqual(len(self.statements), 7)
+    for bf in self.bfs:
+      self.assertEqual(bf.properties(self.fp.session), {"arch": "x86_64", "os": "linux"})
+    with self.assertRaises(FPLBinFileNotExists):
+      self.fp.set_binfile_properties(uid=1046, binfile_ids=[99], properties={"arch": "x86_64"})
+
+  def test_set_properties_permissions(self):
+    with self.assertRaises(FPLPermissionDenied):
+      self.fp.set_fileset_properties(uid=1045, fileset_ids=[1], properties={"arch": "x86_64"})
+    with self.assertRaises(FPLPermissionDenied):
+      self.fp.set_binfile_properties(uid=1045, binfile_ids=[1], properties={"arch": "x86_64"})
+
+
+class TestTagMany(CountStatements, unittest.TestCase):
+
+  def setUp(self):
+    self.store_path = "/tmp/store%d" % (os.getpid())
+    clear_tree(self.store_path)
+    fp = Fruitpile(self.store_path)
+    fp.init(uid=1046, username="db")
+    fp.open()
+    self.fp = fp
+    filename = "%s/data/example_file.txt" % (mydir)
+    self.fs_ids = []
+    self.bf_ids = []
+    for i in range(3):
+      fs = self.fp.add_new_fileset(name="test-%d" % (i), version="1",
+                                   revision="123", uid=1046)
+      self.fs_ids.append(fs.id)
+      bf = self.fp.add_file(uid=1046, source_file=filename, fileset_id=fs.id,
+                            name="artifact-%d.txt" % (i), path="deploy",
+                            primary=True, source="buildbot")
+      self.bf_ids.append(bf.id)
+    self.count_statements()
+
+  def tearDown(self):
+    self.stop_counting()
+    self.fp.close()
+    clear_tree(self.store_path)
+
+  def _tags(self, entity, ids):
+    return [self.fp.session.query(entity).filter(entity.id == obj_id).one().tags(self.fp.session) for obj_id in ids]
+
+  def test_tag_many_filesets(self):
+    added = self.fp.tag_many(uid=1046, tags=["nightly", "RC1"], fileset_ids=self.fs_ids)
+    self.assertEqual(added, 6)
+    self.assertEqual([sorted(tags) for tags in self._tags(FileSet, self.fs_ids)], [["RC1", "nightly"]] * 3)
+    self.assertEqual(self.fp.session.query(Tag).count(), 2)
+
+  def test_tag_many_binfiles_skips_existing(self):
+    self.fp.tag_binfile(uid=1046, binfile=self.fp.get_binfile(uid=1046, binfile_id=self.bf_ids[1])[0], tag="nightly")
+    added = self.fp.tag_many(uid=1046, tags=["nightly"], binfile_ids=self.bf_ids)
+    self.assertEqual(added, 2)
+    self.assertEqual(self._tags(BinFile, self.bf_ids), [["nightly"]] * 3)
+    self.assertEqual(self.fp.tag_many(uid=1046, tags=["nightly"], binfile_ids=self.bf_ids), 0)
+
+  def test_tag_many_uses_tag_cache(self):
+    self.fp.tag_many(uid=1046, tags=["nightly"], fileset_ids=self.fs_ids[:1])
+    self.statements = []
+    self.fp.tag_many(uid=1046, tags=["nightly"], fileset_ids=self.fs_ids)
+    # check the ids exist then one insert for all the associations
+    self.assertEqual(len(self.statements), 2)
+    self.assertTrue(self.statements[1].startswith("INSERT INTO tags_assocs"))
+
+  def test_tag_many_missing_ids(self):
+    with self.assertRaises(FPLFileSetNotExists):
+      self.fp.tag_many(uid=1046, tags=["nightly"], fileset_ids=[1, 99])
+    with self.assertRaises(FPLBinFileNotExists):
+      self.fp.tag_many(uid=1046, tags=["nightly"], binfile_ids=[99])
+    self.assertEqual(self.fp.session.query(TagAssoc).count(), 0)
+    self.assertEqual(self.fp.session.query(BinFileTag).count(), 0)
+
+  def test_tag_many_nothing_to_tag(self):
+    with self.assertRaises(FPLNoFilesSpecified):
+      self.fp.tag_many(uid=1046, tags=["nightly"])
+
+  def test_tag_many_permissions(self):
+    with self.assertRaises(FPLPermissionDenied):
+      self.fp.tag_many(uid=1045, tags=["nightly"], fileset_ids=self.fs_ids)
+    with self.assertRaises(FPLPermissionDenied):
+      self.fp.tag_many(uid=1045, tags=["nightly"], binfile_ids=self.bf_ids)
+
+
+class TestListWithTagsAndProperties(CountStatements, unittest.TestCase):
+
+  def setUp(self):
+    self.store_path = "/tmp/store%d" % (os.getpid())
+    clear_tree(self.store_path)
+    fp = Fruitpile(self.store_path)
+    fp.init(uid=1046, username="db")
+    fp.open()
+    self.fp = fp
+    filename = "%s/data/example_file.txt" % (mydir)
+    for i in range(4):
+      fs = self.fp.add_new_fileset(name="test-%d" % (i), version="1",
+                                   revision="123", uid=1046)
+      bf = self.fp.add_file(uid=1046, source_file=filename, fileset_id=fs.id,
+                            name="artifact-%d.txt" % (i), path="deploy",
+                            primary=True, source="buildbot")
+      if i % 2 == 0:
+        self.fp.tag_fileset(uid=1046, fileset=fs, tag="nightly")
+        self.fp.tag_binfile(uid=1046, binfile=bf, tag="nightly")
+      self.fp.tag_binfile(uid=1046, binfile=bf, tag="build-%d" % (i))
+      self.fp.add_fileset_property(uid=1046, fileset=fs, name="arch", value="arm-%d" % (i))
+      self.fp.add_binfile_property(uid=1046, binfile=bf, name="size", value="%d" % (i))
+    self.count_statements()
+
+  def tearDown(self):
+    self.stop_counting()
+    self.fp.close()
+    clear_tree(self.store_path)
+
+  def test_list_files_with_tags_and_properties(self):
+    bfs = self.fp.list_files(uid=1046, with_tags=True, with_properties=True)
+    # one query for the listing plus one each for tags and properties
+    self.assertEqual(len(self.statements), 3)
+    self.assertEqual([bf.loaded_tags for bf in bfs],
+                     [["nightly","build-0"],["build-1"],["nightly","build-2"],["build-3"]])
+    self.assertEqual([bf.loaded_properties for bf in bfs],
+                     [{"size":"%d" % (i)} for i in range(4)])
+    for bf in bfs:
+      self.assertEqual(bf.loaded_tags, bf.tags(self.fp.session))
+      self.assertEqual(bf.loaded_properties, bf.properties(self.fp.session))
+
+  def test_list_filesets_with_tags_and_properties(self):
+    fss = self.fp.list_filesets(uid=1046, with_tags=True, with_properties=True)
+    # one query for the listing plus one each for tags and properties
+    self.assertEqual(len(self.statements), 3)
+    self.assertEqual([fs.loaded_tags for fs in fss], [["nightly"],[],["nightly"],[]])
+    self.assertEqual([fs.loaded_properties for fs in fss],
+                     [{"arch":"arm-%d" % (i)} for i in range(4)])
+
+  def test_list_files_without_tags_or_properties(self):
+    bfs = self.fp.list_files(uid=1046)
+    self.assertEqual(len(self.statements), 1)
+    self.assertFalse(hasattr(bfs[0], "loaded_tags"))
+  def test_list_file_records(self):
+    bfs = self.fp.list_files(uid=1046, records=True)
+    # the state and fileset names come from the listing query itself
+    self.assertEqual(len(self.statements), 1)
+    self.assertTrue(all(isinstance(bf, FileRecord) for bf in bfs))
+    self.assertEqual([bf.fileset_name for bf in bfs], ["test-%d" % (i) for i in range(4)])
+    self.assertEqual([bf.state_name for bf in bfs], ["untested"] * 4)
+    self.assertEqual(bfs[0].loaded_tags, None)
+    for bf, obj in zip(bfs, self.fp.list_files(uid=1046)):
+      for field in ["id", "fileset_id", "name", "path", "primary", "create_date",
+                    "update_date", "source", "checksum", "ztype"]:
+        self.assertEqual(getattr(bf, field), getattr(obj, field))
+    with self.assertRaises(AttributeError):
+      bfs[0].extra = 1
+
+  def test_list_fileset_records_with_tags_and_properties(self):
+    fss = self.fp.list_filesets(uid=1046, records=True, with_tags=True, with_properties=True)
+    self.assertEqual(len(self.statements), 3)
+    self.assertTrue(all(isinstance(fs, FilesetRecord) for fs in fss))
+    self.assertEqual([(fs.id, fs.name, fs.version, fs.revision, fs.repo_name) for fs in fss],
+                     [(i + 1, "test-%d" % (i), "1", "123", "default") for i in range(4)])
+    self.assertEqual([fs.loaded_tags for fs in fss], [["nightly"],[],["nightly"],[]])
+
+  def test_page_and_iter_file_records(self):
+    bfs, next_cursor = self.fp.page_files(uid=1046, count=3, records=True, with_tags=True)
+    self.assertEqual([bf.id for bf in bfs], [1, 2, 3])
+    bfs, next_cursor = self.fp.page_files(uid=1046, count=3, cursor=next_cursor, records=True)
+    self.assertEqual([bf.id for bf in bfs], [4])
+    self.assertEqual(next_cursor, None)
+    self.statements = []
+    bfs = list(self.fp.iter_files(uid=1046, batch_size=2, records=True))
+    self.assertEqual([(bf.id, bf.state_name) for bf in bfs], [(i + 1, "untested") for i in range(4)])
+    # two full batches and an empty one to find the end
+    self.assertEqual(len(self.statements), 3)
+
+
+class TestSearch(CountStatements, unittest.TestCase):
+
+  def setUp(self):
+    self.store_path = "/tmp/store%d" % (os.getpid())
+    clear_tree(self.store_path)
+    fp = Fruitpile(self.store_path)
+    fp.init(uid=1046, username="db")
+    fp.open()
+    self.fp = fp
+    filename = "%s/data/example_file.txt" % (mydir)
+    for i in range(6):
+      fs = self.fp.add_new_fileset(name="test-%d" % (i), version="%d" % (i % 2),
+                                   revision="123", uid=1046)
+      bf = self.fp.add_file(uid=1046, source_file=filename, fileset_id=fs.id,
+                            name="artifact_%d.txt" % (i), path="deploy",
+                            primary=True, source="buildbot" if i < 4 else "jenkins")
+      if i % 2 == 0:
+        self.fp.tag_fileset(uid=1046, fileset=fs, tag="nightly")
+        self.fp.tag_binfile(uid=1046, binfile=bf, tag="nightly")
+        self.fp.transit_file(uid=1046, file_id=bf.id, req_state="testing")
+      self.fp.tag_binfile(uid=1046, binfile=bf, tag="build-%d" % (i))
+      arch = "x86_64" if i % 3 == 0 else "arm"
+      self.fp.add_fileset_property(uid=1046, fileset=fs, name="arch", value=arch)
+      self.fp.add_binfile_property(uid=1046, binfile=bf, name="arch", value=arch)
+    self.count_statements()
+
+  def tearDown(self):
+    self.stop_counting()
+    self.fp.close()
+    clear_tree(self.store_path)
+
+  def _file_ids(self, **kwargs):
+    bfs, next_cursor = self.fp.search_files(uid=1046, **kwargs)
+    self.assertEqual(next_cursor, None)
+    return [bf.id for bf in bfs]
+
+  def test_search_files_everything(self):
+    self.assertEqual(self._file_ids(), [1, 2, 3, 4, 5, 6])
+
+  def test_search_files_by_tag(self):
+    self.assertEqual(self._file_ids(tags=["nightly"]), [1, 3, 5])
+    self.assertEqual(self._file_ids(tags=["nightly", "build-2"]), [3])
+    self.assertEqual(self._file_ids(tags=["nightly", "build-1"]), [])
+    self.assertEqual(self._file_ids(tags=["nosuchtag"]), [])
+
+  def test_search_files_by_property(self):
+    self.assertEqual(self._file_ids(properties={"arch": "x86_64"}), [1, 4])
+    self.assertEqual(self._file_ids(properties={"arch": None}), [1, 2, 3, 4, 5, 6])
+    self.assertEqual(self._file_ids(properties={"os": None}), [])
+
+  def test_search_files_by_tag_property_and_state_in_one_query(self):
+    bfs, next_cursor = self.fp.search_files(uid=1046, tags=["nightly"], properties={"arch": "x86_64"},
+                                            state="testing")
+    self.assertEqual([bf.id for bf in bfs], [1])
+    self.assertEqual(len(self.statements), 1)
+
+  def test_search_files_by_state(self):
+    self.assertEqual(self._file_ids(state="testing"), [1, 3, 5])
+    self.assertEqual(self._file_ids(state="untested"), [2, 4, 6])
+    self.assertEqual(self._file_ids(state="released"), [])
+    with self.assertRaises(FPLUnknownState):
+      self._file_ids(state="nosuchstate")
+
+  def test_search_files_by_fileset_and_source(self):
+    self.assertEqual(self._file_ids(fileset_id=2), [2])
+    self.assertEqual(self._file_ids(source="jenkins"), [5, 6])
+
+  def test_search_files_by_name_pattern(self):
+    self.assertEqual(self._file_ids(name_pattern="artifact_[1].txt"), [])
+    self.assertEqual(self._file_ids(name_pattern="*_3.txt"), [4])
+    self.assertEqual(self._file_ids(name_pattern="artifact?0*"), [1])
+    # _ and % are not wildcards
+    self.assertEqual(self._file_ids(name_pattern="artifact%"), [])
+    self.assertEqual(self._file_ids(name_pattern="artifact__.txt"), [])
+
+  def test_search_files_by_date(self):
+    now = datetime.now()
+    self.assertEqual(self._file_ids(since=now - timedelta(hours=1)), [1, 2, 3, 4, 5, 6])
+    self.assertEqual(self._file_ids(until=now - timedelta(hours=1)), [])
+    self.assertEqual(self._file_ids(since=now + timedelta(hours=1)), [])
+
+  def test_parse_date(self):
+    self.assertEqual(parse_date("2016-01-02"), datetime(2016, 1, 2))
+    self.assertEqual(parse_date("2016-01-02T03:04"), datetime(2016, 1, 2, 3, 4))
+    self.assertEqual(parse_date("2016-01-02 03:04:05"), datetime(2016, 1, 2, 3, 4, 5))
+    self.assertEqual(parse_date("2016-01-02T03:04:05.5"), datetime(2016, 1, 2, 3, 4, 5, 500000))
+    with self.assertRaises(ValueError):
+      parse_date("yesterday")
+
+  def test_parse_properties(self):
+    self.assertEqual(parse_properties(None), {})
+    self.assertEqual(parse_properties(["os=linux", "nightly", "cmd=a=b", "empty="]),
+                     {"os":"linux", "nightly":None, "cmd":"a=b", "empty":""})
+
+  def test_search_files_pages(self):
+    bfs, next_cursor = self.fp.search_files(uid=1046, tags=["nightly"], count=2)
+    self.assertEqual([bf.id for bf in bfs], [1, 3])
+    bfs, next_cursor = self.fp.search_files(uid=1046, tags=["nightly"], count=2, cursor=next_cursor)
+    self.assertEqual([bf.id for bf in bfs], [5])
+    self.assertEqual(next_cursor, None)
+
+  def test_search_files_with_tags(self):
+    bfs, next_cursor = self.fp.search_files(uid=1046, tags=["build-3"], with_tags=True, with_properties=True)
+    self.assertEqual(bfs[0].loaded_tags, ["build-3"])
+    self.assertEqual(bfs[0].loaded_properties, {"arch": "x86_64"})
+
+  def test_search_filesets(self):
+    fss, next_cursor = self.fp.search_filesets(uid=1046, tags=["nightly"], properties={"arch": "x86_64"})
+    self.assertEqual([fs.name for fs in fss], ["test-0"])
+    fss, next_cursor = self.fp.search_filesets(uid=1046, name_pattern="test-*", version="1")
+    self.assertEqual([fs.name for fs in fss], ["test-1", "test-3", "test-5"])
+    fss, next_cursor = self.fp.search_filesets(uid=1046, revision="456")
+    self.assertEqual(fss, [])
+
+  def test_search_records(self):
+    bfs, next_cursor = self.fp.search_files(uid=1046, tags=["nightly"], state="testing", records=True)
+    self.assertEqual(len(self.statements), 1)
+    self.assertEqual([(bf.id, bf.fileset_name, bf.state_name) for bf in bfs],
+                     [(1, "test-0", "testing"), (3, "test-2", "testing"), (5, "test-4", "testing")])
+    fss, next_cursor = self.fp.search_filesets(uid=1046, properties={"arch": "x86_64"}, records=True)
+    self.assertEqual([(fs.name, fs.repo_name) for fs in fss], [("test-0", "default"), ("test-3", "default")])
+
+  def test_search_permission_denied(self):
+    with self.assertRaises(FPLPermissionDenied):
+      self.fp.search_files(uid=1, tags=["nightly"])
+    with self.assertRaises(FPLPermissionDenied):
+      self.fp.search_filesets(uid=1, tags=["nightly"])
+
 
 if __name__ == "__main__":
   unittest.main()
@@ -0,0 +1,293 @@
+# Copyright (c) 2016 Dominic Binks (software-fool on github)
+# This file is part of Fruitpile.
+#
+# Fruitpile is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Fruitpile is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Fruitpile.  If not, see <http://www.gnu.org/licenses/>.
+import unittest
+import os
+import sqlite3
+
+from fruitpile import Fruitpile, FPLNeedsUpgrade
+from fruitpile.db.schema import (
+  BinFile,
+  BinFileTag,
+  BinFileProp,
+  TagAssoc,
+  PropAssoc,
+  UserPermission,
+  Migration,
+  FileSet)
+from fruitpile.db.migrations import (
+  MIGRATIONS,
+  BatchedUpdate,
+  AddColumn,
+  current_version,
+  pending_migrations,
+  migrate)
+from fruitpile.fp_tool import fp_upgrade
+from argparse import Namespace
+from io import StringIO
+from sqlalchemy import Column, Integer, Table, MetaData
+from fruitpile.tests.test_fruitpile import clear_tree
+
+
+INDEXES = ["ix_binfiles_fileset_primary_name",
+           "ix_binfiles_state_id",
+           "ix_binfiles_checksum",
+           "ix_tags_assocs_fileset_id",
+           "ix_props_assocs_fileset_id",
+           "ix_binfile_tags_binfile_id",
+           "ix_binfile_props_binfile_id",
+           "ux_properties_name_value"]
+
+class TestMigrations(unittest.TestCase):
+
+  def setUp(self):
+    self.store_path = "/tmp/store%d" % (os.getpid())
+    clear_tree(self.store_path)
+    fp = Fruitpile(self.store_path)
+    fp.init(uid=1046, username="db")
+    fp.open()
+    fp.close()
+    self.dbpath = os.path.join(self.store_path, "fpl.db")
+
+  def tearDown(self):
+    clear_tree(self.store_path)
+
+  def _indexes(self):
+    conn = sqlite3.connect(self.dbpath)
+    rows = conn.execute("SELECT name FROM sqlite_master WHERE type='index'").fetchall()
+    conn.close()
+    return set([r[0] for r in rows])
+
+  def _make_old_store(self):
+    # what a store created before the migrations were added looks like
+    conn = sqlite3.connect(self.dbpath)
+    for index in INDEXES:
+      conn.execute("DROP INDEX %s" % (index))
+    conn.execute("DROP TABLE verifications")
+    conn.execute("ALTER TABLE binfiles DROP COLUMN size")
+    conn.execute("DELETE FROM migrations WHERE id > 1")
+    conn.commit()
+    conn.close()
+
+  def _tables(self):
+    conn = sqlite3.connect(self.dbpath)
+    rows = conn.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
+    conn.close()
+    return set([r[0] for r in rows])
+
+  def test_new_store_is_up_to_date(self):
+    fp = Fruitpile(self.store_path)
+    fp.open()
+    self.assertEqual(current_version(fp.session), MIGRATIONS[-1].id)
+    self.assertEqual(pending_migrations(fp.session), [])
+    self.assertEqual(fp.migrate(), [])
+    fp.close()
+    self.assertTrue(set(INDEXES) <= self._indexes())
+
+  def test_migrate_old_store(self):
+    self._make_old_store()
+    self.assertFalse(set(INDEXES) & self._indexes())
+    self.assertFalse("verifications" in self._tables())
+    fp = Fruitpile(self.store_path)
+    with self.assertRaises(FPLNeedsUpgrade):
+      fp.open()
+    fp.open(upgrade=True)
+    seen = []
+    applied = fp.migrate(progress=lambda step, done, total: seen.append(step.id))
+    self.assertEqual(applied, [step.id for step in MIGRATIONS])
+    self.assertEqual(seen, applied)
+    self.assertEqual(current_version(fp.session), MIGRATIONS[-1].id)
+    fp.close()
+    self.assertTrue(set(INDEXES) <= self._indexes())
+    self.assertTrue("verifications" in self._tables())
+    conn = sqlite3.connect(self.dbpath)
+    self.assertTrue("size" in [r[1] for r in conn.execute("PRAGMA table_info(binfiles)")])
+    conn.close()
+
+  def test_migrations_can_be_rerun(self):
+    fp = Fruitpile(self.store_path)
+    fp.open()
+    for step in MIGRATIONS:
+      list(step.run(fp.engine, fp.session, 10))
+    fp.close()
+
+  def _add_filesets(self, fp, count):
+    for n in range(count):
+      fp.add_new_fileset(uid=1046, name="fs%d" % (n), version="1", revision="1")
+
+  def test_batched_update(self):
+    fp = Fruitpile(self.store_path)
+    fp.open()
+    self._add_filesets(fp, 7)
+    def fill(session, ids):
+      session.query(FileSet).filter(FileSet.id.in_(ids)).update(
+        {FileSet.revision: "2"}, synchronize_session=False)
+    step = BatchedUpdate(1000, "bump_revision", FileSet, FileSet.revision == "1", fill)
+    seen = []
+    applied = migrate(fp.engine, progress=lambda step, done, total: seen.append((done, total)),
+                      batch_size=3, steps=[step])
+    self.assertEqual(applied, [1000])
+    self.assertEqual(seen, [(0, 7), (3, 7), (6, 7), (7, 7)])
+    self.assertEqual(fp.session.query(FileSet).filter(FileSet.revision == "2").count(), 7)
+    self.assertEqual(migrate(fp.engine, steps=[step]), [])
+    fp.close()
+
+  def test_batched_update_restarts_where_it_stopped(self):
+    fp = Fruitpile(self.store_path)
+    fp.open()
+    self._add_filesets(fp, 5)
+    def fill(session, ids):
+      session.query(FileSet).filter(FileSet.id.in_(ids)).update(
+        {FileSet.revision: "2"}, synchronize_session=False)
+    step = BatchedUpdate(1000, "bump_revision", FileSet, FileSet.revision == "1", fill)
+    batches = step.run(fp.engine, fp.session, 2)
+    self.assertEqual(next(batches), 2)
+    batches.close()
+    self.assertEqual(step.total(fp.session), 3)
+    self.assertEqual(migrate(fp.engine, batch_size=2, steps=[step]), [1000])
+    self.assertEqual(step.total(fp.session), 0)
+    fp.close()
+
+  def test_add_column(self):
+    fp = Fruitpile(self.store_path)
+    fp.open()
+    filesets = Table("filesets", MetaData(), Column("id", Integer, primary_key=True), Column("extra", Integer))
+    step = AddColumn(1000, "add_fileset_extra", filesets.c.extra)
+    self.assertEqual(migrate(fp.engine, steps=[step]), [1000])
+    list(step.run(fp.engine, fp.session, 10))
+    fp.close()
+    conn = sqlite3.connect(self.dbpath)
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(filesets)")]
+    conn.close()
+    self.assertTrue("extra" in columns)
+
+  def _make_duplicate_properties(self):
+    # three files and two filesets with arch=x86_64 and a fileset with
+    # os=linux, each with its own row as stores before interning had
+    fp = Fruitpile(self.store_path)
+    fp.open()
+    fs1 = fp.add_new_fileset(uid=1046, name="fs1", version="1", revision="1")
+    fs2 = fp.add_new_fileset(uid=1046, name="fs2", version="1", revision="1")
+    for n, fs in enumerate([fs1, fs1, fs2]):
+      bf = fp.add_file(uid=1046, source_file="requirements.txt", fileset_id=fs.id,
+                       name="f%d" % (n), path="p", primary=True, source="buildbot")
+      fp.add_binfile_property(uid=1046, binfile=bf, name="arch", value="x86_64")
+    for fs in [fs1, fs2]:
+      fp.add_fileset_property(uid=1046, fileset=fs, name="arch", value="x86_64")
+    fp.add_fileset_property(uid=1046, fileset=fs2, name="os", value="linux")
+    fp.close()
+    conn = sqlite3.connect(self.dbpath)
+    conn.execute("DROP INDEX ux_properties_name_value")
+    for table, key in [("binfile_props", "binfile_id"), ("props_assocs", "fileset_id")]:
+      for prop_id, obj_id in conn.execute("SELECT prop_id, %s FROM %s" % (key, table)).fetchall():
+        cur = conn.execute("INSERT INTO properties (name, value) SELECT name, value FROM properties WHERE id = ?", (prop_id,))
+        conn.execute("UPDATE %s SET prop_id = ? WHERE prop_id = ? AND %s = ?" % (table, key), (cur.lastrowid, prop_id, obj_id))
+    conn.execute("DELETE FROM migrations WHERE id > 3")
+    conn.commit()
+    conn.close()
+
+  def _properties(self, conn, table, key):
+    return sorted(conn.execute("SELECT a.%s, p.name, p.value FROM %s a JOIN properties p ON p.id = a.prop_id" % (key, table)).fetchall())
+
+  def test_dedupe_properties(self):
+    self._make_duplicate_properties()
+    conn = sqlite3.connect(self.dbpath)
+    self.assertEqual(conn.execute("SELECT COUNT(*) FROM properties").fetchone()[0], 8)
+    before = [self._properties(conn, "binfile_props", "binfile_id"), self._properties(conn, "props_assocs", "fileset_id")]
+    conn.close()
+    fp = Fruitpile(self.store_path)
+    fp.open(upgrade=True)
+    seen = []
+    applied = fp.migrate(progress=lambda step, done, total: seen.append((step.id, done, total)), batch_size=3)
+    self.assertEqual(applied, [4, 5, 6])
+    self.assertEqual(seen, [(4, 0, 6), (4, 1, 6), (4, 4, 6), (4, 6, 6), (5, 0, None), (6, 0, None)])
+    fp.close()
+    conn = sqlite3.connect(self.dbpath)
+    self.assertEqual(sorted(conn.execute("SELECT name, value FROM properties").fetchall()),
+                     [("arch", "x86_64"), ("os", "linux")])
+    after = [self._properties(conn, "binfile_props", "binfile_id"), self._properties(conn, "props_assocs", "fileset_id")]
+    conn.close()
+    self.assertEqual(before, after)
+    self.assertTrue("ux_properties_name_value" in self._indexes())
+
+  def test_fp_tool_upgrade(self):
+    self._make_old_store()
+    outfob = StringIO()
+    fp_upgrade(Namespace(path=self.store_path), outfob=outfob)
+    lines = outfob.getvalue().splitlines()
+    self.assertEqual(lines, ["applying migration %d: %s" % (step.id, step.name) for step in MIGRATIONS])
+    outfob = StringIO()
+    fp_upgrade(Namespace(path=self.store_path, batch_size=10), outfob=outfob)
+    self.assertEqual(outfob.getvalue(), "store is up to date\n")
+
+
+class TestQueryPlans(unittest.TestCase):
+  # The queries run for every file or permission check must find their
+  # rows through an index rather than scanning the table
+
+  def setUp(self):
+    self.store_path = "/tmp/store%d" % (os.getpid())
+    clear_tree(self.store_path)
+    fp = Fruitpile(self.store_path)
+    fp.init(uid=1046, username="db")
+    fp.open()
+    self.fp = fp
+
+  def tearDown(self):
+    self.fp.close()
+    clear_tree(self.store_path)
+
+  def _plan(self, q):
+    sql = str(q.statement.compile(self.fp.engine, compile_kwargs={"literal_binds": True}))
+    conn = self.fp.session.connection()
+    return [row[3] for row in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + sql)]
+
+  def _check_uses_index(self, q):
+    plan = self._plan(q)
+    self.assertTrue(len(plan) > 0)
+    for detail in plan:
+      self.assertTrue(detail.startswith("SEARCH") and "INDEX" in detail, detail)
+
+  def test_binfile_tags(self):
+    self._check_uses_index(self.fp.session.query(BinFileTag).filter(BinFileTag.binfile_id == 1))
+
+  def test_binfile_properties(self):
+    self._check_uses_index(self.fp.session.query(BinFileProp).filter(BinFileProp.binfile_id == 1))
+
+  def test_fileset_tags(self):
+    self._check_uses_index(self.fp.session.query(TagAssoc).filter(TagAssoc.fileset_id == 1))
+
+  def test_fileset_properties(self):
+    self._check_uses_index(self.fp.session.query(PropAssoc).filter(PropAssoc.fileset_id == 1))
+
+  def test_user_permissions(self):
+    self._check_uses_index(self.fp.session.query(UserPermission.perm_id).filter(UserPermission.user_id == 1046))
+
+  def test_auxilliary_files(self):
+    self._check_uses_index(self.fp.session.query(BinFile.name).filter(BinFile.fileset_id == 1).filter(
+      BinFile.primary == False).filter(BinFile.name.in_(["test_report"])))
+
+  def test_files_in_fileset(self):
+    self._check_uses_index(self.fp.session.query(BinFile).filter(BinFile.fileset_id == 1))
+
+  def test_files_in_state(self):
+    self._check_uses_index(self.fp.session.query(BinFile).filter(BinFile.state_id == 1))
+
+  def test_files_with_checksum(self):
+    self._check_uses_index(self.fp.session.query(BinFile).filter(BinFile.checksum == "abc"))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -118,6 +118,42 @@ class TestPermissionManager(unittest.TestCase):
     with self.assertRaises(FPLPermissionDenied):
       perm_man.check_permission(1046, Capability.ADD_FILESET)
 
+  def _setup_user(self, ttl=60):
+    build_permissions_table(self)
+    self.session.add(User(uid=1046,name="db"))
+    self.session.add(UserPermission(user_id=1046,perm_id=3))
+    self.session.commit()
+    return PermissionManager(self.session, ttl=ttl)
+
+  def test_permissions_are_cached(self):
+    perm_man = self._setup_user()
+    perm_man.check_permission(1046, Capability.LIST_FILESETS)
+    # A change made behind the session's back is not seen until the
+    # cache is invalidated
+    self.session.execute(UserPermission.__table__.insert().values(user_id=1046, perm_id=1))
+    with self.assertRaises(FPLPermissionDenied):
+      perm_man.check_permission(1046, Capability.ADD_FILESET)
+    perm_man.invalidate(1046)
+    perm_man.check_permission(1046, Capability.ADD_FILESET)
+
+  def test_permission_change_through_session_invalidates_cache(self):
+    perm_man = self._setup_user()
+    with self.assertRaises(FPLPermissionDenied):
+      perm_man.check_permission(1046, Capability.ADD_FILESET)
+    self.session.add(UserPermission(user_id=1046,perm_id=1))
+    self.session.commit()
+    perm_man.check_permission(1046, Capability.ADD_FILESET)
+    up = self.session.query(UserPermission).filter(UserPermission.perm_id==3).one()
+    self.session.delete(up)
+    self.session.commit()
+    with self.assertRaises(FPLPermissionDenied):
+      perm_man.check_permission(1046, Capability.LIST_FILESETS)
+
+  def test_permission_cache_expires(self):
+    perm_man = self._setup_user(ttl=0)
+    perm_man.check_permission(1046, Capability.LIST_FILESETS)
+    self.session.execute(UserPermission.__table__.insert().values(user_id=1046, perm_id=1))
+    perm_man.check_permission(1046, Capability.ADD_FILESET)
 
 
 if __name__ == "__main__":
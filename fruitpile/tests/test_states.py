@@ -73,6 +73,24 @@ class TestStateMachine(unittest.TestCase):
     with self.assertRaises(FPLUnknownState):
       sm.transit(1000, None, "start", "new_state", {"obj":self})
 
+  def test_errors_name_the_old_state(self):
+    sm = self.build_simple_state_machine(lambda a,b,c,d,e: None)
+    pm = DummyPermManager(True)
+    with self.assertRaises(FPLUnknownState) as exc:
+      sm.transit(100, pm, "middle", "end", {"obj":self})
+    self.assertEqual(str(exc.exception), "An unknown state: middle")
+    sm._transitions["end"] = {}
+    with self.assertRaises(FPLInvalidStateTransition) as exc:
+      sm.transit(100, pm, "end", "start", {"obj":self})
+    self.assertEqual(str(exc.exception), "Invalid state transition from end to start")
+
+  def test_transit_leaves_state_machine_alone(self):
+    sm = self.build_simple_state_machine(lambda a,b,c,d,e: None)
+    pm = DummyPermManager(True)
+    self.assertEqual(sm.transit(100, pm, "start", "end", {"obj":self}), "end")
+    self.assertEqual(sm.state, "start")
+    self.assertEqual(sm.transit(100, pm, "start", "end", {"obj":self}), "end")
+
   def test_simple_state_machine(self):
     sm = self.build_simple_state_machine(lambda a,b,c,d,e: None)
     self.assertEqual(sm.state, "start")